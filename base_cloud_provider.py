@@ -1,29 +1,96 @@
 import typing as t
 
+from provider_executor import ProviderExecutor
+
+StoreTokensCallback = t.Callable[[t.Optional[str], t.Optional[str]], None]
+
+
 class BaseCloudProvider:
     directory_name: str = 'Save Bot Directory'
     name: str = 'base'
+    # Stored per chat and used as /start parameter by providers without OAuth
+    key: str = 'base'
+    uses_oauth: bool = False
+    # Seconds an access token stays valid, None for providers whose tokens don't expire
+    access_token_ttl: t.Optional[float] = None
 
     def __init__(self, **kwargs) -> None:
-        ...
+        # Blocking SDK and file system calls run here, bounded per chat and globally
+        self.executor: ProviderExecutor = kwargs.get('executor') or ProviderExecutor()
 
     def get_registration_link(self) -> str:
         ...
 
-    def get_directory_link(self, directory_id: str) -> str:
+    def get_directory_link(self, directory_id: str, directory_name: str) -> str:
         ...
 
     def get_file_link(self, file_id: str, file_name: str) -> str:
         ...
 
-    def get_oauth_tokens(self, code: str) -> str:
+    async def get_oauth_tokens(self, code: str) -> t.Tuple[str, str]:
+        ...
+
+    async def refresh_tokens(
+            self,
+            access_token: str,
+            refresh_token: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.Tuple[str, str]:
+        ...
+
+    async def register_user(
+            self,
+            code: t.Optional[str],
+            update_store_callback: t.Callable[[str, str, str], None],
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            tokens: t.Optional[t.Tuple[str, str]] = None) -> t.Tuple[t.Any, str, str, t.Any]:
         ...
 
-    def register_user(self, code: str, update_store_callback: t.Callable[[str, str, str], None]) -> str:
+    async def upload_stream(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            file: t.BinaryIO,
+            file_name: str,
+            file_size: t.Optional[int] = None,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            upload_session_id: t.Optional[str] = None,
+            on_upload_session: t.Optional[t.Callable[[str], None]] = None) -> t.Any:
         ...
 
-    def upload_file(self, access_token: str, refresh_token: str, file) -> t.Any:
+    async def file_exists(
+            self,
+            access_token: str,
+            refresh_token: str,
+            file_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> bool:
         ...
 
-    def search(self, access_token: str, refresh_token: str, folder_id: str, query: str) -> t.Any:
-        ...
\ No newline at end of file
+    def search(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            query: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.AsyncIterator[t.Any]:
+        ...
+
+    async def list_files(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.List[t.Any]:
+        ...
+
+    def invalidate_folder_cache(self, folder_id: str) -> None:
+        ...
+
+    async def shutdown(self) -> None:
+        ...
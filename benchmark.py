@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import json
+import multiprocessing
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+import click
+import httpx
+from telegram import Update
+
+from config import Config
+from db_schema import migrate
+from fake_api import FakeTelegramApi, run_fake_box_api
+from file_index import FileIndex
+from rate_limiter import TokenBucketRateLimiter
+from saver_bot import SaverBot
+from sqlite_persistence import SqlitePersistence
+from upload_queue import UploadJobStore
+
+# Drives simulated chats through the bot against local stand-ins of the Telegram Bot API and the Box API.
+# Every chat registers, uploads its documents and searches for them, one step after another, and a step
+# is timed from putting its update on the application's queue until the bot's final reply reaches the fake Telegram.
+
+# Replies the bot sends before the one that finishes an upload
+UPLOAD_PROGRESS_MARKERS = ('is uploading to your', 'Uploading ')
+ERROR_MARKERS = ('Error', 'Something went wrong', 'Temporary failure', 'could not be uploaded', 'already exists', 'Sorry')
+
+
+class ReplyTracker:
+    # Every chat waits for one reply at a time, the fake Telegram API reports all texts the bot sends
+    def __init__(self) -> None:
+        self._waiting: t.Dict[int, t.Tuple[t.Callable[[str], bool], asyncio.Future]] = {}
+
+    def expect(self, chat_id: int, is_final: t.Callable[[str], bool]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = (is_final, future)
+        return future
+
+    def on_message(self, chat_id: int, text: str) -> None:
+        waiting = self._waiting.get(chat_id)
+        if waiting is None:
+            return
+        is_final, future = waiting
+        if is_final(text) and not future.done():
+            del self._waiting[chat_id]
+            future.set_result(text)
+
+    def cancel(self, chat_id: int) -> None:
+        self._waiting.pop(chat_id, None)
+
+
+class Benchmark:
+    def __init__(
+            self,
+            bot: SaverBot,
+            tracker: ReplyTracker,
+            chats: int = 1000,
+            concurrency: int = 200,
+            files_per_chat: int = 2,
+            searches_per_chat: int = 1,
+            file_size: int = 256 * 1024,
+            timeout: float = 120) -> None:
+        self.bot = bot
+        self.tracker = tracker
+        self.chats = chats
+        self.concurrency = concurrency
+        self.files_per_chat = files_per_chat
+        self.searches_per_chat = searches_per_chat
+        self.file_size = file_size
+        self.timeout = timeout
+        self.latencies: t.DefaultDict[str, t.List[float]] = collections.defaultdict(list)
+        self.errors: t.Counter[str] = collections.Counter()
+        self._update_ids = iter(range(1, 1 << 62))
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _run_chat(chat_id: int) -> None:
+            async with semaphore:
+                await self._run_chat(chat_id)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(_run_chat(chat_id) for chat_id in range(1, self.chats + 1)))
+        return time.perf_counter() - started_at
+
+    async def _run_chat(self, chat_id: int) -> None:
+        if not await self._step(chat_id, 'register', self._make_message(chat_id, text=f'/start bench-{chat_id}'), self._is_any_reply):
+            return
+        for index in range(self.files_per_chat):
+            document = {
+                'file_id': f'doc-{chat_id}-{index}',
+                'file_unique_id': f'doc-{chat_id}-{index}',
+                'file_name': f'bench book {chat_id} {index}.pdf',
+                'file_size': self.file_size,
+            }
+            await self._step(chat_id, 'upload', self._make_message(chat_id, document=document), self._is_upload_result)
+        for _ in range(self.searches_per_chat):
+            await self._step(chat_id, 'search', self._make_message(chat_id, text='bench book'), self._is_any_reply)
+
+    async def _step(self, chat_id: int, operation: str, message: dict, is_final: t.Callable[[str], bool]) -> bool:
+        application = self.bot.application
+        future = self.tracker.expect(chat_id, is_final)
+        started_at = time.perf_counter()
+        await application.update_queue.put(Update.de_json({'update_id': next(self._update_ids), 'message': message}, application.bot))
+        try:
+            text = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.tracker.cancel(chat_id)
+            self.errors[f'{operation}_timeout'] += 1
+            return False
+        self.latencies[operation].append(time.perf_counter() - started_at)
+        if any(marker in text for marker in ERROR_MARKERS):
+            self.errors[f'{operation}_error'] += 1
+            return False
+        return True
+
+    def _make_message(self, chat_id: int, text: t.Optional[str] = None, document: t.Optional[dict] = None) -> dict:
+        message = {
+            'message_id': next(self._update_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'bench {chat_id}'},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+        if document is not None:
+            message['document'] = document
+        return message
+
+    @staticmethod
+    def _is_any_reply(text: str) -> bool:
+        return True
+
+    @staticmethod
+    def _is_upload_result(text: str) -> bool:
+        # A batch status message is final once all of its files are processed
+        return not any(marker in text for marker in UPLOAD_PROGRESS_MARKERS)
+
+    def summary(self, elapsed: float) -> t.Dict[str, t.Any]:
+        operations = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            operations[operation] = {
+                'count': len(ordered),
+                'throughput_per_s': len(ordered) / elapsed,
+                'p50_ms': statistics.median(ordered) * 1000,
+                'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        completed = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'elapsed_s': elapsed,
+            'throughput_per_s': completed / elapsed,
+            'operations': operations,
+            'errors': dict(self.errors),
+        }
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _get_commit() -> t.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _wait_for_server(url: str, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def _fetch_json(url: str) -> t.Dict[str, t.Any]:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(url)).json()
+
+
+async def run_benchmark(
+        chats: int,
+        concurrency: int,
+        files_per_chat: int,
+        searches_per_chat: int,
+        file_size: int,
+        telegram_latency: float,
+        box_latency: float,
+        telegram_failure_rate: float,
+        box_failure_rate: float,
+        timeout: float,
+        rate_limit: bool,
+        bot_kwargs: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    tracker = ReplyTracker()
+    telegram_api = FakeTelegramApi(
+        bot_name=Config().bot_name,
+        file_size=file_size,
+        latency=telegram_latency,
+        failure_rate=telegram_failure_rate,
+        on_message=tracker.on_message)
+    telegram_port = _get_free_port()
+    telegram_server = telegram_api.make_app().listen(telegram_port, '127.0.0.1')
+
+    box_port = _get_free_port()
+    box_process = multiprocessing.get_context('spawn').Process(
+        target=run_fake_box_api,
+        args=(box_port, box_latency, box_failure_rate),
+        name='fake-box-api',
+        daemon=True)
+    box_process.start()
+
+    try:
+        box_api_url = f'http://127.0.0.1:{box_port}'
+        await _wait_for_server(f'{box_api_url}/stats')
+        with tempfile.TemporaryDirectory(prefix='save-bot-bench-') as directory:
+            db = str(Path(directory) / 'bench.db')
+            migrate(db)
+            persistence = SqlitePersistence(db)
+            upload_queue = UploadJobStore(db) if bot_kwargs.pop('upload_queue') else None
+            # The real limits would make Telegram's flood control the only thing measured
+            rate_limiter = None if rate_limit else TokenBucketRateLimiter(
+                global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6, group_rate=1e6, group_burst=1e6)
+            bot = SaverBot(
+                persistence=persistence,
+                file_index=FileIndex(db) if bot_kwargs.pop('file_index') else None,
+                upload_queue=upload_queue,
+                rate_limiter=rate_limiter,
+                telegram_api_url=f'http://127.0.0.1:{telegram_port}',
+                box_api_url=box_api_url,
+                polling=False,
+                **bot_kwargs)
+            benchmark = Benchmark(bot, tracker, chats, concurrency, files_per_chat, searches_per_chat, file_size, timeout)
+            elapsed, upload_jobs = 0.0, None
+
+            async def _serve() -> None:
+                nonlocal elapsed, upload_jobs
+                elapsed = await benchmark.run()
+                # The store is closed together with the bot
+                upload_jobs = upload_queue.stats() if upload_queue is not None else None
+
+            persistence_before = persistence.stats()
+            await bot._serve_application(_serve)
+            persistence_after = persistence.stats()
+            results = benchmark.summary(elapsed)
+            results['sqlite'] = {
+                'chat_data_flushes_per_s': (persistence_after['flushes'] - persistence_before['flushes']) / elapsed,
+                'chat_data_rows_per_s': (persistence_after['rows_written'] - persistence_before['rows_written']) / elapsed,
+                'upload_jobs': upload_jobs,
+            }
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        results['fake_telegram'] = {'requests': telegram_api.requests, 'failures': telegram_api.failures}
+        results['fake_box'] = await _fetch_json(f'{box_api_url}/stats')
+        return results
+    finally:
+        telegram_server.stop()
+        box_process.terminate()
+        box_process.join()
+
+
+def _compare(results: t.Dict[str, t.Any], baseline: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    # Relative change of the headline numbers, positive means more (slower for latencies, faster for throughput)
+    def _change(new: t.Optional[float], old: t.Optional[float]) -> t.Optional[float]:
+        if new is None or not old:
+            return None
+        return round((new - old) / old * 100, 1)
+
+    comparison = {
+        'baseline_commit': baseline.get('commit'),
+        'same_parameters': results['parameters'] == baseline.get('parameters'),
+        'throughput_per_s_pct': _change(results['throughput_per_s'], baseline.get('throughput_per_s')),
+        'peak_rss_mb_pct': _change(results['peak_rss_mb'], baseline.get('peak_rss_mb')),
+    }
+    for operation, stats in results['operations'].items():
+        old_stats = baseline.get('operations', {}).get(operation, {})
+        for name in ('p50_ms', 'p99_ms'):
+            comparison[f'{operation}_{name}_pct'] = _change(stats[name], old_stats.get(name))
+    return comparison
+
+
+@click.command()
+@click.option('--chats', default=1000, help='Number of simulated chats')
+@click.option('--concurrency', default=200, help='Max number of chats active at the same time')
+@click.option('--files-per-chat', default=2, help='Documents every chat uploads')
+@click.option('--searches-per-chat', default=1, help='Searches every chat runs after its uploads')
+@click.option('--file-size', default=256 * 1024, help='Size of every document in bytes')
+@click.option('--telegram-latency', default=0.02, help='Seconds the fake Telegram API waits before answering')
+@click.option('--box-latency', default=0.05, help='Seconds the fake Box API waits before answering')
+@click.option('--telegram-failure-rate', default=0.0, help='Share of Telegram requests answered with a 429')
+@click.option('--box-failure-rate', default=0.0, help='Share of Box requests answered with a 503')
+@click.option('--timeout', default=120.0, help='Seconds a chat waits for a reply before the step counts as timed out')
+@click.option('--rate-limit/--no-rate-limit', default=False, help='Apply the real Telegram rate limits to outgoing messages')
+@click.option('--workers', default=16, help='Size of the thread pool for cloud provider calls')
+@click.option('--max-concurrent', default=64, help='Max number of provider calls in flight across all chats')
+@click.option('--per-chat-limit', default=2, help='Max number of provider calls in flight for a single chat')
+@click.option('--streaming/--no-streaming', default=False, help='Pipe Telegram downloads straight into the provider upload')
+@click.option('--spool-dir', default=None, help='Spool downloads to this directory and upload them memory-mapped')
+@click.option('--file-index/--no-file-index', default=True, help='Answer searches from the local full-text index')
+@click.option('--upload-queue/--no-upload-queue', default=True, help='Run uploads as durable jobs')
+@click.option('--upload-workers', default=4, help='Number of upload jobs processed at the same time')
+@click.option('--batch-window', default=1.0, help='Seconds to collect documents of a chat into one batch, 0 disables batching')
+@click.option('--output', default=None, help='File to write the JSON results to, printed otherwise')
+@click.option('--baseline', default=None, help='Results of an earlier run to compare against')
+def main(
+        chats: int,
+        concurrency: int,
+        files_per_chat: int,
+        searches_per_chat: int,
+        file_size: int,
+        telegram_latency: float,
+        box_latency: float,
+        telegram_failure_rate: float,
+        box_failure_rate: float,
+        timeout: float,
+        rate_limit: bool,
+        workers: int,
+        max_concurrent: int,
+        per_chat_limit: int,
+        streaming: bool,
+        spool_dir: t.Optional[str],
+        file_index: bool,
+        upload_queue: bool,
+        upload_workers: int,
+        batch_window: float,
+        output: t.Optional[str],
+        baseline: t.Optional[str]) -> None:
+    parameters = dict(
+        chats=chats,
+        concurrency=concurrency,
+        files_per_chat=files_per_chat,
+        searches_per_chat=searches_per_chat,
+        file_size=file_size,
+        telegram_latency=telegram_latency,
+        box_latency=box_latency,
+        telegram_failure_rate=telegram_failure_rate,
+        box_failure_rate=box_failure_rate,
+        rate_limit=rate_limit)
+    bot_kwargs = dict(
+        max_workers=workers,
+        max_concurrent=max_concurrent,
+        per_chat_limit=per_chat_limit,
+        streaming=streaming,
+        spool_dir=spool_dir,
+        file_index=file_index,
+        upload_queue=upload_queue,
+        upload_workers=upload_workers,
+        batch_window=batch_window)
+    results = asyncio.run(run_benchmark(timeout=timeout, bot_kwargs=dict(bot_kwargs), **parameters))
+    # Runs are only comparable with the same parameters, so they travel with the numbers
+    results = dict(commit=_get_commit(), python=platform.python_version(), parameters=dict(parameters, **bot_kwargs), **results)
+    if baseline is not None:
+        results['comparison'] = _compare(results, json.loads(Path(baseline).read_text()))
+
+    text = json.dumps(results, indent=2)
+    if output is not None:
+        Path(output).write_text(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import collections
+import re
+import threading
+import time
+import typing as t
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import boxsdk
+from boxsdk.config import API
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import Session, AuthorizedSession
+
+from base_cloud_provider import StoreTokensCallback
+from metrics import REGISTRY
+
+BOX_API_REQUEST_SECONDS = REGISTRY.histogram('save_bot_box_api_request_seconds', 'Duration of Box API requests, retries count separately')
+# Numeric item ids and hex upload session ids, replaced so every endpoint is a single label value
+_ID_SEGMENT_RE = re.compile(r'^(\d+|[0-9A-Fa-f]{32})$')
+
+
+def _get_endpoint(url: str) -> str:
+    segments = [segment for segment in urlsplit(url).path.split('/') if segment and segment not in ('api', '2.0')]
+    return '/'.join(':id' if _ID_SEGMENT_RE.match(segment) else segment for segment in segments)
+
+
+class _SharedSessionNetwork(DefaultNetwork):
+    def __init__(self, session: requests.Session) -> None:
+        super().__init__()
+        self._session = session
+
+    def request(self, method, url, access_token, **kwargs):
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().request(method, url, access_token, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            BOX_API_REQUEST_SECONDS.observe(time.perf_counter() - started_at, method=method.upper(), endpoint=_get_endpoint(url), status=status)
+
+
+class _PooledClient:
+    def __init__(self, client: boxsdk.Client, access_token: str, refresh_token: str, store_tokens: t.Optional[StoreTokensCallback]) -> None:
+        self.client = client
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        # Callers may still hold tokens read before a rotation, those must hit the same client
+        self.known_refresh_tokens = {refresh_token}
+        self.store_tokens = store_tokens
+        self.last_used = time.monotonic()
+
+    def on_tokens_rotated(self, access_token: str, refresh_token: str) -> None:
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.known_refresh_tokens.add(refresh_token)
+        if self.store_tokens is not None:
+            self.store_tokens(access_token, refresh_token)
+
+
+class BoxClientPool:
+    def __init__(
+            self,
+            client_id: str,
+            client_secret: str,
+            max_size: int = 1024,
+            ttl: float = 30 * 60,
+            http_pool_size: int = 32,
+            api_config: t.Optional[API] = None) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_size = max_size
+        self.ttl = ttl
+        self.api_config = api_config or API()
+
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+        self.http_session.mount('https://', adapter)
+        self.http_session.mount('http://', adapter)
+        self.network = _SharedSessionNetwork(self.http_session)
+
+        self._clients: t.OrderedDict[t.Hashable, _PooledClient] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+            self,
+            key: t.Optional[t.Hashable],
+            access_token: str,
+            refresh_token: str,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> boxsdk.Client:
+        if key is None:
+            return self._create(access_token, refresh_token, store_tokens).client
+
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+            pooled = self._clients.get(key)
+            # An unknown refresh token means the user re-registered and the cached client is stale
+            if pooled is not None and refresh_token in pooled.known_refresh_tokens:
+                self._clients.move_to_end(key)
+                pooled.last_used = now
+                pooled.store_tokens = store_tokens
+                self.hits += 1
+                return pooled.client
+
+            self.misses += 1
+            pooled = self._create(access_token, refresh_token, store_tokens)
+            self._clients[key] = pooled
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+            return pooled.client
+
+    def invalidate(self, key: t.Hashable) -> None:
+        with self._lock:
+            self._clients.pop(key, None)
+
+    def stats(self) -> t.Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._clients),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _create(self, access_token: str, refresh_token: str, store_tokens: t.Optional[StoreTokensCallback]) -> _PooledClient:
+        pooled = _PooledClient(None, access_token, refresh_token, store_tokens)
+        oauth = boxsdk.OAuth2(
+            self.client_id,
+            self.client_secret,
+            access_token=access_token,
+            refresh_token=refresh_token,
+            store_tokens=pooled.on_tokens_rotated,
+            session=Session(network_layer=self.network, api_config=self.api_config))
+        # OAuth2 keeps its own API config for token refreshes
+        oauth._api_config = self.api_config
+        pooled.client = boxsdk.Client(oauth, session=AuthorizedSession(oauth, network_layer=self.network, api_config=self.api_config))
+        return pooled
+
+    def _evict_expired(self, now: float) -> None:
+        # Entries are ordered by last use, so expired ones are always at the front
+        while self._clients:
+            key, pooled = next(iter(self._clients.items()))
+            if now - pooled.last_used < self.ttl:
+                break
+            del self._clients[key]
+            self.evictions += 1
@@ -1,130 +1,420 @@
-import typing as t
-
-import requests
-
-import boxsdk
-from boxsdk.object.user import User as BoxUser
-from boxsdk.object.folder import Folder as BoxFolder
-from boxsdk.object.file import File as BoxFile
-
-from base_cloud_provider import BaseCloudProvider
-from exceptions import (
-    ItemNameInUseException,
-    InternalException,
-)
-
-
-class BoxProvider(BaseCloudProvider):
-    name: str = 'Box.com'
-
-    def __init__(self, **kwargs) -> None:
-        super().__init__()
-
-        self.client_id = kwargs['client_id']
-        self.client_token = kwargs['client_token']
-        self.redirect_url = kwargs['redirect_url']
-
-    def get_oauth_tokens(self, code: str) -> str:
-        access_token_url = 'https://api.box.com/oauth2/token'
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        params = {
-            'client_id': self.client_id,
-            'client_secret': self.client_token,
-            'code': code,
-            'grant_type': 'authorization_code'
-        }
-        response = requests.post(access_token_url, data=params, headers=headers)
-
-        json_response = response.json()
-        access_token = json_response['access_token']
-        refresh_token = json_response['refresh_token']
-
-        return access_token, refresh_token
-
-    def register_user(self, code: str, update_store_callback: t.Callable[[str, str, str], None]) -> str:
-        access_token, refresh_token, save_bot_directory = None, None, None
-        try:
-            access_token, refresh_token = self.get_oauth_tokens(code)
-            oauth: boxsdk.OAuth2 = boxsdk.OAuth2(
-                self.client_id,
-                self.client_token,
-                access_token=access_token,
-                refresh_token=refresh_token)
-            box_client = boxsdk.Client(oauth)
-            user: BoxUser = box_client.user().get()
-            save_bot_directory: BoxFolder = box_client.root_folder().create_subfolder(self.directory_name)
-            return user, access_token, refresh_token, save_bot_directory
-        except boxsdk.exception.BoxAPIException as box_exception:
-            if box_exception.status == 409 and box_exception.code == 'item_name_in_use':
-                context_info = box_exception.context_info
-                conflicts = [x for x in context_info['conflicts'] if x['name'] == self.directory_name]
-                if len(conflicts) == 1:
-                    box_folder_id = conflicts[0]['id']
-                    update_store_callback(access_token, refresh_token, box_folder_id)
-                    raise ItemNameInUseException(user.login, box_folder_id, self.directory_name)
-                else:
-                    update_store_callback(access_token, refresh_token, save_bot_directory)
-                    raise InternalException(box_exception)
-        except Exception as ex:
-            update_store_callback(access_token, refresh_token, save_bot_directory)
-            raise InternalException(ex)
-
-    def get_registration_link(self) -> str:
-        return f'<a href="https://account.box.com/api/oauth2/authorize?client_id={self.client_id}&redirect_uri={self.redirect_url}&response_type=code">Connect to Box.com</a>'
-
-    def get_directory_link(self, directory_id: str, directory_name: str) -> str:
-        return f'[{directory_name}](https://app.box.com/file/{directory_id})'
-
-    def get_file_link(self, file_id: str, file_name: str) -> str:
-        return f'[{file_name}](https://app.box.com/file/{file_id})'
-
-    def upload_file(self, access_token: str, refresh_token: str, folder_id: str, file, file_name: str) -> BoxFile:
-        try:
-            oauth: boxsdk.OAuth2 = boxsdk.OAuth2(self.client_id, self.client_token, access_token=access_token, refresh_token=refresh_token)
-            box_client = boxsdk.Client(oauth)
-            uploaded_file = box_client.folder(folder_id).upload_stream(file, file_name)
-            return uploaded_file
-        except boxsdk.exception.BoxAPIException as box_exception:
-            if box_exception.status == 409 and box_exception.code == 'item_name_in_use':
-                context_info = box_exception.context_info
-                user: BoxUser = box_client.user().get()                
-                file_id = context_info['conflicts']['id']
-                file_name = context_info['conflicts']['name']
-                raise ItemNameInUseException(user.login, file_id, file_name)
-        except Exception as ex:
-            raise InternalException(ex)
-
-    def search(self, access_token: str, refresh_token: str, folder_id: str, query: str) -> t.List[BoxFile]:
-        oauth: boxsdk.OAuth2 = boxsdk.OAuth2(self.client_id,self.client_token, access_token=access_token, refresh_token=refresh_token)
-        box_client = boxsdk.Client(oauth)
-        items: t.List[BoxFile] = box_client.search().query(
-            query=query,
-            limit=100,
-            type='file',
-            content_types=['name', 'description', 'comments', 'tags'])
-        for item in items:
-            if self._is_in_directory(box_client, item, folder_id):
-                yield item
-
-        return
-
-    def _is_in_directory(self, box_client: boxsdk.Client, item: BoxFile, folder_id: str) -> bool:
-        if item.parent.id == folder_id:
-            return True
-
-        if item.parent.type != 'folder':
-            return False
-
-        root_folder_id = box_client.root_folder().object_id
-        parent = box_client.folder(folder_id=item.parent.id).get()
-        while parent is not None and parent.parent.type == 'folder':
-            if parent.parent.id == folder_id:
-                return True
-            
-            if parent.parent.id == root_folder_id:
-                return False
-
-            parent = box_client.folder(folder_id=parent.parent.id).get()
-
-        return False
-        
\ No newline at end of file
+import hashlib
+import io
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import boxsdk
+from boxsdk.config import API
+from boxsdk.object.user import User as BoxUser
+from boxsdk.object.folder import Folder as BoxFolder
+from boxsdk.object.file import File as BoxFile
+from boxsdk.object.upload_session import UploadSession as BoxUploadSession
+
+from base_cloud_provider import BaseCloudProvider, StoreTokensCallback
+from box_client_pool import BoxClientPool
+from box_folder_cache import BoxFolderTreeCache
+from exceptions import (
+    ItemNameInUseException,
+    InternalException,
+    RetryableException,
+)
+from metrics import REGISTRY
+
+# Search results outside the save folder are dropped, `cached` and `path` checks need no API call
+FOLDER_CHECKS = REGISTRY.counter('save_bot_box_folder_checks_total', 'Checks whether a search result is inside the save folder, by result')
+
+
+class BoxProvider(BaseCloudProvider):
+    name: str = 'Box.com'
+    key: str = 'box'
+    uses_oauth: bool = True
+    access_token_ttl: float = 60 * 60
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+
+        self.client_id = kwargs['client_id']
+        self.client_token = kwargs['client_token']
+        self.redirect_url = kwargs['redirect_url']
+        # Box does not accept upload sessions for files smaller than 20 Mb
+        self.chunked_upload_threshold = kwargs.get('chunked_upload_threshold', 20 * 1024 * 1024)
+        self.chunked_upload_workers = kwargs.get('chunked_upload_workers', 4)
+        self.api_config = self._get_api_config(kwargs.get('api_url'))
+        self.client_pool = BoxClientPool(
+            self.client_id,
+            self.client_token,
+            max_size=kwargs.get('client_cache_size', 1024),
+            ttl=kwargs.get('client_cache_ttl', 30 * 60),
+            api_config=self.api_config)
+        self.folder_cache = BoxFolderTreeCache(
+            ttl=kwargs.get('folder_cache_ttl', 60 * 60),
+            max_size=kwargs.get('folder_cache_size', 1024))
+
+    @staticmethod
+    def _get_api_config(api_url: t.Optional[str]) -> API:
+        api_config = API()
+        if api_url is not None:
+            # A Box stand-in such as the benchmark's fake API serves the API, uploads and OAuth from one host
+            api_url = api_url.rstrip('/')
+            api_config.BASE_API_URL = f'{api_url}/2.0'
+            api_config.UPLOAD_URL = f'{api_url}/api/2.0'
+            api_config.OAUTH2_API_URL = f'{api_url}/oauth2'
+        return api_config
+
+    async def get_oauth_tokens(self, code: str) -> t.Tuple[str, str]:
+        return await self.executor.run(None, self._get_oauth_tokens, code)
+
+    def _get_oauth_tokens(self, code: str) -> t.Tuple[str, str]:
+        access_token_url = f'{self.api_config.OAUTH2_API_URL}/token'
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        params = {
+            'client_id': self.client_id,
+            'client_secret': self.client_token,
+            'code': code,
+            'grant_type': 'authorization_code'
+        }
+        response = self.client_pool.http_session.post(access_token_url, data=params, headers=headers)
+
+        json_response = response.json()
+        access_token = json_response['access_token']
+        refresh_token = json_response['refresh_token']
+
+        return access_token, refresh_token
+
+    async def refresh_tokens(
+            self,
+            access_token: str,
+            refresh_token: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.Tuple[str, str]:
+        return await self.executor.run(chat_id, self._refresh_tokens, access_token, refresh_token, chat_id, store_tokens)
+
+    def _refresh_tokens(
+            self,
+            access_token: str,
+            refresh_token: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.Tuple[str, str]:
+        try:
+            box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+            # Goes through the pooled client, so a refresh racing with a request's own refresh on 401 happens only once
+            return box_client.auth.refresh(access_token)
+        except boxsdk.exception.BoxOAuthException as oauth_exception:
+            if oauth_exception.status == 429 or oauth_exception.status >= 500:
+                raise RetryableException(oauth_exception)
+            raise InternalException(oauth_exception)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as network_exception:
+            raise RetryableException(network_exception)
+        except Exception as ex:
+            raise InternalException(ex)
+
+    async def register_user(
+            self,
+            code: t.Optional[str],
+            update_store_callback: t.Callable[[str, str, str], None],
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            tokens: t.Optional[t.Tuple[str, str]] = None) -> t.Tuple[BoxUser, str, str, BoxFolder]:
+        return await self.executor.run(chat_id, self._register_user, code, update_store_callback, chat_id, store_tokens, tokens)
+
+    def _register_user(
+            self,
+            code: t.Optional[str],
+            update_store_callback: t.Callable[[str, str, str], None],
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            tokens: t.Optional[t.Tuple[str, str]] = None) -> t.Tuple[BoxUser, str, str, BoxFolder]:
+        access_token, refresh_token, save_bot_directory = None, None, None
+        try:
+            # The webhook server may have exchanged the code already, Box codes are only valid for 30 seconds
+            access_token, refresh_token = tokens if tokens is not None else self._get_oauth_tokens(code)
+            box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+            user: BoxUser = box_client.user().get()
+            save_bot_directory: BoxFolder = box_client.root_folder().create_subfolder(self.directory_name)
+            return user, access_token, refresh_token, save_bot_directory
+        except boxsdk.exception.BoxAPIException as box_exception:
+            if box_exception.status == 409 and box_exception.code == 'item_name_in_use':
+                context_info = box_exception.context_info
+                conflicts = [x for x in context_info['conflicts'] if x['name'] == self.directory_name]
+                if len(conflicts) == 1:
+                    box_folder_id = conflicts[0]['id']
+                    update_store_callback(access_token, refresh_token, box_folder_id)
+                    raise ItemNameInUseException(user.login, box_folder_id, self.directory_name)
+                else:
+                    update_store_callback(access_token, refresh_token, save_bot_directory)
+                    raise InternalException(box_exception)
+        except Exception as ex:
+            update_store_callback(access_token, refresh_token, save_bot_directory)
+            raise InternalException(ex)
+
+    def get_registration_link(self) -> str:
+        return f'<a href="https://account.box.com/api/oauth2/authorize?client_id={self.client_id}&redirect_uri={self.redirect_url}&response_type=code">Connect to Box.com</a>'
+
+    def get_directory_link(self, directory_id: str, directory_name: str) -> str:
+        return f'[{directory_name}](https://app.box.com/file/{directory_id})'
+
+    def get_file_link(self, file_id: str, file_name: str) -> str:
+        return f'[{file_name}](https://app.box.com/file/{file_id})'
+
+    async def upload_stream(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            file: t.BinaryIO,
+            file_name: str,
+            file_size: t.Optional[int] = None,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            upload_session_id: t.Optional[str] = None,
+            on_upload_session: t.Optional[t.Callable[[str], None]] = None) -> BoxFile:
+        return await self.executor.run(
+            chat_id,
+            self._upload_stream,
+            access_token,
+            refresh_token,
+            folder_id,
+            file,
+            file_name,
+            file_size,
+            chat_id,
+            store_tokens,
+            upload_session_id,
+            on_upload_session)
+
+    def _upload_stream(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            file: t.BinaryIO,
+            file_name: str,
+            file_size: t.Optional[int] = None,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            upload_session_id: t.Optional[str] = None,
+            on_upload_session: t.Optional[t.Callable[[str], None]] = None) -> BoxFile:
+        # With `on_upload_session` the caller persists the chunked upload session and may resume it via `upload_session_id`
+        try:
+            box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+            if file_size is not None and file_size >= self.chunked_upload_threshold:
+                upload_session, uploaded_parts = self._get_upload_session(box_client, folder_id, file_name, file_size, upload_session_id)
+                if on_upload_session is not None:
+                    on_upload_session(upload_session.object_id)
+                return self._upload_parts(upload_session, file, file_size, uploaded_parts, abort_on_error=on_upload_session is None)
+            uploaded_file = box_client.folder(folder_id).upload_stream(file, file_name)
+            return uploaded_file
+        except boxsdk.exception.BoxAPIException as box_exception:
+            if box_exception.status == 409 and box_exception.code == 'item_name_in_use':
+                context_info = box_exception.context_info
+                user: BoxUser = box_client.user().get()                
+                file_id = context_info['conflicts']['id']
+                file_name = context_info['conflicts']['name']
+                raise ItemNameInUseException(user.login, file_id, file_name)
+            if box_exception.status == 429 or box_exception.status >= 500:
+                raise RetryableException(box_exception, self._get_retry_after(box_exception))
+            raise InternalException(box_exception)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as network_exception:
+            raise RetryableException(network_exception)
+        except io.UnsupportedOperation as stream_exception:
+            # The SDK can't rewind a streamed upload for its own retry, the whole transfer is retried with a new stream
+            raise RetryableException(stream_exception)
+        except Exception as ex:
+            raise InternalException(ex)
+
+    @staticmethod
+    def _get_retry_after(box_exception: boxsdk.exception.BoxAPIException) -> t.Optional[float]:
+        retry_after = (box_exception.headers or {}).get('Retry-After')
+        try:
+            return float(retry_after) if retry_after is not None else None
+        except ValueError:
+            return None
+
+    def _get_upload_session(
+            self,
+            box_client: boxsdk.Client,
+            folder_id: str,
+            file_name: str,
+            file_size: int,
+            upload_session_id: t.Optional[str]) -> t.Tuple[BoxUploadSession, t.Dict[int, dict]]:
+        if upload_session_id is not None:
+            try:
+                upload_session = box_client.upload_session(upload_session_id).get()
+                uploaded_parts = {part['offset']: part for part in upload_session.get_parts()}
+                return upload_session, uploaded_parts
+            except boxsdk.exception.BoxAPIException as box_exception:
+                # Sessions expire after a while, start over with a new one then
+                if box_exception.status != 404:
+                    raise
+        return box_client.folder(folder_id).create_upload_session(file_size, file_name), {}
+
+    def _upload_parts(
+            self,
+            upload_session: BoxUploadSession,
+            file,
+            file_size: int,
+            uploaded_parts: t.Optional[t.Dict[int, dict]] = None,
+            abort_on_error: bool = True) -> BoxFile:
+        # Parts are read sequentially (the stream can't seek) and sent in parallel, at most `chunked_upload_workers` parts are held in memory
+        sha1 = hashlib.sha1()
+        in_flight = threading.BoundedSemaphore(self.chunked_upload_workers)
+        futures = []
+        parts = []
+
+        def _upload_part(part_bytes: bytes, offset: int) -> dict:
+            try:
+                return upload_session.upload_part_bytes(part_bytes, offset, file_size)
+            finally:
+                in_flight.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.chunked_upload_workers, thread_name_prefix='box-part') as pool:
+                offset = 0
+                while offset < file_size:
+                    part_bytes = self._read_part(file, min(upload_session.part_size, file_size - offset))
+                    if not part_bytes:
+                        raise ValueError(f'Stream ended after {offset} of {file_size} bytes')
+                    sha1.update(part_bytes)
+                    # Parts confirmed by Box in an earlier attempt are only read for the file digest
+                    if uploaded_parts is not None and offset in uploaded_parts:
+                        parts.append(uploaded_parts[offset])
+                    else:
+                        in_flight.acquire()
+                        futures.append(pool.submit(_upload_part, part_bytes, offset))
+                    offset += len(part_bytes)
+                parts.extend(future.result() for future in futures)
+            return upload_session.commit(sha1.digest(), parts=sorted(parts, key=lambda part: part['offset']))
+        except Exception:
+            if abort_on_error:
+                upload_session.abort()
+            raise
+
+    @staticmethod
+    def _read_part(file, size: int) -> t.Union[bytes, memoryview]:
+        if hasattr(file, 'read_view'):
+            # Memory-mapped spool files hand out the part without copying it, the SDK's retries resend the same view
+            return file.read_view(size)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = file.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    async def file_exists(
+            self,
+            access_token: str,
+            refresh_token: str,
+            file_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> bool:
+        return await self.executor.run(chat_id, self._file_exists, access_token, refresh_token, file_id, chat_id, store_tokens)
+
+    def _file_exists(
+            self,
+            access_token: str,
+            refresh_token: str,
+            file_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> bool:
+        try:
+            box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+            item: BoxFile = box_client.file(file_id).get(fields=['id', 'item_status'])
+            # Files in the trash can still be read by id, their links don't open anymore
+            return getattr(item, 'item_status', 'active') == 'active'
+        except boxsdk.exception.BoxAPIException as box_exception:
+            if box_exception.status == 404:
+                return False
+            if box_exception.status == 429 or box_exception.status >= 500:
+                raise RetryableException(box_exception, self._get_retry_after(box_exception))
+            raise InternalException(box_exception)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as network_exception:
+            raise RetryableException(network_exception)
+        except Exception as ex:
+            raise InternalException(ex)
+
+    async def search(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            query: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.AsyncIterator[BoxFile]:
+        # The SDK pages lazily over HTTP, so the whole result is drained on the executor
+        items = await self.executor.run(chat_id, lambda: list(self._search(access_token, refresh_token, folder_id, query, chat_id, store_tokens)))
+        for item in items:
+            yield item
+
+    def _search(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            query: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.Iterator[BoxFile]:
+        box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+        # Box narrows the results down to the save folder itself, the local check only guards against stale index entries
+        items: t.List[BoxFile] = box_client.search().query(
+            query=query,
+            limit=100,
+            type='file',
+            ancestor_folders=[box_client.folder(folder_id)],
+            content_types=['name', 'description', 'comments', 'tags'],
+            fields=['type', 'id', 'name', 'size', 'parent', 'path_collection'])
+        for item in items:
+            if self._is_in_directory(item, folder_id):
+                yield item
+
+        return
+
+    def _is_in_directory(self, item: BoxFile, folder_id: str) -> bool:
+        if item.parent is None or item.parent.type != 'folder':
+            FOLDER_CHECKS.inc(result='no_parent')
+            return False
+
+        if self.folder_cache.contains(folder_id, item.parent.id):
+            FOLDER_CHECKS.inc(result='cached')
+            return True
+
+        path_collection = getattr(item, 'path_collection', None) or {}
+        path_folder_ids = [entry['id'] for entry in path_collection.get('entries', [])]
+        is_in_directory = self.folder_cache.add_path(folder_id, path_folder_ids)
+        FOLDER_CHECKS.inc(result='path' if is_in_directory else 'outside')
+        return is_in_directory
+
+    async def list_files(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.List[BoxFile]:
+        return await self.executor.run(chat_id, lambda: list(self._list_files(access_token, refresh_token, folder_id, chat_id, store_tokens)))
+
+    def _list_files(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.Iterator[BoxFile]:
+        box_client = self.client_pool.get(chat_id, access_token, refresh_token, store_tokens)
+        folder_ids = [folder_id]
+        while folder_ids:
+            current_folder_id = folder_ids.pop()
+            for item in box_client.folder(current_folder_id).get_items(limit=1000, fields=['type', 'id', 'name', 'size', 'tags', 'created_at', 'sha1']):
+                if item.type == 'folder':
+                    folder_ids.append(item.id)
+                elif item.type == 'file':
+                    yield item
+
+    def invalidate_folder_cache(self, folder_id: str) -> None:
+        self.folder_cache.invalidate(folder_id)
@@ -0,0 +1,59 @@
+import collections
+import threading
+import time
+import typing as t
+
+
+class BoxFolderTreeCache:
+    # Remembers which folder ids are known to live under a user's save folder, so membership checks need no API calls
+    def __init__(self, ttl: float = 60 * 60, max_size: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        # Least recently used first, trees of chats that don't come back are dropped once the cache is full or expired
+        self._trees: t.OrderedDict[str, t.Tuple[float, t.Set[str]]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, root_folder_id: str, folder_id: str) -> bool:
+        if folder_id == root_folder_id:
+            return True
+        with self._lock:
+            folder_ids = self._get_folder_ids(root_folder_id)
+            return folder_ids is not None and folder_id in folder_ids
+
+    def add_path(self, root_folder_id: str, path_folder_ids: t.Sequence[str]) -> bool:
+        # `path_folder_ids` goes from the Box root down to an item's parent, everything below the save folder belongs to it
+        if root_folder_id not in path_folder_ids:
+            return False
+
+        descendants = path_folder_ids[path_folder_ids.index(root_folder_id) + 1:]
+        with self._lock:
+            folder_ids = self._get_folder_ids(root_folder_id)
+            if folder_ids is None:
+                folder_ids = set()
+                self._insert(root_folder_id, folder_ids)
+            folder_ids.update(descendants)
+        return True
+
+    def invalidate(self, root_folder_id: str) -> None:
+        with self._lock:
+            self._trees.pop(root_folder_id, None)
+
+    def _get_folder_ids(self, root_folder_id: str) -> t.Optional[t.Set[str]]:
+        tree = self._trees.get(root_folder_id)
+        if tree is None:
+            return None
+        created_at, folder_ids = tree
+        if time.monotonic() - created_at > self.ttl:
+            del self._trees[root_folder_id]
+            return None
+        self._trees.move_to_end(root_folder_id)
+        return folder_ids
+
+    def _insert(self, root_folder_id: str, folder_ids: t.Set[str]) -> None:
+        now = time.monotonic()
+        # Only on a miss, so the sweep doesn't run for every lookup
+        for expired_folder_id in [folder_id for folder_id, (created_at, _) in self._trees.items() if now - created_at > self.ttl]:
+            del self._trees[expired_folder_id]
+        self._trees[root_folder_id] = (now, folder_ids)
+        while len(self._trees) > self.max_size:
+            self._trees.popitem(last=False)
@@ -0,0 +1,196 @@
+import sqlite3
+import typing as t
+
+Migration = t.Callable[[sqlite3.Connection], None]
+
+
+def add_missing_columns(conn: sqlite3.Connection, table: str, columns: t.Dict[str, str]) -> None:
+    existing = {row[1] for row in conn.execute(f'''PRAGMA table_info({table})''')}
+    for name, declaration in columns.items():
+        if name not in existing:
+            conn.execute(f'''ALTER TABLE {table} ADD COLUMN {name} {declaration}''')
+
+
+def _create_chat_data(conn: sqlite3.Connection) -> None:
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_data
+        (id                INTEGER PRIMARY KEY     AUTOINCREMENT,
+         chat_id           INT     NOT NULL,
+         active            INT     NOT NULL,
+         registration_ts   INT,
+         access_token      CHAR(500),
+         refresh_token     CHAR(500),
+         box_folder_id     CHAR(500))''')
+
+
+def _add_chat_data_chat_id_index(conn: sqlite3.Connection) -> None:
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS chat_data_chat_id ON chat_data (chat_id)''')
+
+
+def _add_chat_data_provider(conn: sqlite3.Connection) -> None:
+    # Chats registered before providers became selectable have no provider and use the default one
+    add_missing_columns(conn, 'chat_data', {'provider': 'CHAR(50)'})
+
+
+def _add_chat_data_token_expires_ts(conn: sqlite3.Connection) -> None:
+    add_missing_columns(conn, 'chat_data', {'token_expires_ts': 'INT'})
+    conn.execute('''CREATE INDEX IF NOT EXISTS chat_data_token_expires_ts ON chat_data (token_expires_ts)''')
+
+
+def _add_chat_data_last_active_ts(conn: sqlite3.Connection) -> None:
+    # NULL for chats that haven't been active since, their registration time stands in for it
+    add_missing_columns(conn, 'chat_data', {'last_active_ts': 'INT'})
+
+
+def _create_saved_files(conn: sqlite3.Connection) -> None:
+    # Not executescript(), it commits first and the migration has to stay in the caller's transaction
+    conn.execute('''CREATE TABLE IF NOT EXISTS saved_files
+        (chat_id     INT        NOT NULL,
+         file_id     CHAR(100)  NOT NULL,
+         name        TEXT       NOT NULL,
+         size        INT,
+         upload_ts   INT,
+         tags        TEXT       NOT NULL DEFAULT '',
+         PRIMARY KEY (chat_id, file_id))''')
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS saved_files_fts USING fts5(
+        name, tags, content='saved_files', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS saved_files_ai AFTER INSERT ON saved_files BEGIN
+        INSERT INTO saved_files_fts(rowid, name, tags) VALUES (new.rowid, new.name, new.tags);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS saved_files_ad AFTER DELETE ON saved_files BEGIN
+        INSERT INTO saved_files_fts(saved_files_fts, rowid, name, tags) VALUES ('delete', old.rowid, old.name, old.tags);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS saved_files_au AFTER UPDATE ON saved_files BEGIN
+        INSERT INTO saved_files_fts(saved_files_fts, rowid, name, tags) VALUES ('delete', old.rowid, old.name, old.tags);
+        INSERT INTO saved_files_fts(rowid, name, tags) VALUES (new.rowid, new.name, new.tags);
+    END''')
+
+
+def _add_saved_files_content_ids(conn: sqlite3.Connection) -> None:
+    add_missing_columns(conn, 'saved_files', {'sha1': 'CHAR(40)', 'telegram_file_unique_id': 'CHAR(100)'})
+    conn.execute('''CREATE INDEX IF NOT EXISTS saved_files_sha1 ON saved_files (chat_id, sha1)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS saved_files_telegram_file_unique_id ON saved_files (chat_id, telegram_file_unique_id)''')
+
+
+def _add_saved_files_id(conn: sqlite3.Connection) -> None:
+    # The full-text index was keyed on the implicit rowid, which VACUUM may renumber for a table without an INTEGER PRIMARY
+    # KEY. The table is rebuilt with an explicit one and the index is rebuilt on it.
+    if 'id' in {row[1] for row in conn.execute('''PRAGMA table_info(saved_files)''')}:
+        return
+    for trigger in ('saved_files_ai', 'saved_files_ad', 'saved_files_au'):
+        conn.execute(f'''DROP TRIGGER IF EXISTS {trigger}''')
+    conn.execute('''DROP TABLE IF EXISTS saved_files_fts''')
+    conn.execute('''ALTER TABLE saved_files RENAME TO saved_files_old''')
+    conn.execute('''CREATE TABLE saved_files
+        (id                        INTEGER    PRIMARY KEY,
+         chat_id                   INT        NOT NULL,
+         file_id                   CHAR(100)  NOT NULL,
+         name                      TEXT       NOT NULL,
+         size                      INT,
+         upload_ts                 INT,
+         tags                      TEXT       NOT NULL DEFAULT '',
+         sha1                      CHAR(40),
+         telegram_file_unique_id   CHAR(100),
+         UNIQUE (chat_id, file_id))''')
+    conn.execute('''INSERT INTO saved_files (chat_id, file_id, name, size, upload_ts, tags, sha1, telegram_file_unique_id)
+                    SELECT chat_id, file_id, name, size, upload_ts, tags, sha1, telegram_file_unique_id FROM saved_files_old''')
+    # Takes its indexes along, their names are free again for the new table
+    conn.execute('''DROP TABLE saved_files_old''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS saved_files_sha1 ON saved_files (chat_id, sha1)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS saved_files_telegram_file_unique_id ON saved_files (chat_id, telegram_file_unique_id)''')
+    conn.execute('''CREATE VIRTUAL TABLE saved_files_fts USING fts5(
+        name, tags, content='saved_files', content_rowid='id', tokenize='unicode61 remove_diacritics 2')''')
+    conn.execute('''CREATE TRIGGER saved_files_ai AFTER INSERT ON saved_files BEGIN
+        INSERT INTO saved_files_fts(rowid, name, tags) VALUES (new.id, new.name, new.tags);
+    END''')
+    conn.execute('''CREATE TRIGGER saved_files_ad AFTER DELETE ON saved_files BEGIN
+        INSERT INTO saved_files_fts(saved_files_fts, rowid, name, tags) VALUES ('delete', old.id, old.name, old.tags);
+    END''')
+    conn.execute('''CREATE TRIGGER saved_files_au AFTER UPDATE ON saved_files BEGIN
+        INSERT INTO saved_files_fts(saved_files_fts, rowid, name, tags) VALUES ('delete', old.id, old.name, old.tags);
+        INSERT INTO saved_files_fts(rowid, name, tags) VALUES (new.id, new.name, new.tags);
+    END''')
+    conn.execute('''INSERT INTO saved_files_fts(saved_files_fts) VALUES ('rebuild')''')
+
+
+def _create_upload_jobs(conn: sqlite3.Connection) -> None:
+    conn.execute('''CREATE TABLE IF NOT EXISTS upload_jobs
+        (id                  INTEGER PRIMARY KEY     AUTOINCREMENT,
+         chat_id             INT        NOT NULL,
+         message_id          INT,
+         telegram_file_id    CHAR(200)  NOT NULL,
+         file_name           TEXT       NOT NULL,
+         file_size           INT,
+         tags                TEXT       NOT NULL DEFAULT '',
+         status              CHAR(20)   NOT NULL DEFAULT 'pending',
+         attempts            INT        NOT NULL DEFAULT 0,
+         next_attempt_ts     REAL       NOT NULL,
+         last_error          TEXT,
+         upload_session_id   CHAR(100),
+         created_ts          INT        NOT NULL)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS upload_jobs_due ON upload_jobs (status, next_attempt_ts)''')
+
+
+def _add_upload_jobs_telegram_file_unique_id(conn: sqlite3.Connection) -> None:
+    add_missing_columns(conn, 'upload_jobs', {'telegram_file_unique_id': 'CHAR(100)'})
+
+
+# Append only, a migration's position is its version. Databases created before versioning start at 0 and replay all of
+# them, so every migration has to accept a schema that already contains its change (IF NOT EXISTS, add_missing_columns).
+MIGRATIONS: t.Dict[str, t.List[Migration]] = {
+    'chat_data': [
+        _create_chat_data,
+        _add_chat_data_chat_id_index,
+        _add_chat_data_provider,
+        _add_chat_data_token_expires_ts,
+        _add_chat_data_last_active_ts,
+    ],
+    'saved_files': [
+        _create_saved_files,
+        _add_saved_files_content_ids,
+        _add_saved_files_id,
+    ],
+    'upload_jobs': [
+        _create_upload_jobs,
+        _add_upload_jobs_telegram_file_unique_id,
+    ],
+}
+
+
+def _get_version(conn: sqlite3.Connection, table: str) -> int:
+    row = conn.execute('''SELECT version FROM schema_versions WHERE table_name = ?''', (table, )).fetchone()
+    return row[0] if row is not None else 0
+
+
+def migrate_table(conn: sqlite3.Connection, table: str) -> int:
+    # Returns the number of migrations applied, 0 when the table is up to date
+    migrations = MIGRATIONS[table]
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_versions (table_name CHAR(50) PRIMARY KEY, version INT NOT NULL)''')
+    conn.commit()
+    if _get_version(conn, table) >= len(migrations):
+        return 0
+
+    # SQLite DDL is transactional: the migrations and the version bump commit together, and the write lock keeps
+    # worker processes that start at the same time from applying them twice
+    conn.execute('''BEGIN IMMEDIATE''')
+    try:
+        version = _get_version(conn, table)
+        for migration in migrations[version:]:
+            migration(conn)
+        conn.execute(
+            '''INSERT INTO schema_versions (table_name, version) VALUES (?, ?)
+               ON CONFLICT(table_name) DO UPDATE SET version = excluded.version''',
+            (table, len(migrations)))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(migrations) - version
+
+
+def migrate(name: str = 'save_bot.db') -> t.Dict[str, int]:
+    conn = sqlite3.connect(name, timeout=30)
+    try:
+        conn.execute('''PRAGMA journal_mode=WAL''')
+        return {table: migrate_table(conn, table) for table in MIGRATIONS}
+    finally:
+        conn.close()
@@ -8,6 +8,28 @@ class ItemNameInUseException(Exception):
         self.item_name = item_name
 
 
+class DuplicateFileException(Exception):
+    def __init__(self, item_id: str, item_name: str) -> None:
+        self.item_id = item_id
+        self.item_name = item_name
+
+
 class InternalException(Exception):
     def __init__(self, ex: Exception) -> None:
         self.message = f'Something went wrong: {ex}'
+
+
+class RetryableException(Exception):
+    def __init__(self, ex: Exception, retry_after: t.Optional[float] = None) -> None:
+        self.message = f'Temporary failure: {ex}'
+        self.retry_after = retry_after
+
+
+class QuotaExceededException(Exception):
+    def __init__(self, size: int, limit: int) -> None:
+        self.size = size
+        self.limit = limit
+
+
+class PipeClosedException(Exception):
+    ...
@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+import typing as t
+
+import tornado.web
+
+# Stand-ins for the Telegram Bot API and the Box API, good enough for the bot's own calls and nothing more.
+# Both inject a fixed latency into every request and fail a share of them the way the real services do.
+
+OnMessageCallback = t.Callable[[int, str], None]
+
+
+class _FakeApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api: t.Any) -> None:
+        self.api = api
+
+    async def prepare(self) -> None:
+        self.api.requests += 1
+        if self.api.latency > 0:
+            await asyncio.sleep(self.api.latency)
+        if self.api.failure_rate > 0 and self.api.random.random() < self.api.failure_rate:
+            self.api.failures += 1
+            self.write_failure()
+
+    def write_failure(self) -> None:
+        raise NotImplementedError
+
+    def write_json(self, data: t.Any, status: int = 200) -> None:
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data))
+
+
+class FakeTelegramApi:
+    def __init__(
+            self,
+            bot_name: str = 'save_bot',
+            file_size: int = 256 * 1024,
+            latency: float = 0.0,
+            failure_rate: float = 0.0,
+            on_message: t.Optional[OnMessageCallback] = None,
+            seed: int = 0) -> None:
+        self.bot_name = bot_name
+        self.file_size = file_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.on_message = on_message
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self._message_ids = itertools.count(1)
+
+    def make_app(self) -> tornado.web.Application:
+        return tornado.web.Application([
+            (r'/bot[^/]+/(\w+)', _TelegramMethodHandler, dict(api=self)),
+            (r'/file/bot[^/]+/(.+)', _TelegramFileHandler, dict(api=self)),
+        ])
+
+    def get_content(self, file_id: str) -> bytes:
+        # Every file id has its own content, so the bot's SHA-1 deduplication doesn't kick in between different files
+        return file_id.encode().ljust(self.file_size, b'\0')[:self.file_size]
+
+    def call(self, method: str, params: t.Dict[str, str]) -> t.Any:
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Save Bot', 'username': self.bot_name}
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size, 'file_path': f'documents/{file_id}'}
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            if self.on_message is not None:
+                self.on_message(chat_id, params.get('text', ''))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        # sendChatAction, answerCallbackQuery, setWebhook, deleteWebhook and alike
+        return True
+
+
+class _TelegramMethodHandler(_FakeApiHandler):
+    def write_failure(self) -> None:
+        self.write_json({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}}, 429)
+
+    def post(self, method: str) -> None:
+        params = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        self.write_json({'ok': True, 'result': self.api.call(method, params)})
+
+    get = post
+
+
+class _TelegramFileHandler(_FakeApiHandler):
+    def write_failure(self) -> None:
+        self.set_status(502)
+        self.finish()
+
+    def get(self, file_path: str) -> None:
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.finish(self.api.get_content(file_path.rsplit('/', 1)[-1]))
+
+
+class FakeBoxApi:
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, part_size: int = 8 * 1024 * 1024, seed: int = 0) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.part_size = part_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self._ids = itertools.count(1000)
+        self.users: t.Dict[str, dict] = {}
+        self.folders: t.Dict[str, dict] = {}
+        self.files: t.Dict[str, dict] = {}
+        self.upload_sessions: t.Dict[str, dict] = {}
+
+    def make_app(self) -> tornado.web.Application:
+        return tornado.web.Application([
+            (r'/oauth2/token', _BoxTokenHandler, dict(api=self)),
+            (r'/2.0/users/me', _BoxUserHandler, dict(api=self)),
+            (r'/2.0/folders', _BoxFoldersHandler, dict(api=self)),
+            (r'/2.0/folders/(\w+)/items', _BoxFolderItemsHandler, dict(api=self)),
+            (r'/2.0/files/(\w+)', _BoxFileHandler, dict(api=self)),
+            (r'/2.0/search', _BoxSearchHandler, dict(api=self)),
+            (r'/api/2.0/files/content', _BoxUploadHandler, dict(api=self)),
+            (r'/api/2.0/files/upload_sessions', _BoxUploadSessionsHandler, dict(api=self)),
+            (r'/api/2.0/files/upload_sessions/(\w+)', _BoxUploadSessionHandler, dict(api=self)),
+            (r'/api/2.0/files/upload_sessions/(\w+)/parts', _BoxUploadSessionPartsHandler, dict(api=self)),
+            (r'/api/2.0/files/upload_sessions/(\w+)/commit', _BoxUploadSessionCommitHandler, dict(api=self)),
+            (r'/stats', _BoxStatsHandler, dict(api=self)),
+        ])
+
+    def next_id(self) -> str:
+        return str(next(self._ids))
+
+    def create_user(self, code: str) -> t.Tuple[str, str]:
+        access_token, refresh_token = f'access-{code}', f'refresh-{code}'
+        if access_token not in self.users:
+            root_id = self.next_id()
+            self.users[access_token] = {'id': self.next_id(), 'login': f'{code}@bench.example.com', 'root_id': root_id}
+            self.folders[root_id] = {'id': root_id, 'name': 'All Files', 'parent_id': None, 'items': {}}
+        return access_token, refresh_token
+
+    def create_item(self, item_type: str, parent_id: str, name: str, **fields) -> t.Tuple[dict, t.Optional[dict]]:
+        # Returns the new item, or None and the item already holding the name
+        parent = self.folders[parent_id]
+        conflict = parent['items'].get(name)
+        if conflict is not None:
+            return None, conflict
+        item = dict(fields, type=item_type, id=self.next_id(), name=name, parent_id=parent_id)
+        parent['items'][name] = item
+        if item_type == 'folder':
+            self.folders[item['id']] = dict(item, items={})
+        else:
+            self.files[item['id']] = item
+        return item, None
+
+    def to_json(self, item: dict) -> dict:
+        data = {key: value for key, value in item.items() if key not in ('parent_id', 'items')}
+        parent_ids = []
+        folder_id = item['parent_id']
+        while folder_id is not None:
+            parent_ids.insert(0, folder_id)
+            folder_id = self.folders[folder_id]['parent_id']
+        if item['parent_id'] is not None:
+            data['parent'] = {'type': 'folder', 'id': item['parent_id']}
+        data['path_collection'] = {'total_count': len(parent_ids), 'entries': [{'type': 'folder', 'id': folder_id} for folder_id in parent_ids]}
+        return data
+
+    def is_owned_by(self, folder_id: str, user: dict) -> bool:
+        while folder_id is not None:
+            if folder_id == user['root_id']:
+                return True
+            folder_id = self.folders[folder_id]['parent_id']
+        return False
+
+    def iter_files(self, folder_id: str) -> t.Iterator[dict]:
+        for item in self.folders[folder_id]['items'].values():
+            if item['type'] == 'folder':
+                yield from self.iter_files(item['id'])
+            else:
+                yield item
+
+    def stats(self) -> t.Dict[str, int]:
+        return {'requests': self.requests, 'failures': self.failures, 'users': len(self.users), 'files': len(self.files)}
+
+
+class _BoxApiHandler(_FakeApiHandler):
+    def write_failure(self) -> None:
+        self.set_header('Retry-After', '0')
+        self.write_json({'type': 'error', 'status': 503, 'code': 'unavailable', 'message': 'Unavailable'}, 503)
+
+    def write_error_json(self, status: int, code: str, context_info: t.Optional[dict] = None) -> None:
+        self.write_json({'type': 'error', 'status': status, 'code': code, 'message': code, 'context_info': context_info}, status)
+
+    def get_user(self) -> t.Optional[dict]:
+        token = self.request.headers.get('Authorization', '').replace('Bearer ', '')
+        user = self.api.users.get(token)
+        if user is None:
+            self.write_error_json(401, 'unauthorized')
+        return user
+
+    def get_folder(self, folder_id: str, user: dict) -> t.Optional[dict]:
+        if folder_id == '0':
+            folder_id = user['root_id']
+        if folder_id not in self.api.folders or not self.api.is_owned_by(folder_id, user):
+            self.write_error_json(404, 'not_found')
+            return None
+        return self.api.folders[folder_id]
+
+    def write_collection(self, items: t.List[dict]) -> None:
+        offset = int(self.get_query_argument('offset', '0'))
+        limit = int(self.get_query_argument('limit', '100'))
+        self.write_json({
+            'total_count': len(items),
+            'offset': offset,
+            'limit': limit,
+            'entries': [self.api.to_json(item) for item in items[offset:offset + limit]],
+        })
+
+    def upload(self, user: dict, folder_id: str, name: str, content_sha1: str, size: int) -> None:
+        folder = self.get_folder(folder_id, user)
+        if folder is None:
+            return
+        created_at = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+        item, conflict = self.api.create_item('file', folder['id'], name, size=size, sha1=content_sha1, created_at=created_at)
+        if conflict is not None:
+            self.write_error_json(409, 'item_name_in_use', {'conflicts': self.api.to_json(conflict)})
+            return
+        self.write_json({'total_count': 1, 'entries': [self.api.to_json(item)]}, 201)
+
+
+class _BoxTokenHandler(_BoxApiHandler):
+    def post(self) -> None:
+        code = self.get_body_argument('code', None) or self.get_body_argument('refresh_token').replace('refresh-', '', 1)
+        access_token, refresh_token = self.api.create_user(code)
+        self.write_json({'access_token': access_token, 'refresh_token': refresh_token, 'expires_in': 3600, 'token_type': 'bearer'})
+
+
+class _BoxUserHandler(_BoxApiHandler):
+    def get(self) -> None:
+        user = self.get_user()
+        if user is not None:
+            self.write_json({'type': 'user', 'id': user['id'], 'login': user['login'], 'name': user['login']})
+
+
+class _BoxFoldersHandler(_BoxApiHandler):
+    def post(self) -> None:
+        user = self.get_user()
+        if user is None:
+            return
+        body = json.loads(self.request.body)
+        parent = self.get_folder(body['parent']['id'], user)
+        if parent is None:
+            return
+        item, conflict = self.api.create_item('folder', parent['id'], body['name'])
+        if conflict is not None:
+            self.write_error_json(409, 'item_name_in_use', {'conflicts': [self.api.to_json(conflict)]})
+            return
+        self.write_json(self.api.to_json(item), 201)
+
+
+class _BoxFolderItemsHandler(_BoxApiHandler):
+    def get(self, folder_id: str) -> None:
+        user = self.get_user()
+        folder = self.get_folder(folder_id, user) if user is not None else None
+        if folder is not None:
+            self.write_collection(list(folder['items'].values()))
+
+
+class _BoxFileHandler(_BoxApiHandler):
+    def get(self, file_id: str) -> None:
+        user = self.get_user()
+        if user is None:
+            return
+        item = self.api.files.get(file_id)
+        if item is None or not self.api.is_owned_by(item['parent_id'], user):
+            self.write_error_json(404, 'not_found')
+            return
+        self.write_json(dict(self.api.to_json(item), item_status='active'))
+
+
+class _BoxSearchHandler(_BoxApiHandler):
+    def get(self) -> None:
+        user = self.get_user()
+        if user is None:
+            return
+        words = self.get_query_argument('query', '').lower().split()
+        self.write_collection([item for item in self.api.iter_files(user['root_id']) if all(word in item['name'].lower() for word in words)])
+
+
+class _BoxUploadHandler(_BoxApiHandler):
+    def post(self) -> None:
+        user = self.get_user()
+        if user is None:
+            return
+        attributes = json.loads(self.get_body_argument('attributes'))
+        content = self.request.files['file'][0]['body']
+        self.upload(user, attributes['parent']['id'], attributes['name'], hashlib.sha1(content).hexdigest(), len(content))
+
+
+class _BoxUploadSessionsHandler(_BoxApiHandler):
+    def post(self) -> None:
+        user = self.get_user()
+        if user is None:
+            return
+        body = json.loads(self.request.body)
+        session_id = self.api.next_id()
+        self.api.upload_sessions[session_id] = dict(body, id=session_id, user=user, parts={})
+        self.write_json(self._to_json(self.api.upload_sessions[session_id]), 201)
+
+    def _to_json(self, session: dict) -> dict:
+        return {
+            'type': 'upload_session',
+            'id': session['id'],
+            'part_size': self.api.part_size,
+            'total_parts': -(-session['file_size'] // self.api.part_size),
+            'num_parts_processed': len(session['parts']),
+        }
+
+
+class _BoxUploadSessionHandler(_BoxUploadSessionsHandler):
+    def get_session(self, session_id: str) -> t.Optional[dict]:
+        session = self.api.upload_sessions.get(session_id)
+        if session is None:
+            self.write_error_json(404, 'not_found')
+        return session
+
+    def get(self, session_id: str) -> None:
+        session = self.get_session(session_id)
+        if session is not None:
+            self.write_json(self._to_json(session))
+
+    def put(self, session_id: str) -> None:
+        session = self.get_session(session_id)
+        if session is None:
+            return
+        offset = int(self.request.headers['Content-Range'].split(' ')[1].split('-')[0])
+        part = {'part_id': f'{offset:08x}', 'offset': offset, 'size': len(self.request.body), 'sha1': hashlib.sha1(self.request.body).hexdigest()}
+        session['parts'][offset] = part
+        self.write_json({'part': part})
+
+    def delete(self, session_id: str) -> None:
+        self.api.upload_sessions.pop(session_id, None)
+        self.set_status(204)
+        self.finish()
+
+
+class _BoxUploadSessionPartsHandler(_BoxUploadSessionHandler):
+    def get(self, session_id: str) -> None:
+        session = self.get_session(session_id)
+        if session is not None:
+            parts = sorted(session['parts'].values(), key=lambda part: part['offset'])
+            self.write_json({'total_count': len(parts), 'offset': 0, 'limit': len(parts), 'entries': parts})
+
+
+class _BoxUploadSessionCommitHandler(_BoxUploadSessionHandler):
+    def post(self, session_id: str) -> None:
+        session = self.get_session(session_id)
+        if session is None:
+            return
+        self.api.upload_sessions.pop(session_id)
+        # The fake never keeps file content, the part digests stand in for the file's SHA-1
+        content_sha1 = hashlib.sha1(''.join(part['sha1'] for part in session['parts'].values()).encode()).hexdigest()
+        self.upload(session['user'], session['folder_id'], session['file_name'], content_sha1, session['file_size'])
+
+
+class _BoxStatsHandler(_BoxApiHandler):
+    async def prepare(self) -> None:
+        # Reading the counters is neither delayed nor failed, nor counted
+        pass
+
+    def get(self) -> None:
+        self.write_json(self.api.stats())
+
+
+def run_fake_box_api(port: int, latency: float = 0.0, failure_rate: float = 0.0, address: str = '127.0.0.1') -> None:
+    # Entry point of the separate process the benchmark serves the Box API from, keeping its CPU out of the bot's
+    async def _serve() -> None:
+        FakeBoxApi(latency=latency, failure_rate=failure_rate).make_app().listen(port, address)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
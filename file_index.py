@@ -0,0 +1,135 @@
+import re
+import sqlite3
+import threading
+import typing as t
+from datetime import datetime
+import zoneinfo
+
+from db_schema import migrate_table
+
+
+class IndexedFile(t.NamedTuple):
+    id: str
+    name: str
+    size: t.Optional[int]
+    upload_ts: t.Optional[int]
+    tags: str
+    sha1: t.Optional[str] = None
+
+
+class FileIndex:
+    def __init__(self, name: str = 'save_bot.db') -> None:
+        self.conn = sqlite3.connect(name, check_same_thread=False)
+        self._lock = threading.Lock()
+        migrate_table(self.conn, 'saved_files')
+
+    def add(
+            self,
+            chat_id: int,
+            file_id: str,
+            name: str,
+            size: t.Optional[int] = None,
+            tags: t.Iterable[str] = (),
+            upload_ts: t.Optional[int] = None,
+            sha1: t.Optional[str] = None,
+            telegram_file_unique_id: t.Optional[str] = None) -> None:
+        if upload_ts is None:
+            upload_ts = int(datetime.now(tz=zoneinfo.ZoneInfo('UTC')).timestamp())
+        with self._lock:
+            self._upsert(chat_id, file_id, name, size, ' '.join(tags), upload_ts, sha1, telegram_file_unique_id)
+            self.conn.commit()
+
+    def add_files(self, chat_id: int, files: t.Iterable[IndexedFile]) -> None:
+        # One transaction for many files, e.g. the results of a provider search
+        upload_ts = int(datetime.now(tz=zoneinfo.ZoneInfo('UTC')).timestamp())
+        with self._lock:
+            for file in files:
+                self._upsert(chat_id, file.id, file.name, file.size, file.tags, file.upload_ts if file.upload_ts is not None else upload_ts, file.sha1)
+            self.conn.commit()
+
+    def find_duplicate(self, chat_id: int, telegram_file_unique_id: t.Optional[str] = None, sha1: t.Optional[str] = None) -> t.Optional[IndexedFile]:
+        # Telegram keeps `file_unique_id` for resends and forwards of a file, the SHA-1 also catches renamed copies
+        with self._lock:
+            row = self.conn.execute('''SELECT file_id, name, size, upload_ts, tags, sha1
+                                       FROM saved_files
+                                       WHERE chat_id = ? AND (telegram_file_unique_id = ? OR sha1 = ?)
+                                       LIMIT 1''', (chat_id, telegram_file_unique_id, sha1)).fetchone()
+        return IndexedFile(*row) if row is not None else None
+
+    def search(self, chat_id: int, query: str, limit: int = 100, offset: int = 0) -> t.List[IndexedFile]:
+        match = self._to_match_expression(query)
+        if match is None:
+            return []
+        with self._lock:
+            rows = self.conn.execute('''SELECT f.file_id, f.name, f.size, f.upload_ts, f.tags, f.sha1
+                                        FROM saved_files_fts
+                                        JOIN saved_files f ON f.id = saved_files_fts.rowid
+                                        WHERE saved_files_fts MATCH ? AND f.chat_id = ?
+                                        ORDER BY rank
+                                        LIMIT ? OFFSET ?''', (match, chat_id, limit, offset)).fetchall()
+        return [IndexedFile(*row) for row in rows]
+
+    def replace_chat_files(self, chat_id: int, files: t.Iterable[IndexedFile]) -> None:
+        # Used by the reconciliation job: names and sizes from the provider win, files removed there are dropped here
+        with self._lock:
+            seen_ids = []
+            for file in files:
+                self._upsert(chat_id, file.id, file.name, file.size, file.tags, file.upload_ts, file.sha1)
+                seen_ids.append(file.id)
+            self.conn.execute('''CREATE TEMP TABLE IF NOT EXISTS reconciled_file_ids (file_id CHAR(100) PRIMARY KEY)''')
+            self.conn.execute('''DELETE FROM reconciled_file_ids''')
+            self.conn.executemany('''INSERT OR IGNORE INTO reconciled_file_ids (file_id) VALUES (?)''', ((x,) for x in seen_ids))
+            self.conn.execute('''DELETE FROM saved_files
+                                 WHERE chat_id = ? AND file_id NOT IN (SELECT file_id FROM reconciled_file_ids)''', (chat_id,))
+            self.conn.commit()
+
+    def remove(self, chat_id: int, file_id: str) -> None:
+        with self._lock:
+            self.conn.execute('''DELETE FROM saved_files WHERE chat_id = ? AND file_id = ?''', (chat_id, file_id))
+            self.conn.commit()
+
+    def drop_chat(self, chat_id: int) -> None:
+        with self._lock:
+            self.conn.execute('''DELETE FROM saved_files WHERE chat_id = ?''', (chat_id,))
+            self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _upsert(
+            self,
+            chat_id: int,
+            file_id: str,
+            name: str,
+            size: t.Optional[int],
+            tags: str,
+            upload_ts: t.Optional[int],
+            sha1: t.Optional[str] = None,
+            telegram_file_unique_id: t.Optional[str] = None) -> None:
+        self.conn.execute('''INSERT INTO saved_files (chat_id, file_id, name, size, upload_ts, tags, sha1, telegram_file_unique_id)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(chat_id, file_id) DO UPDATE SET
+                                 name = excluded.name,
+                                 size = excluded.size,
+                                 upload_ts = COALESCE(saved_files.upload_ts, excluded.upload_ts),
+                                 tags = CASE WHEN excluded.tags = '' THEN saved_files.tags ELSE excluded.tags END,
+                                 sha1 = COALESCE(excluded.sha1, saved_files.sha1),
+                                 -- A new version of the file in the provider no longer matches what was sent to Telegram
+                                 telegram_file_unique_id = CASE
+                                     WHEN excluded.telegram_file_unique_id IS NULL AND saved_files.sha1 IS NOT NULL AND excluded.sha1 IS NOT NULL AND saved_files.sha1 != excluded.sha1 THEN NULL
+                                     ELSE COALESCE(excluded.telegram_file_unique_id, saved_files.telegram_file_unique_id)
+                                 END
+                             WHERE saved_files.name IS NOT excluded.name
+                                 OR saved_files.size IS NOT excluded.size
+                                 OR (excluded.tags != '' AND saved_files.tags != excluded.tags)
+                                 OR (excluded.sha1 IS NOT NULL AND saved_files.sha1 IS NOT excluded.sha1)
+                                 OR (excluded.telegram_file_unique_id IS NOT NULL AND saved_files.telegram_file_unique_id IS NOT excluded.telegram_file_unique_id)''',
+            (chat_id, file_id, name, size, upload_ts, tags, sha1, telegram_file_unique_id))
+
+    @staticmethod
+    def _to_match_expression(query: str) -> t.Optional[str]:
+        # Every word of the query becomes a quoted prefix term, so user input can't inject FTS5 syntax
+        words = re.findall(r'\w+', query)
+        if len(words) == 0:
+            return None
+        return ' '.join(f'"{word}"*' for word in words)
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import tempfile
+import typing as t
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+from base_cloud_provider import BaseCloudProvider, StoreTokensCallback
+from exceptions import (
+    ItemNameInUseException,
+    InternalException,
+)
+
+# The local provider has no accounts, registered chats carry this in place of OAuth tokens
+LOCAL_TOKEN = 'local'
+
+
+class LocalUser(t.NamedTuple):
+    login: str
+
+
+class LocalFolder(t.NamedTuple):
+    object_id: str
+
+
+class LocalFile(t.NamedTuple):
+    id: str
+    name: str
+    size: int
+    created_at: str
+    sha1: t.Optional[str] = None
+
+
+class LocalProvider(BaseCloudProvider):
+    # Saves files on the bot's own disk, for self-hosted deployments and for running the bot without any network
+    name: str = 'local storage'
+    key: str = 'local'
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+
+        self.root = Path(kwargs.get('root', 'saved_files')).resolve()
+        # Files are only linked when something serves `root` over HTTP, e.g. https://files.example.com/saved_files
+        self.base_url = kwargs.get('base_url')
+        self.bot_name = kwargs['bot_name']
+        self.chunk_size = kwargs.get('chunk_size', 1024 * 1024)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def get_registration_link(self) -> str:
+        return f'<a href="https://t.me/{self.bot_name}?start={self.key}">Save files on the bot server</a>'
+
+    def get_directory_link(self, directory_id: str, directory_name: str) -> str:
+        if self.base_url is None:
+            return f'`{directory_name}`'
+        return f'[{directory_name}]({self.base_url.rstrip("/")}/{quote(directory_id)}/)'
+
+    def get_file_link(self, file_id: str, file_name: str) -> str:
+        if self.base_url is None:
+            return f'`{file_name}`'
+        return f'[{file_name}]({self.base_url.rstrip("/")}/{quote(file_id)})'
+
+    async def get_oauth_tokens(self, code: str) -> t.Tuple[str, str]:
+        return LOCAL_TOKEN, LOCAL_TOKEN
+
+    async def register_user(
+            self,
+            code: t.Optional[str],
+            update_store_callback: t.Callable[[str, str, str], None],
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            tokens: t.Optional[t.Tuple[str, str]] = None) -> t.Tuple[LocalUser, str, str, LocalFolder]:
+        return await self.executor.run(chat_id, self._register_user, update_store_callback, chat_id)
+
+    def _register_user(self, update_store_callback: t.Callable[[str, str, str], None], chat_id: t.Optional[int]) -> t.Tuple[LocalUser, str, str, LocalFolder]:
+        user = LocalUser(f'chat {chat_id}')
+        folder_id = str(chat_id)
+        try:
+            self._resolve(folder_id).mkdir()
+        except FileExistsError:
+            update_store_callback(LOCAL_TOKEN, LOCAL_TOKEN, folder_id)
+            raise ItemNameInUseException(user.login, folder_id, self.directory_name)
+        except Exception as ex:
+            raise InternalException(ex)
+        return user, LOCAL_TOKEN, LOCAL_TOKEN, LocalFolder(folder_id)
+
+    async def upload_stream(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            file: t.BinaryIO,
+            file_name: str,
+            file_size: t.Optional[int] = None,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None,
+            upload_session_id: t.Optional[str] = None,
+            on_upload_session: t.Optional[t.Callable[[str], None]] = None) -> LocalFile:
+        return await self.executor.run(chat_id, self._upload_stream, folder_id, file, file_name)
+
+    def _upload_stream(self, folder_id: str, file: t.BinaryIO, file_name: str) -> LocalFile:
+        directory = self._resolve(folder_id)
+        path = directory / Path(file_name).name
+        file_id = str(path.relative_to(self.root))
+        if path.exists():
+            raise ItemNameInUseException(f'chat {folder_id}', file_id, path.name)
+
+        try:
+            # Written under a temporary name first, so a failed transfer never leaves a truncated file behind
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    sha1 = self._copy(file, out)
+                # mkstemp() creates the file private to the bot, --local-base-url needs a web server to read it
+                os.chmod(temp_path, 0o644)
+                # link() fails if a concurrent upload took the name in the meantime, rename() would overwrite it
+                os.link(temp_path, path)
+            finally:
+                os.unlink(temp_path)
+        except FileExistsError:
+            raise ItemNameInUseException(f'chat {folder_id}', file_id, path.name)
+        except Exception as ex:
+            raise InternalException(ex)
+        return self._to_local_file(path, sha1)
+
+    def _copy(self, file: t.BinaryIO, out: t.BinaryIO) -> t.Optional[str]:
+        try:
+            in_fd = file.fileno()
+        except (AttributeError, OSError):
+            in_fd = None
+        if in_fd is not None:
+            try:
+                # Zero-copy: the kernel moves the bytes between both files, the content is never read into Python
+                offset = file.tell()
+                while True:
+                    sent = os.sendfile(out.fileno(), in_fd, offset, self.chunk_size)
+                    if sent == 0:
+                        return None
+                    offset += sent
+            except (AttributeError, OSError):
+                # No sendfile() between regular files on this platform, fall back to the copy loop below
+                out.seek(0)
+                out.truncate()
+
+        sha1 = hashlib.sha1()
+        while True:
+            chunk = file.read(self.chunk_size)
+            if not chunk:
+                return sha1.hexdigest()
+            sha1.update(chunk)
+            out.write(chunk)
+
+    async def file_exists(
+            self,
+            access_token: str,
+            refresh_token: str,
+            file_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> bool:
+        return await self.executor.run(chat_id, lambda: self._resolve(file_id).is_file())
+
+    async def search(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            query: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.AsyncIterator[LocalFile]:
+        words = query.lower().split()
+        files = await self.executor.run(chat_id, self._list_files, folder_id)
+        for file in files:
+            if all(word in file.name.lower() for word in words):
+                yield file
+
+    async def list_files(
+            self,
+            access_token: str,
+            refresh_token: str,
+            folder_id: str,
+            chat_id: t.Optional[int] = None,
+            store_tokens: t.Optional[StoreTokensCallback] = None) -> t.List[LocalFile]:
+        return await self.executor.run(chat_id, self._list_files, folder_id)
+
+    def _list_files(self, folder_id: str) -> t.List[LocalFile]:
+        files = []
+        for directory, _, file_names in os.walk(self._resolve(folder_id)):
+            for file_name in file_names:
+                if not file_name.startswith('.upload-'):
+                    files.append(self._to_local_file(Path(directory) / file_name))
+        return files
+
+    def _resolve(self, folder_id: str) -> Path:
+        path = (self.root / folder_id).resolve()
+        if path != self.root and self.root not in path.parents:
+            raise InternalException(ValueError(f'Folder {folder_id} is outside of {self.root}'))
+        return path
+
+    def _to_local_file(self, path: Path, sha1: t.Optional[str] = None) -> LocalFile:
+        stat = path.stat()
+        created_at = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat()
+        return LocalFile(str(path.relative_to(self.root)), path.name, stat.st_size, created_at, sha1)
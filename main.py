@@ -1,25 +1,155 @@
-from email.policy import default
-from saver_bot import SaverBot
-from sqlite_persistence import SqlitePersistence, init_db
-from telegram.ext import PicklePersistence
-import click
-
-
-def init_database(db: str) -> None:
-    init_db(db)
-
-
-@click.command()
-@click.option('--mode', default='run', help='Execution mode: "run" or "init"')
-@click.option('--db', default='save_bot.db')
-def main(mode: str = 'run', db: str = 'save_bot.db') -> None:
-    if mode == 'run':
-        bot = SaverBot(persistence=SqlitePersistence(db))
-        bot.run()
-    elif mode == 'init':
-        print(f'init {db} db')
-        init_database(db)
-
-
-if __name__ == '__main__':
-    main()
+import typing as t
+
+import click
+
+from db_schema import migrate
+
+# Everything else is imported by the mode that needs it: `init`/`migrate` only touch SQLite, and the workers mode
+# dispatcher never loads the provider SDKs or telegram.ext
+
+
+def migrate_database(db: str) -> None:
+    applied = migrate(db)
+    for table, count in applied.items():
+        print(f'{table}: {count} migrations applied' if count > 0 else f'{table}: up to date')
+
+
+@click.command()
+@click.option('--mode', default='run', help='Execution mode: "run", "webhook", "workers" or "migrate" ("init" is an alias of it)')
+@click.option('--db', default='save_bot.db')
+@click.option('--workers', default=16, help='Size of the thread pool for cloud provider calls')
+@click.option('--max-concurrent', default=64, help='Max number of provider calls in flight across all chats')
+@click.option('--per-chat-limit', default=2, help='Max number of provider calls in flight for a single chat')
+@click.option('--streaming/--no-streaming', default=False, help='Pipe Telegram downloads straight into the provider upload')
+@click.option('--stream-buffer', default=4 * 1024 * 1024, help='Max bytes buffered between download and upload per file in streaming mode')
+@click.option('--spool-dir', default=None, help='Download files into this directory and upload them memory-mapped instead of buffering them in memory, ignored with --streaming')
+@click.option('--spool-quota', default=1024 * 1024 * 1024, help='Max bytes of spooled files per process, further downloads wait for space')
+@click.option('--memory-budget', default=256 * 1024 * 1024, help='Max bytes of downloads buffered in memory per process, further downloads wait for room')
+@click.option('--file-index/--no-file-index', default=True, help='Answer /find from a local full-text index of saved files')
+@click.option('--max-loaded-chats', default=10000, help='Max number of chats kept in memory, idle ones are reloaded from the db on demand')
+@click.option('--upload-queue/--no-upload-queue', default=True, help='Run uploads as durable jobs that are retried with backoff and resumed after restarts')
+@click.option('--upload-workers', default=4, help='Number of upload jobs processed at the same time per bot process')
+@click.option('--batch-window', default=1.0, help='Seconds to collect documents of a chat into one batch with a single status message, 0 disables batching')
+@click.option('--batch-parallelism', default=4, help='Max number of files of a batch transferred at the same time')
+@click.option('--search-page-size', default=30, help='Max number of /find results on one page of the paginated reply')
+@click.option('--provider', 'providers', multiple=True, default=['box'], help='Storage offered to users: "box" or "local", repeat for several, the first one is the default')
+@click.option('--local-root', default='saved_files', help='Directory the local provider saves files to')
+@click.option('--local-base-url', default=None, help='Public url serving --local-root, files of the local provider are linked to it')
+@click.option('--telegram-api-url', default=None, help='Base url of a self-hosted Telegram Bot API server, e.g. http://localhost:8081')
+@click.option('--box-api-url', default=None, help='Base url of a Box API stand-in, used by the benchmark')
+@click.option('--metrics-port', default=None, type=int, help='Port of the Prometheus /metrics endpoint, disabled by default; workers use consecutive ports')
+@click.option('--metrics-listen', default='127.0.0.1', help='Address the /metrics endpoint binds to, it is not authenticated')
+@click.option('--profiler/--no-profiler', default=False, help='Serve a sampling profiler at /debug/profile?seconds=N next to /metrics')
+@click.option('--reconcile-interval', default=15 * 60, help='Seconds between syncs of the local file index with the provider')
+@click.option('--token-refresh-interval', default=60, help='Seconds between checks for OAuth tokens about to expire')
+@click.option('--token-refresh-margin', default=10 * 60, help='Refresh OAuth tokens that expire within this many seconds')
+@click.option('--token-refresh-batch-size', default=100, help='Max number of chats whose tokens are refreshed per check')
+@click.option('--token-refresh-concurrency', default=8, help='Max number of token refreshes running at the same time')
+@click.option('--token-refresh-inactive-after', default=30 * 24 * 60 * 60, help='Stop refreshing OAuth tokens of chats inactive for this many seconds')
+@click.option('--webhook-url', default=None, help='Public base url of the webhook server, e.g. https://bot.example.com')
+@click.option('--listen', default='0.0.0.0', help='Address the webhook server binds to')
+@click.option('--port', default=8000, help='Port the webhook server binds to')
+@click.option('--secret-token', default=None, help='Secret Telegram has to send with every webhook request')
+@click.option('--exchange-code/--no-exchange-code', default=False, help='Exchange the OAuth code on the redirect instead of on /start')
+@click.option('--worker-count', default=4, help='Number of bot processes in workers mode, updates are sharded between them by chat id')
+def main(
+        mode: str = 'run',
+        db: str = 'save_bot.db',
+        workers: int = 16,
+        max_concurrent: int = 64,
+        per_chat_limit: int = 2,
+        streaming: bool = False,
+        stream_buffer: int = 4 * 1024 * 1024,
+        spool_dir: t.Optional[str] = None,
+        spool_quota: int = 1024 * 1024 * 1024,
+        memory_budget: int = 256 * 1024 * 1024,
+        file_index: bool = True,
+        max_loaded_chats: int = 10000,
+        upload_queue: bool = True,
+        upload_workers: int = 4,
+        batch_window: float = 1.0,
+        batch_parallelism: int = 4,
+        search_page_size: int = 30,
+        providers: t.Sequence[str] = ('box', ),
+        local_root: str = 'saved_files',
+        local_base_url: t.Optional[str] = None,
+        telegram_api_url: t.Optional[str] = None,
+        box_api_url: t.Optional[str] = None,
+        metrics_port: t.Optional[int] = None,
+        metrics_listen: str = '127.0.0.1',
+        profiler: bool = False,
+        reconcile_interval: int = 15 * 60,
+        token_refresh_interval: int = 60,
+        token_refresh_margin: int = 10 * 60,
+        token_refresh_batch_size: int = 100,
+        token_refresh_concurrency: int = 8,
+        token_refresh_inactive_after: int = 30 * 24 * 60 * 60,
+        webhook_url: t.Optional[str] = None,
+        listen: str = '0.0.0.0',
+        port: int = 8000,
+        secret_token: t.Optional[str] = None,
+        exchange_code: bool = False,
+        worker_count: int = 4) -> None:
+    bot_kwargs = dict(
+        max_workers=workers,
+        max_concurrent=max_concurrent,
+        per_chat_limit=per_chat_limit,
+        streaming=streaming,
+        stream_buffer_size=stream_buffer,
+        spool_dir=spool_dir,
+        spool_quota=spool_quota,
+        memory_budget=memory_budget,
+        upload_workers=upload_workers,
+        batch_window=batch_window,
+        batch_parallelism=batch_parallelism,
+        search_page_size=search_page_size,
+        providers=list(providers),
+        local_root=local_root,
+        local_base_url=local_base_url,
+        telegram_api_url=telegram_api_url,
+        box_api_url=box_api_url,
+        metrics_port=metrics_port,
+        metrics_listen=metrics_listen,
+        profiler=profiler,
+        reconcile_interval=reconcile_interval,
+        token_refresh_interval=token_refresh_interval,
+        token_refresh_margin=token_refresh_margin,
+        token_refresh_batch_size=token_refresh_batch_size,
+        token_refresh_concurrency=token_refresh_concurrency,
+        token_refresh_inactive_after=token_refresh_inactive_after)
+    if mode in ('run', 'webhook'):
+        from file_index import FileIndex
+        from saver_bot import SaverBot
+        from sqlite_persistence import SqlitePersistence
+        from upload_queue import UploadJobStore
+
+        bot = SaverBot(
+            persistence=SqlitePersistence(db, max_loaded_chats=max_loaded_chats),
+            file_index=FileIndex(db) if file_index else None,
+            upload_queue=UploadJobStore(db) if upload_queue else None,
+            **bot_kwargs)
+        if mode == 'run':
+            bot.run()
+        else:
+            if webhook_url is None:
+                raise click.UsageError('--webhook-url is required in webhook mode')
+            bot.run_webhook(webhook_url, listen=listen, port=port, secret_token=secret_token, exchange_code=exchange_code)
+    elif mode == 'workers':
+        from config import Config
+        from workers import UpdateDispatcher
+
+        dispatcher = UpdateDispatcher(
+            Config().token,
+            db,
+            worker_count,
+            dict(bot_kwargs, file_index=file_index, upload_queue=upload_queue, max_loaded_chats=max_loaded_chats))
+        dispatcher.run()
+    elif mode in ('migrate', 'init'):
+        print(f'migrate {db} db')
+        migrate_database(db)
+    else:
+        raise click.UsageError(f'Unknown mode {mode}')
+
+
+if __name__ == '__main__':
+    main()
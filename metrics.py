@@ -0,0 +1,227 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing as t
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cached SQLite read up to a large upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+LabelValues = t.Tuple[t.Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelValues) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _to_label_values(labels: t.Dict[str, t.Any]) -> LabelValues:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        # Provider and SQLite calls report from their own threads
+        self._lock = threading.Lock()
+
+    def render(self) -> t.List[str]:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}'] + self._render_samples()
+
+    def _render_samples(self) -> t.List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: t.Dict[LabelValues, float] = collections.defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _to_label_values(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def _render_samples(self) -> t.List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(labels)} {value}' for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = _to_label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: t.Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        # Per label set: count per bucket (the last one is +Inf), sum of all observations
+        self._values: t.Dict[LabelValues, t.Tuple[t.List[int], t.List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _to_label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> t.Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def _render_samples(self) -> t.List[str]:
+        lines = []
+        with self._lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", le), ))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} {total[0]}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: t.Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: t.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def _register(self, metric: _Metric) -> t.Any:
+        with self._lock:
+            # Modules declare their metrics at import time, a second declaration gets the existing one
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+# Every module records into this one, like logging's root logger
+REGISTRY = MetricsRegistry()
+
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    'save_bot_event_loop_lag_seconds',
+    'How late the event loop woke up a sleeping task',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+def get_call_name(func: t.Callable) -> str:
+    # Methods come out as Class.method, lambdas are named after the method they're defined in
+    name = getattr(func, '__qualname__', None) or getattr(getattr(func, 'func', None), '__qualname__', None) or type(func).__name__
+    return name.replace('.<locals>.<lambda>', '')
+
+
+async def sample_event_loop_lag(interval: float = 0.5) -> None:
+    # A blocking call on the loop shows up as a late wake-up here
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads from a background thread, the output is in the collapsed format of flamegraph.pl
+    def __init__(self, interval: float = 0.005, max_depth: int = 64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float) -> str:
+        # One profile at a time, concurrent ones would sample each other
+        with self._lock:
+            stacks: t.Counter[str] = collections.Counter()
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        stacks[self._collapse(frame)] += 1
+                time.sleep(self.interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def _collapse(self, frame) -> str:
+        entries = traceback.extract_stack(frame, limit=self.max_depth)
+        return ';'.join(f'{entry.name} ({entry.filename.rsplit("/", 1)[-1]}:{entry.lineno})' for entry in entries)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+
+    def get(self) -> None:
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.registry.render())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    def initialize(self, profiler: SamplingProfiler) -> None:
+        self.profiler = profiler
+
+    async def get(self) -> None:
+        seconds = min(float(self.get_query_argument('seconds', '10')), 300)
+        # Sampling runs on its own thread, so the event loop being profiled keeps running
+        stacks = await asyncio.get_running_loop().run_in_executor(None, self.profiler.profile, seconds)
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(stacks)
+
+
+class MetricsServer:
+    # Meant for a local address only, nothing here is authenticated
+    def __init__(self, registry: MetricsRegistry = REGISTRY, profiler: t.Optional[SamplingProfiler] = None) -> None:
+        handlers = [('/metrics', MetricsHandler, {'registry': registry})]
+        if profiler is not None:
+            handlers.append(('/debug/profile', ProfileHandler, {'profiler': profiler}))
+        self.web_application = tornado.web.Application(handlers)
+        self._server: t.Optional[HTTPServer] = None
+
+    def listen(self, port: int, address: str = '127.0.0.1') -> None:
+        self._server = HTTPServer(self.web_application)
+        self._server.listen(port, address)
+        logger.info('Serving metrics on http://%s:%s/metrics', address, port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
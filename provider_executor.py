@@ -0,0 +1,89 @@
+import asyncio
+import functools
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY, get_call_name
+
+PROVIDER_WAIT_SECONDS = REGISTRY.histogram('save_bot_provider_wait_seconds', 'Time provider calls waited for a per-chat and a global slot')
+PROVIDER_CALL_SECONDS = REGISTRY.histogram('save_bot_provider_call_seconds', 'Duration of blocking provider calls on the thread pool')
+PROVIDER_CALLS_IN_FLIGHT = REGISTRY.gauge('save_bot_provider_calls_in_flight', 'Provider calls running on the thread pool')
+
+
+class ProviderExecutor:
+    def __init__(self, max_workers: int = 16, max_concurrent: int = 64, per_chat_limit: int = 2) -> None:
+        self.max_workers = max_workers
+        self.max_concurrent = max_concurrent
+        self.per_chat_limit = per_chat_limit
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='provider')
+        self._global_semaphore: t.Optional[asyncio.Semaphore] = None
+        self._chat_semaphores: t.Dict[int, asyncio.Semaphore] = {}
+        self._chat_waiters: t.Dict[int, int] = {}
+
+    async def run(self, chat_id: t.Optional[int], func: t.Callable[..., t.Any], *args, **kwargs) -> t.Any:
+        # Semaphores are created lazily so they bind to the running event loop
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        call = get_call_name(func)
+        queued_at = time.perf_counter()
+        async with self._chat_slot(chat_id):
+            async with self._global_semaphore:
+                started_at = time.perf_counter()
+                PROVIDER_WAIT_SECONDS.observe(started_at - queued_at, call=call)
+                PROVIDER_CALLS_IN_FLIGHT.inc(1)
+                outcome = 'error'
+                try:
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+                    outcome = 'ok'
+                    return result
+                finally:
+                    PROVIDER_CALLS_IN_FLIGHT.inc(-1)
+                    PROVIDER_CALL_SECONDS.observe(time.perf_counter() - started_at, call=call, outcome=outcome)
+
+    def _chat_slot(self, chat_id: t.Optional[int]) -> '_ChatSlot':
+        return _ChatSlot(self, chat_id)
+
+    def _acquire_chat_semaphore(self, chat_id: int) -> asyncio.Semaphore:
+        semaphore = self._chat_semaphores.get(chat_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_chat_limit)
+            self._chat_semaphores[chat_id] = semaphore
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        return semaphore
+
+    def _release_chat_semaphore(self, chat_id: int) -> None:
+        # Drop per-chat semaphores as soon as nobody uses them, so the dict does not grow with every chat ever seen
+        self._chat_waiters[chat_id] -= 1
+        if self._chat_waiters[chat_id] == 0:
+            del self._chat_waiters[chat_id]
+            del self._chat_semaphores[chat_id]
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+
+class _ChatSlot:
+    def __init__(self, executor: ProviderExecutor, chat_id: t.Optional[int]) -> None:
+        self.executor = executor
+        self.chat_id = chat_id
+        self.semaphore: t.Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> None:
+        if self.chat_id is None:
+            return
+        self.semaphore = self.executor._acquire_chat_semaphore(self.chat_id)
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.executor._release_chat_semaphore(self.chat_id)
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self.semaphore is None:
+            return
+        self.semaphore.release()
+        self.executor._release_chat_semaphore(self.chat_id)
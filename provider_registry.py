@@ -0,0 +1,34 @@
+import typing as t
+
+from base_cloud_provider import BaseCloudProvider
+
+
+class ProviderRegistry:
+    # Every chat saves into the provider it registered with, chats registered before that use the first one
+    def __init__(self, providers: t.Sequence[BaseCloudProvider]) -> None:
+        if len(providers) == 0:
+            raise ValueError('At least one provider is required')
+        self._providers: t.Dict[str, BaseCloudProvider] = {provider.key: provider for provider in providers}
+        self.default = providers[0]
+
+    def __iter__(self) -> t.Iterator[BaseCloudProvider]:
+        return iter(self._providers.values())
+
+    def get(self, key: t.Optional[str]) -> BaseCloudProvider:
+        if key is None:
+            return self.default
+        return self._providers[key]
+
+    def for_chat(self, chat_data: dict) -> BaseCloudProvider:
+        return self.get(chat_data.get('provider'))
+
+    @property
+    def oauth_provider(self) -> t.Optional[BaseCloudProvider]:
+        return next((provider for provider in self._providers.values() if provider.uses_oauth), None)
+
+    def for_start_parameter(self, parameter: str) -> t.Tuple[t.Optional[BaseCloudProvider], t.Optional[str]]:
+        # Providers without OAuth register through a /start deep link with their key, anything else is an OAuth code
+        provider = self._providers.get(parameter)
+        if provider is not None and not provider.uses_oauth:
+            return provider, None
+        return self.oauth_provider, parameter
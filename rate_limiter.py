@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+import typing as t
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Every Bot API call passes the rate limiter, file downloads don't
+TELEGRAM_REQUEST_SECONDS = REGISTRY.histogram('save_bot_telegram_request_seconds', 'Duration of Telegram Bot API calls, without rate limiting')
+TELEGRAM_RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram('save_bot_telegram_rate_limit_wait_seconds', 'Time Telegram Bot API calls were held back by the rate limits')
+TELEGRAM_FLOOD_CONTROL = REGISTRY.counter('save_bot_telegram_flood_control_total', 'Telegram Bot API calls answered with RetryAfter')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        # Tokens are taken right away and may go negative, so waiters are served in arrival order without a lock
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+
+class TokenBucketRateLimiter(BaseRateLimiter[int]):
+    # Telegram allows about 30 messages per second overall, one per second in a chat and 20 per minute in a group
+    def __init__(
+            self,
+            global_rate: float = 30,
+            global_burst: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            group_rate: float = 20 / 60,
+            group_burst: float = 5,
+            max_retries: int = 2,
+            max_chat_buckets: int = 10000,
+            shard_count: int = 1) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+
+        # Each of `shard_count` worker processes limits itself to its share of the bot-wide limit. Chats are sharded
+        # between the workers, so a chat's limits stay whole.
+        self._global_bucket = TokenBucket(global_rate / shard_count, max(1.0, global_burst / shard_count))
+        self._chat_buckets: t.Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chat_buckets.clear()
+
+    async def process_request(
+            self,
+            callback: t.Callable[..., t.Coroutine[t.Any, t.Any, t.Union[bool, t.Dict[str, t.Any], None]]],
+            args: t.Any,
+            kwargs: t.Dict[str, t.Any],
+            endpoint: str,
+            data: t.Dict[str, t.Any],
+            rate_limit_args: t.Optional[int]) -> t.Union[bool, t.Dict[str, t.Any], None]:
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        chat_id = self._get_chat_id(data)
+        for attempt in range(max_retries + 1):
+            queued_at = time.perf_counter()
+            await self._wait_for_pause()
+            # Only requests that post into a chat count against the limits, getFile, getUpdates and alike pass through
+            if chat_id is not None:
+                await self._get_chat_bucket(chat_id).acquire()
+                await self._global_bucket.acquire()
+            TELEGRAM_RATE_LIMIT_WAIT_SECONDS.observe(time.perf_counter() - queued_at)
+            try:
+                with TELEGRAM_REQUEST_SECONDS.time(endpoint=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as ex:
+                TELEGRAM_FLOOD_CONTROL.inc(endpoint=endpoint)
+                if attempt == max_retries:
+                    raise
+                # Flood control applies to the whole bot, everything waits until it's lifted
+                logger.info('Telegram flood control on %s, pausing for %ss', endpoint, ex.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + ex.retry_after)
+
+    async def _wait_for_pause(self) -> None:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                self._evict_idle_buckets()
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _evict_idle_buckets(self) -> None:
+        # A full bucket carries no state, it's recreated the same way on the next message
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.idle]:
+            del self._chat_buckets[chat_id]
+
+    @staticmethod
+    def _get_chat_id(data: t.Dict[str, t.Any]) -> t.Optional[int]:
+        try:
+            return int(data['chat_id'])
+        except (KeyError, TypeError, ValueError):
+            return None
@@ -1,139 +1,1001 @@
-import io
-
-from telegram import Bot as TelegramBot, Update, constants
-from telegram.ext import CommandHandler, CallbackContext, Application, BasePersistence, MessageHandler, filters
-from telegram.ext import (
-    CommandHandler,
-    CallbackContext,
-    Application,
-    BasePersistence,
-    MessageHandler,
-    filters
-)
-from telegram.error import BadRequest as tgBadRequest
-
-from config import Config
-from box_cloud_provider import BoxProvider
-from exceptions import (
-    ItemNameInUseException,
-    InternalException
-)
-
-
-class SaverBot(TelegramBot):
-    def __init__(self, persistence: BasePersistence):
-        config = Config()
-        self.provider = BoxProvider(
-            client_id=config.client_id,
-            client_token=config.client_token,
-            redirect_url=config.redirect_url)
-        self.bot_token = config.token
-
-        self.application = Application.builder().token(self.bot_token).persistence(persistence).build()
-        self.application.add_handler(CommandHandler('start', self.start))
-        self.application.add_handler(MessageHandler(filters=filters.ALL, callback=self.upload_file_or_search))
-
-
-    async def start(self, update: Update, context: CallbackContext):
-        message_parts: list[str] = update.message.text.split(' ')
-        if len(message_parts) == 2:
-            await self.register_user(update, context)
-        else:
-            await self.send_register_link(update, context)
-
-    async def register_user(self, update, context):
-        def _update_store_callback(access_token, refresh_token, directory_id) -> None:
-            if access_token is None or refresh_token is None or directory_id is None:
-                raise InternalException(ValueError(f'Some of required props are None: {access_token=}, {refresh_token=}, {directory_id=}'))
-            context.chat_data['access_token'] = access_token
-            context.chat_data['refresh_token'] = refresh_token
-            context.chat_data['box_folder_id'] = directory_id
-
-        try:
-            code = update.message.text.split(' ')[1]
-            user, access_token, refresh_token, save_bot_directory = self.provider.register_user(code, _update_store_callback)
-            _update_store_callback(access_token, refresh_token, save_bot_directory.object_id)
-            await update.message.reply_markdown(self.get_success_registered_msg_text(user.login, save_bot_directory.object_id))
-
-        except ItemNameInUseException as item_name_in_use_ex:
-            context.chat_data['box_folder_id'] = item_name_in_use_ex.item_id
-            await update.message.reply_markdown(self.get_already_registered_msg_text(item_name_in_use_ex.user_login, item_name_in_use_ex.item_id))
-
-        except InternalException as internal_ex:
-            await update.message.reply_markdown(internal_ex.message)
-
-
-    @staticmethod
-    async def _send_no_document_passed_message(update: Update):
-        await update.message.reply_text('Message does not contain any file. Please, try resend file one more time.')
-
-    async def upload_file_or_search(self, update: Update, context: CallbackContext) -> None:
-        if update.message.document is None:
-            await self.search(update, context)
-            return
-        
-        if 'access_token' in context.chat_data:
-            try:
-                await update.message.reply_text(f'File {update.effective_message.document.file_name} is uploading to your {self.provider.name}.')
-                uploaded_file = await self._upload_file(update, context)
-                file_link = self.provider.get_file_link(uploaded_file.id, uploaded_file.name)
-                await update.message.reply_markdown(f'{file_link} is now in your {self.provider.name}')
-            except tgBadRequest as tg_exception:
-                if tg_exception.message == 'File is too big':
-                    await update.message.reply_text('Sorry, but the file is too big. Bot supports files less than 20 Mb only.')
-                else:
-                    await update.message.reply_text(f'Internal Telegram Error: {tg_exception.message}')
-            except ItemNameInUseException as item_in_use_ex:
-                existing_file_link = self.provider.get_file_link(item_in_use_ex.item_id, item_in_use_ex.item_name)
-                await update.message.reply_markdown(f'File with the same name already exists: {existing_file_link}')
-            except Exception as ex:
-                await update.message.reply_text(f'Internal Error: {ex}')
-        else:
-            await update.message.reply_text(f'It seems like you have to connect to {self.provider.name}.')
-            await self.send_register_link(update, context)
-
-    async def search(self, update: Update, context: CallbackContext) -> None:
-        query = update.message.text.replace('/find', '').strip()
-
-        access_token = context.chat_data['access_token']
-        refresh_token = context.chat_data['refresh_token']
-        folder_id = context.chat_data['box_folder_id']  
-        search_result = self.provider.search(access_token, refresh_token, folder_id, query)
-        if search_result is None:
-            await update.message.reply_markdown('You don\'t have any book with "{query}" in name, description, comments, or tags.')
-
-        await update.message.reply_chat_action(action=constants.ChatAction.TYPING)
-        search_message = []
-        for item in search_result:
-            search_message.append(f'- {self.provider.get_file_link(item.id, item.name)}')
-            if len(search_message) == 5:
-                await update.message.reply_chat_action(action=constants.ChatAction.TYPING)
-                await update.message.reply_markdown('\n'.join(search_message))
-                search_message = []
-
-        if len(search_message) > 0:
-            await update.message.reply_markdown('\n'.join(search_message))
-
-    async def _upload_file(self, update, context):
-        access_token = context.chat_data['access_token']
-        refresh_token = context.chat_data['refresh_token']
-        folder_id = context.chat_data['box_folder_id']
-
-        document = update.effective_message.document
-        file = await self.application.bot.get_file(document.file_id)
-        with io.BytesIO() as content:
-            await file.download(out=content)
-            uploaded_file = self.provider.upload_file(access_token, refresh_token, folder_id, content, document.file_name)
-            return uploaded_file
-
-    async def send_register_link(self, update: Update, context: CallbackContext):
-        await update.message.reply_html(self.provider.get_registration_link())
-
-    def get_success_registered_msg_text(self, login: str, box_folder_id: str) -> str:
-        return  f'You\'ve been successfully registered with login {login}. I\'ve created a directory for savings called {self.provider.get_directory_link(box_folder_id, self.provider.directory_name)}'
-
-    def get_already_registered_msg_text(self, login: str, box_folder_id: str) -> str:
-        return f'You\'ve been already registered with login {login}. The directory for savings called {self.provider.get_directory_link(box_folder_id, self.provider.directory_name)}'
-
-    def run(self):
-        self.application.run_polling()
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import logging
+import re
+import signal
+import time
+import typing as t
+from datetime import datetime
+from pathlib import Path
+
+from telegram import Bot as TelegramBot, Document, Update, constants, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import CommandHandler, CallbackContext, Application, BasePersistence, MessageHandler, filters
+from telegram.ext import (
+    CommandHandler,
+    CallbackContext,
+    CallbackQueryHandler,
+    Application,
+    BasePersistence,
+    MessageHandler,
+    filters
+)
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest as tgBadRequest, NetworkError as tgNetworkError, RetryAfter as tgRetryAfter
+
+from config import Config
+from base_cloud_provider import BaseCloudProvider
+from local_cloud_provider import LocalProvider
+from provider_registry import ProviderRegistry
+from provider_executor import ProviderExecutor
+from streaming import StreamPipe, TelegramFileStreamer
+from spool import ByteBudget, FileSpool, MappedFile
+from file_index import FileIndex, IndexedFile
+from webhook_server import PendingAuthorizations, WebhookServer
+from upload_queue import UploadJob, UploadJobStore
+from upload_batch import UploadBatch, UploadBatcher
+from rate_limiter import TokenBucketRateLimiter
+from sqlite_persistence import SqlitePersistence
+from metrics import REGISTRY, MetricsServer, SamplingProfiler, get_call_name, sample_event_loop_lag
+from exceptions import (
+    ItemNameInUseException,
+    DuplicateFileException,
+    InternalException,
+    QuotaExceededException,
+    RetryableException
+)
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_HEADER_RE = re.compile(r'^Files with "(.*)", \d+-\d+:')
+
+# Bot API limit for downloads, reserved when Telegram doesn't report a file size
+TELEGRAM_MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+
+TELEGRAM_DOWNLOAD_SECONDS = REGISTRY.histogram('save_bot_telegram_download_seconds', 'Duration of file downloads from Telegram')
+TOKEN_REFRESHES = REGISTRY.counter('save_bot_token_refreshes_total', 'Proactive token refreshes by outcome')
+THREAD_CALL_SECONDS = REGISTRY.histogram('save_bot_thread_call_seconds', 'Duration of file index, upload queue and hashing calls, including the wait for a thread')
+
+
+class SaverBot(TelegramBot):
+    def __init__(
+            self,
+            persistence: BasePersistence,
+            max_workers: int = 16,
+            max_concurrent: int = 64,
+            per_chat_limit: int = 2,
+            streaming: bool = False,
+            stream_buffer_size: int = 4 * 1024 * 1024,
+            spool_dir: t.Optional[str] = None,
+            spool_quota: int = 1024 * 1024 * 1024,
+            memory_budget: int = 256 * 1024 * 1024,
+            file_index: t.Optional[FileIndex] = None,
+            reconcile_interval: float = 15 * 60,
+            reconcile_batch_size: int = 20,
+            upload_queue: t.Optional[UploadJobStore] = None,
+            upload_workers: int = 4,
+            batch_window: float = 1.0,
+            batch_parallelism: int = 4,
+            search_page_size: int = 30,
+            rate_limiter: t.Optional[TokenBucketRateLimiter] = None,
+            providers: t.Sequence[str] = ('box', ),
+            local_root: str = 'saved_files',
+            local_base_url: t.Optional[str] = None,
+            telegram_api_url: t.Optional[str] = None,
+            box_api_url: t.Optional[str] = None,
+            metrics_port: t.Optional[int] = None,
+            metrics_listen: str = '127.0.0.1',
+            profiler: bool = False,
+            token_refresh_interval: float = 60,
+            token_refresh_margin: float = 10 * 60,
+            token_refresh_batch_size: int = 100,
+            token_refresh_concurrency: int = 8,
+            token_refresh_inactive_after: float = 30 * 24 * 60 * 60,
+            shard_index: int = 0,
+            shard_count: int = 1,
+            polling: bool = True):
+        config = Config()
+        self.box_api_url = box_api_url
+        self.executor = ProviderExecutor(max_workers=max_workers, max_concurrent=max_concurrent, per_chat_limit=per_chat_limit)
+        self.providers = ProviderRegistry([self._create_provider(key, config, local_root, local_base_url) for key in providers])
+        self.streaming = streaming
+        self.stream_buffer_size = stream_buffer_size
+        self.file_streamer = TelegramFileStreamer()
+        # Downloads spooled to disk count against `spool_quota`, the ones buffered in memory against `memory_budget`
+        self.spool = FileSpool(spool_dir, spool_quota) if spool_dir is not None else None
+        self.memory_budget = ByteBudget('memory', memory_budget)
+        self.file_index = file_index
+        self.reconcile_batch_size = reconcile_batch_size
+        self._reconcile_cursor = 0
+        self.upload_queue = upload_queue
+        self.upload_workers = upload_workers
+        self._upload_queue_event = asyncio.Event()
+        self._upload_queue_tasks: t.List[asyncio.Task] = []
+        # Collects media groups and bursts of documents of a chat, a zero window uploads every document on its own
+        self.upload_batcher = UploadBatcher(self._upload_batch, window=batch_window) if batch_window > 0 else None
+        self.batch_parallelism = batch_parallelism
+        self._upload_batches: t.Dict[int, t.Tuple[UploadBatch, int]] = {}
+        # Updates of a chat are handled one after another, e.g. a document sent right after /start sees the registration
+        self._chat_locks: t.Dict[int, asyncio.Lock] = {}
+        self._chat_lock_users: t.Counter[int] = collections.Counter()
+        self.search_page_size = search_page_size
+        self.bot_token = config.token
+        self.bot_name = config.bot_name
+        self.pending_authorizations = PendingAuthorizations()
+        self.metrics_port = metrics_port
+        self.metrics_listen = metrics_listen
+        self.metrics_server = MetricsServer(profiler=SamplingProfiler() if profiler else None) if metrics_port is not None else None
+        self._event_loop_lag_task: t.Optional[asyncio.Task] = None
+        # Tokens expiring within `token_refresh_margin` seconds are refreshed ahead of time, so requests never wait for OAuth
+        self.token_refresh_margin = token_refresh_margin
+        self.token_refresh_batch_size = token_refresh_batch_size
+        self.token_refresh_concurrency = token_refresh_concurrency
+        # Not for chats inactive longer than that, a refresh token stays valid for a while after its last use and the
+        # chat's next update refreshes it on demand
+        self.token_refresh_inactive_after = token_refresh_inactive_after
+        # In workers mode every process refreshes the tokens of the chats sharded to it
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+        builder = (
+            Application.builder()
+            .token(self.bot_token)
+            .persistence(persistence)
+            .concurrent_updates(max_concurrent)
+            .rate_limiter(rate_limiter if rate_limiter is not None else TokenBucketRateLimiter(shard_count=shard_count)))
+        if telegram_api_url is not None:
+            # A self-hosted Bot API server or the benchmark's fake one
+            telegram_api_url = telegram_api_url.rstrip('/')
+            builder = builder.base_url(f'{telegram_api_url}/bot').base_file_url(f'{telegram_api_url}/file/bot')
+        if not polling:
+            builder = builder.updater(None)
+        self.application = builder.build()
+        self.application.add_handler(CommandHandler('start', self._chat_handler(self.start)))
+        self.application.add_handler(CallbackQueryHandler(self._chat_handler(self.search_page), pattern=r'^find:\d+$'))
+        self.application.add_handler(MessageHandler(filters=filters.ALL, callback=self._chat_handler(self.upload_file_or_search)))
+        if self.file_index is not None:
+            self.application.job_queue.run_repeating(self._reconcile_file_index, interval=reconcile_interval, first=reconcile_interval)
+        if isinstance(persistence, SqlitePersistence) and any(provider.access_token_ttl is not None for provider in self.providers):
+            self.application.job_queue.run_repeating(self._refresh_expiring_tokens, interval=token_refresh_interval, first=token_refresh_interval)
+        if self.upload_queue is not None:
+            self.application.job_queue.run_repeating(self._prune_upload_jobs, interval=60 * 60, first=60)
+
+
+    def _create_provider(self, key: str, config: Config, local_root: str, local_base_url: t.Optional[str]) -> BaseCloudProvider:
+        if key == 'box':
+            # Imported on first use, boxsdk and requests are the slowest imports of the bot and a local-only bot never needs them
+            from box_cloud_provider import BoxProvider
+            return BoxProvider(
+                client_id=config.client_id,
+                client_token=config.client_token,
+                redirect_url=config.redirect_url,
+                api_url=self.box_api_url,
+                executor=self.executor)
+        if key == LocalProvider.key:
+            return LocalProvider(root=local_root, base_url=local_base_url, bot_name=config.bot_name, executor=self.executor)
+        raise ValueError(f'Unknown provider {key}')
+
+    async def start(self, update: Update, context: CallbackContext):
+        message_parts: list[str] = update.message.text.split(' ')
+        if len(message_parts) == 2:
+            await self.register_user(update, context)
+        else:
+            await self.send_register_link(update, context)
+
+    async def register_user(self, update, context):
+        provider, code = self.providers.for_start_parameter(update.message.text.split(' ')[1])
+        if provider is None:
+            await self.send_register_link(update, context)
+            return
+
+        def _update_store_callback(access_token, refresh_token, directory_id) -> None:
+            if access_token is None or refresh_token is None or directory_id is None:
+                raise InternalException(ValueError(f'Some of required props are None: {access_token=}, {refresh_token=}, {directory_id=}'))
+            if context.chat_data.get('provider', self.providers.default.key) != provider.key and self.file_index is not None:
+                # File ids of the previous provider mean nothing to the new one
+                self.file_index.drop_chat(update.effective_chat.id)
+            context.chat_data['access_token'] = access_token
+            context.chat_data['refresh_token'] = refresh_token
+            context.chat_data['box_folder_id'] = directory_id
+            context.chat_data['provider'] = provider.key
+            context.chat_data['token_expires_ts'] = self._get_token_expiry(provider)
+
+        try:
+            user, access_token, refresh_token, save_bot_directory = await provider.register_user(
+                code,
+                _update_store_callback,
+                chat_id=update.effective_chat.id,
+                store_tokens=self._get_store_tokens_callback(context.chat_data),
+                tokens=self.pending_authorizations.pop(code) if code is not None else None)
+            _update_store_callback(access_token, refresh_token, save_bot_directory.object_id)
+            provider.invalidate_folder_cache(save_bot_directory.object_id)
+            await update.message.reply_markdown(self.get_success_registered_msg_text(provider, user.login, save_bot_directory.object_id))
+
+        except ItemNameInUseException as item_name_in_use_ex:
+            context.chat_data['box_folder_id'] = item_name_in_use_ex.item_id
+            provider.invalidate_folder_cache(item_name_in_use_ex.item_id)
+            await update.message.reply_markdown(self.get_already_registered_msg_text(provider, item_name_in_use_ex.user_login, item_name_in_use_ex.item_id))
+
+        except InternalException as internal_ex:
+            await update.message.reply_markdown(internal_ex.message)
+
+
+    @staticmethod
+    async def _send_no_document_passed_message(update: Update):
+        await update.message.reply_text('Message does not contain any file. Please, try resend file one more time.')
+
+    async def upload_file_or_search(self, update: Update, context: CallbackContext) -> None:
+        if update.message.document is None:
+            await self.search(update, context)
+            return
+
+        if 'access_token' not in context.chat_data:
+            await update.message.reply_text(f'It seems like you have to connect to {self.providers.default.name}.')
+            await self.send_register_link(update, context)
+        elif self.upload_batcher is not None and not self.upload_batcher.closed:
+            # Released once the batch is done, see `_upload_batch`
+            self._hold_chat(update.effective_chat.id)
+            self.upload_batcher.add(update.effective_chat.id, (update, context.chat_data))
+        else:
+            await self._upload_single(update, context.chat_data)
+
+    async def _upload_single(self, update: Update, chat_data: dict) -> None:
+        provider = self.providers.for_chat(chat_data)
+        # A resend of a saved file is answered right away, nothing is downloaded or uploaded
+        duplicate = await self._find_duplicate(update.effective_chat.id, chat_data, telegram_file_unique_id=update.effective_message.document.file_unique_id)
+        if duplicate is not None:
+            await update.message.reply_markdown(self.get_duplicate_msg_text(provider, duplicate.id, duplicate.name))
+        elif self.upload_queue is not None:
+            try:
+                await self._enqueue_upload(update)
+            except Exception as ex:
+                logger.exception('Failed to enqueue the upload of a document of chat %s', update.effective_chat.id)
+                text, parse_mode = self._get_upload_error_text(provider, ex)
+                await update.message.reply_text(text, parse_mode=parse_mode)
+                return
+            self._upload_queue_event.set()
+            await update.message.reply_text(f'File {self._get_file_name(update.effective_message.document)} is uploading to your {provider.name}.')
+        else:
+            try:
+                await update.message.reply_text(f'File {self._get_file_name(update.effective_message.document)} is uploading to your {provider.name}.')
+                text = await self._upload_and_index(update, chat_data)
+                await update.message.reply_markdown(text)
+            except Exception as ex:
+                text, parse_mode = self._get_upload_error_text(provider, ex)
+                await update.message.reply_text(text, parse_mode=parse_mode)
+
+    async def _upload_batch(self, chat_id: int, items: t.List[t.Tuple[Update, dict]]) -> None:
+        chat_data = items[-1][1]
+        try:
+            if len(items) == 1:
+                await self._upload_single(items[0][0], chat_data)
+            else:
+                updates = [update for update, _ in items]
+                batch = UploadBatch(chat_id, [self._get_file_name(update.effective_message.document) for update in updates], self.providers.for_chat(chat_data).name)
+                await batch.send(updates[0].effective_message)
+                semaphore = asyncio.Semaphore(self.batch_parallelism)
+                # Every item settles before the holds are released below, a failed one doesn't unload the chat under the rest
+                results = await asyncio.gather(
+                    *(self._upload_batch_item(batch, index, update, chat_data, semaphore) for index, update in enumerate(updates)),
+                    return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error('Upload of a batched document of chat %s failed', chat_id, exc_info=result)
+        finally:
+            # Batches run after their handlers returned, so the application doesn't persist rotated tokens on its own.
+            # Also when the batch is cancelled on shutdown, a token rotated mid-upload is the only valid one.
+            await self.application.persistence.update_chat_data(chat_id, dict(chat_data))
+            for _ in items:
+                self._release_chat(chat_id)
+
+    async def _upload_batch_item(self, batch: UploadBatch, index: int, update: Update, chat_data: dict, semaphore: asyncio.Semaphore) -> None:
+        provider = self.providers.for_chat(chat_data)
+        async with semaphore:
+            duplicate = await self._find_duplicate(batch.chat_id, chat_data, telegram_file_unique_id=update.effective_message.document.file_unique_id)
+            if duplicate is not None:
+                await batch.add_result(index, self.get_duplicate_msg_text(provider, duplicate.id, duplicate.name), constants.ParseMode.MARKDOWN)
+            elif self.upload_queue is not None:
+                # The job reports back into the batch once it's done, see `_reply_to_job`
+                try:
+                    job_id = await self._enqueue_upload(update)
+                except Exception as ex:
+                    logger.exception('Failed to enqueue the upload of a document of chat %s', batch.chat_id)
+                    await batch.add_result(index, *self._get_upload_error_text(provider, ex))
+                    return
+                self._upload_batches[job_id] = (batch, index)
+                self._upload_queue_event.set()
+            else:
+                try:
+                    text, parse_mode = await self._upload_and_index(update, chat_data), constants.ParseMode.MARKDOWN
+                except Exception as ex:
+                    text, parse_mode = self._get_upload_error_text(provider, ex)
+                await batch.add_result(index, text, parse_mode)
+
+    async def _upload_and_index(self, update: Update, chat_data: dict) -> str:
+        uploaded_file, sha1 = await self._upload_file(update, chat_data)
+        await self._index_file(
+            update.effective_chat.id,
+            uploaded_file.id,
+            uploaded_file.name,
+            update.effective_message.document.file_size,
+            self._get_caption_tags(update),
+            sha1,
+            update.effective_message.document.file_unique_id)
+        provider = self.providers.for_chat(chat_data)
+        file_link = provider.get_file_link(uploaded_file.id, uploaded_file.name)
+        return f'{file_link} is now in your {provider.name}'
+
+    def _get_upload_error_text(self, provider: BaseCloudProvider, ex: Exception) -> t.Tuple[str, t.Optional[str]]:
+        if isinstance(ex, tgBadRequest):
+            if ex.message == 'File is too big':
+                return 'Sorry, but the file is too big. Bot supports files less than 20 Mb only.', None
+            return f'Internal Telegram Error: {ex.message}', None
+        if isinstance(ex, QuotaExceededException):
+            return f'Sorry, but the file is too big. Bot accepts files up to {ex.limit // (1024 * 1024)} Mb at the moment.', None
+        if isinstance(ex, DuplicateFileException):
+            return self.get_duplicate_msg_text(provider, ex.item_id, ex.item_name), constants.ParseMode.MARKDOWN
+        if isinstance(ex, ItemNameInUseException):
+            existing_file_link = provider.get_file_link(ex.item_id, ex.item_name)
+            return f'File with the same name already exists: {existing_file_link}', constants.ParseMode.MARKDOWN
+        return f'Internal Error: {ex}', None
+
+    async def search(self, update: Update, context: CallbackContext) -> None:
+        query = update.message.text.replace('/find', '').strip()
+
+        await update.message.reply_chat_action(action=constants.ChatAction.TYPING)
+        text, reply_markup = await self._get_search_page(update.effective_chat.id, context.chat_data, query, 0)
+        await update.message.reply_markdown(text, reply_markup=reply_markup, disable_web_page_preview=True)
+
+    async def search_page(self, update: Update, context: CallbackContext) -> None:
+        # The query is read back from the page header, so the buttons keep working across restarts and worker processes
+        callback_query = update.callback_query
+        await callback_query.answer()
+        match = SEARCH_PAGE_HEADER_RE.match(callback_query.message.text or '')
+        if match is None or 'access_token' not in context.chat_data:
+            return
+
+        offset = int(callback_query.data.split(':')[1])
+        text, reply_markup = await self._get_search_page(update.effective_chat.id, context.chat_data, match.group(1), offset)
+        await callback_query.edit_message_text(text, parse_mode=constants.ParseMode.MARKDOWN, reply_markup=reply_markup, disable_web_page_preview=True)
+
+    async def _get_search_page(self, chat_id: int, chat_data: dict, query: str, offset: int) -> t.Tuple[str, t.Optional[InlineKeyboardMarkup]]:
+        # One message per page instead of one per 5 hits, as many links as fit into a Telegram message
+        search_result = await self._find_files(chat_id, chat_data, query, offset, self.search_page_size + 1)
+        if len(search_result) == 0:
+            return f'You don\'t have any book with "{escape_markdown(query)}" in name, description, comments, or tags.', None
+
+        provider = self.providers.for_chat(chat_data)
+        lines = []
+        length = 0
+        for item in search_result[:self.search_page_size]:
+            line = f'- {provider.get_file_link(item.id, item.name)}'
+            # Telegram counts the limit in UTF-16 code units, the header takes up the rest
+            length += len(line.encode('utf-16-le')) // 2 + 1
+            if lines and length > constants.MessageLimit.TEXT_LENGTH - 200:
+                break
+            lines.append(line)
+
+        header = f'Files with "{escape_markdown(query)}", {offset + 1}-{offset + len(lines)}:'
+        buttons = []
+        if offset > 0:
+            buttons.append(InlineKeyboardButton('« Previous', callback_data=f'find:{max(0, offset - self.search_page_size)}'))
+        if len(search_result) > len(lines):
+            buttons.append(InlineKeyboardButton('Next »', callback_data=f'find:{offset + len(lines)}'))
+        return '\n'.join([header] + lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+    async def _find_files(self, chat_id: int, chat_data: dict, query: str, offset: int, limit: int) -> t.List[t.Any]:
+        if self.file_index is not None:
+            search_result = await self._run_in_thread(self.file_index.search, chat_id, query, limit, offset)
+            if len(search_result) > 0:
+                return search_result
+
+        search_result = [
+            item async for item in self.providers.for_chat(chat_data).search(
+                chat_data['access_token'],
+                chat_data['refresh_token'],
+                chat_data['box_folder_id'],
+                query,
+                chat_id=chat_id,
+                store_tokens=self._get_store_tokens_callback(chat_data))]
+        await self._index_files(chat_id, [IndexedFile(item.id, item.name, getattr(item, 'size', None), None, '') for item in search_result])
+        return search_result[offset:offset + limit]
+
+    async def _upload_file(self, update: Update, chat_data: dict):
+        document = update.effective_message.document
+        return await self._upload_document(
+            update.effective_chat.id,
+            chat_data,
+            document.file_id,
+            self._get_file_name(document),
+            document.file_size)
+
+    async def _upload_document(
+            self,
+            chat_id: int,
+            chat_data: dict,
+            telegram_file_id: str,
+            file_name: str,
+            file_size: t.Optional[int],
+            spool_key: t.Optional[t.Hashable] = None,
+            **upload_kwargs) -> t.Tuple[t.Any, t.Optional[str]]:
+        # Returns the uploaded file and the SHA-1 of its content, if the provider or the bot computed one. A spooled
+        # download with a `spool_key` is kept for the next call with the same key, until it's discarded.
+        provider = self.providers.for_chat(chat_data)
+        upload_args = (chat_data['access_token'], chat_data['refresh_token'], chat_data['box_folder_id'])
+        upload_kwargs = dict(upload_kwargs, chat_id=chat_id, store_tokens=self._get_store_tokens_callback(chat_data))
+
+        file = await self.application.bot.get_file(telegram_file_id)
+        local_path = Path(file.file_path)
+        sha1 = None
+        if local_path.is_file():
+            # A local Bot API server hands out paths on this machine, the provider reads the file itself (zero-copy for the local provider)
+            with local_path.open('rb') as local_file:
+                uploaded_file = await provider.upload_stream(*upload_args, local_file, file_name, file_size, **upload_kwargs)
+        elif self.streaming:
+            async with self.memory_budget.reserve(self.stream_buffer_size):
+                uploaded_file = await self._upload_file_streaming(provider, file, file_name, file_size, upload_args, upload_kwargs)
+        elif self.spool is not None:
+            uploaded_file, sha1 = await self._upload_file_spooled(chat_id, chat_data, provider, file, file_name, file_size, spool_key, upload_args, upload_kwargs)
+        else:
+            async with self.memory_budget.reserve(file.file_size or file_size or TELEGRAM_MAX_DOWNLOAD_SIZE):
+                with io.BytesIO() as content:
+                    with TELEGRAM_DOWNLOAD_SECONDS.time(mode='buffered'):
+                        await file.download(out=content)
+                    sha1 = await self._raise_on_duplicate(chat_id, chat_data, content)
+                    content.seek(0)
+                    uploaded_file = await provider.upload_stream(*upload_args, content, file_name, file_size, **upload_kwargs)
+        # The local provider doesn't hash what it copies with sendfile(), the bot's hash lets renamed copies be found then
+        return uploaded_file, getattr(uploaded_file, 'sha1', None) or sha1
+
+    async def _upload_file_spooled(self, chat_id, chat_data, provider, file, file_name, file_size, spool_key, upload_args, upload_kwargs):
+        # The download goes to disk and the upload reads it through mmap, a retry rewinds instead of downloading again
+        reserved_size = file.file_size or file_size or TELEGRAM_MAX_DOWNLOAD_SIZE
+        async with self.spool.spool(reserved_size, spool_key) as spooled:
+            if not spooled.complete:
+                # A kept file may hold the part of a download that failed
+                spooled.file.seek(0)
+                spooled.file.truncate()
+                with TELEGRAM_DOWNLOAD_SECONDS.time(mode='spooled'):
+                    await self.file_streamer.download_to(file, spooled.file, max_size=reserved_size)
+                spooled.complete = True
+            with MappedFile(spooled.file) as content:
+                sha1 = await self._raise_on_duplicate(chat_id, chat_data, content)
+                return await provider.upload_stream(*upload_args, content, file_name, file_size, **upload_kwargs), sha1
+
+    async def _raise_on_duplicate(self, chat_id: int, chat_data: dict, content: t.Union[io.BytesIO, MappedFile]) -> str:
+        # Renamed copies of a saved file only differ in name, the content hash still matches. Returns the hash.
+        sha1 = await self._run_in_thread(self._get_sha1, content)
+        duplicate = await self._find_duplicate(chat_id, chat_data, sha1=sha1)
+        if duplicate is not None:
+            raise DuplicateFileException(duplicate.id, duplicate.name)
+        return sha1
+
+    async def _upload_file_streaming(self, provider, file, file_name, file_size, upload_args, upload_kwargs):
+        # Telegram download and provider upload overlap, only `stream_buffer_size` bytes are buffered in between
+        pipe = StreamPipe(max_buffer_size=self.stream_buffer_size, size=file.file_size or file_size)
+
+        async def _upload():
+            try:
+                return await provider.upload_stream(*upload_args, pipe, file_name, file_size, **upload_kwargs)
+            finally:
+                pipe.close_read()
+
+        upload = asyncio.ensure_future(_upload())
+        try:
+            # Includes the time the download waited for the upload to drain the buffer
+            with TELEGRAM_DOWNLOAD_SECONDS.time(mode='streaming'):
+                await self.file_streamer.stream_to(file, pipe)
+        except BaseException:
+            # The upload task sees the aborted pipe and fails on its own, wait for it so the error isn't left unretrieved
+            await asyncio.gather(upload, return_exceptions=True)
+            raise
+        return await upload
+
+    async def _enqueue_upload(self, update: Update) -> int:
+        # The job row is the source of truth from here on, the upload survives restarts and provider outages
+        document = update.effective_message.document
+        return await self._run_in_thread(
+            self.upload_queue.enqueue,
+            update.effective_chat.id,
+            update.effective_message.message_id,
+            document.file_id,
+            self._get_file_name(document),
+            document.file_size,
+            self._get_caption_tags(update),
+            document.file_unique_id)
+
+    async def _prune_upload_jobs(self, context: CallbackContext) -> None:
+        pruned = await self._run_in_thread(self.upload_queue.prune)
+        if pruned > 0:
+            logger.info('Pruned %s failed upload jobs', pruned)
+
+    async def _drain_upload_queue(self, poll_interval: float = 30, error_delay: float = 5) -> None:
+        while True:
+            try:
+                # Cleared before claiming, so a job enqueued in between still wakes the worker up
+                self._upload_queue_event.clear()
+                job = await self._run_in_thread(self.upload_queue.claim)
+                if job is not None:
+                    try:
+                        await self._process_upload_job(job)
+                    except Exception as ex:
+                        # Errors of the upload itself are handled by the job, this is the store or the job's own bookkeeping
+                        logger.exception('Upload job %s of chat %s failed unexpectedly', job.id, job.chat_id)
+                        await self._run_in_thread(self.upload_queue.retry, job, str(ex))
+                    continue
+
+                next_due_in = await self._run_in_thread(self.upload_queue.next_due_in)
+                timeout = poll_interval if next_due_in is None else min(next_due_in, poll_interval)
+                try:
+                    await asyncio.wait_for(self._upload_queue_event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception:
+                # E.g. a locked or unavailable database, the worker must outlive it. Jobs left 'running' are recovered
+                # on the next start.
+                logger.exception('Upload queue worker failed, retrying in %ss', error_delay)
+                await asyncio.sleep(error_delay)
+
+    async def _process_upload_job(self, job: UploadJob) -> None:
+        with self._holding_chat(job.chat_id):
+            context = CallbackContext(self.application, chat_id=job.chat_id)
+            await context.refresh_data()
+            chat_data = context.chat_data
+            if 'access_token' not in chat_data:
+                await self._run_in_thread(self.upload_queue.fail, job.id, 'Chat is not registered')
+                return
+            # Unexpected errors are retried by `_drain_upload_queue`
+            retrying = True
+            try:
+                retrying = await self._run_upload_job(job, chat_data)
+            finally:
+                # No update handler runs for the chat to persist rotated tokens, also not after an upload that failed or
+                # was cancelled on shutdown
+                await self.application.persistence.update_chat_data(job.chat_id, dict(chat_data))
+                if not retrying and self.spool is not None:
+                    self.spool.discard(job.id)
+
+    async def _run_upload_job(self, job: UploadJob, chat_data: dict) -> bool:
+        # Returns whether the job is retried later
+        provider = self.providers.for_chat(chat_data)
+        try:
+            uploaded_file, sha1 = await self._upload_document(
+                job.chat_id,
+                chat_data,
+                job.telegram_file_id,
+                job.file_name,
+                job.file_size,
+                spool_key=job.id,
+                upload_session_id=job.upload_session_id,
+                on_upload_session=lambda upload_session_id: self.upload_queue.save_upload_session(job.id, upload_session_id))
+        except tgBadRequest as tg_exception:
+            await self._run_in_thread(self.upload_queue.fail, job.id, tg_exception.message)
+            if tg_exception.message == 'File is too big':
+                await self._reply_to_job(job, 'Sorry, but the file is too big. Bot supports files less than 20 Mb only.')
+            else:
+                await self._reply_to_job(job, f'Internal Telegram Error: {tg_exception.message}')
+            return False
+        except tgRetryAfter as tg_exception:
+            return await self._retry_upload_job(provider, job, tg_exception, tg_exception.retry_after)
+        except tgNetworkError as tg_exception:
+            return await self._retry_upload_job(provider, job, tg_exception)
+        except RetryableException as retryable_ex:
+            return await self._retry_upload_job(provider, job, retryable_ex, retryable_ex.retry_after)
+        except QuotaExceededException as quota_ex:
+            await self._run_in_thread(self.upload_queue.fail, job.id, f'File of {quota_ex.size} bytes exceeds the {quota_ex.limit} bytes budget')
+            await self._reply_to_job(job, self._get_upload_error_text(provider, quota_ex)[0])
+            return False
+        except DuplicateFileException as duplicate_ex:
+            await self._run_in_thread(self.upload_queue.complete, job.id)
+            await self._reply_to_job(job, self.get_duplicate_msg_text(provider, duplicate_ex.item_id, duplicate_ex.item_name), parse_mode=constants.ParseMode.MARKDOWN)
+            return False
+        except ItemNameInUseException as item_in_use_ex:
+            await self._run_in_thread(self.upload_queue.complete, job.id)
+            existing_file_link = provider.get_file_link(item_in_use_ex.item_id, item_in_use_ex.item_name)
+            await self._reply_to_job(job, f'File with the same name already exists: {existing_file_link}', parse_mode=constants.ParseMode.MARKDOWN)
+            return False
+        except Exception as ex:
+            logger.exception('Upload job %s of chat %s failed', job.id, job.chat_id)
+            await self._run_in_thread(self.upload_queue.fail, job.id, str(ex))
+            await self._reply_to_job(job, f'Internal Error: {ex}')
+            return False
+
+        await self._run_in_thread(self.upload_queue.complete, job.id)
+        await self._index_file(
+            job.chat_id,
+            uploaded_file.id,
+            uploaded_file.name,
+            job.file_size,
+            job.tags.split(),
+            sha1,
+            job.telegram_file_unique_id)
+        file_link = provider.get_file_link(uploaded_file.id, uploaded_file.name)
+        await self._reply_to_job(job, f'{file_link} is now in your {provider.name}', parse_mode=constants.ParseMode.MARKDOWN)
+        return False
+
+    async def _retry_upload_job(self, provider: BaseCloudProvider, job: UploadJob, error: Exception, retry_after: t.Optional[float] = None) -> bool:
+        delay = await self._run_in_thread(self.upload_queue.retry, job, str(error), retry_after)
+        if delay is None:
+            await self._reply_to_job(job, f'Sorry, {job.file_name} could not be uploaded to your {provider.name} after {job.attempts} attempts: {error}')
+            return False
+        logger.info('Upload job %s of chat %s retries in %.1fs: %s', job.id, job.chat_id, delay, error)
+        return True
+
+    async def _reply_to_job(self, job: UploadJob, text: str, parse_mode: t.Optional[str] = None) -> None:
+        try:
+            batch_entry = self._upload_batches.pop(job.id, None)
+            if batch_entry is not None:
+                batch, index = batch_entry
+                await batch.add_result(index, text, parse_mode)
+                return
+            await self.application.bot.send_message(
+                job.chat_id,
+                text,
+                parse_mode=parse_mode,
+                reply_to_message_id=job.message_id,
+                allow_sending_without_reply=True)
+        except Exception as ex:
+            # The upload itself is done (or given up on), a lost notification must not put the job back
+            logger.warning('Failed to notify chat %s about upload job %s: %s', job.chat_id, job.id, ex)
+
+    def _chat_handler(self, callback: t.Callable[[Update, CallbackContext], t.Awaitable[None]]):
+        # Runs the chat's updates one at a time, holding the chat's data meanwhile
+        @functools.wraps(callback)
+        async def _callback(update: Update, context: CallbackContext) -> None:
+            if update.effective_chat is None:
+                return await callback(update, context)
+            async with self._chat_lock(update.effective_chat.id):
+                with self._holding_chat(update.effective_chat.id):
+                    return await callback(update, context)
+        return _callback
+
+    @contextlib.asynccontextmanager
+    async def _chat_lock(self, chat_id: int) -> t.AsyncIterator[None]:
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_lock_users[chat_id] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            # Dropped with its last user, so there is only a lock for each chat with updates in flight
+            self._chat_lock_users[chat_id] -= 1
+            if self._chat_lock_users[chat_id] <= 0:
+                del self._chat_lock_users[chat_id]
+                del self._chat_locks[chat_id]
+
+    @contextlib.contextmanager
+    def _holding_chat(self, chat_id: int) -> t.Iterator[None]:
+        self._hold_chat(chat_id)
+        try:
+            yield
+        finally:
+            self._release_chat(chat_id)
+
+    def _hold_chat(self, chat_id: int) -> None:
+        # Keeps SqlitePersistence from unloading the chat's data while a handler, batch or job works with the dict
+        if isinstance(self.application.persistence, SqlitePersistence):
+            self.application.persistence.hold_chat(chat_id)
+
+    def _release_chat(self, chat_id: int) -> None:
+        if isinstance(self.application.persistence, SqlitePersistence):
+            self.application.persistence.release_chat(chat_id)
+
+    async def _run_in_thread(self, func, *args):
+        with THREAD_CALL_SECONDS.time(call=get_call_name(func)):
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _index_file(
+            self,
+            chat_id: int,
+            file_id: str,
+            file_name: str,
+            size: t.Optional[int] = None,
+            tags: t.Iterable[str] = (),
+            sha1: t.Optional[str] = None,
+            telegram_file_unique_id: t.Optional[str] = None) -> None:
+        if self.file_index is None:
+            return
+        try:
+            await self._run_in_thread(self.file_index.add, chat_id, file_id, file_name, size, tags, None, sha1, telegram_file_unique_id)
+        except Exception as ex:
+            # The index is only a cache of the provider, a failed write must not fail the upload itself
+            logger.warning('Failed to index file %s for chat %s: %s', file_id, chat_id, ex)
+
+    async def _index_files(self, chat_id: int, files: t.List[IndexedFile]) -> None:
+        if self.file_index is None or len(files) == 0:
+            return
+        try:
+            await self._run_in_thread(self.file_index.add_files, chat_id, files)
+        except Exception as ex:
+            logger.warning('Failed to index %s files for chat %s: %s', len(files), chat_id, ex)
+
+    async def _find_duplicate(
+            self,
+            chat_id: int,
+            chat_data: dict,
+            telegram_file_unique_id: t.Optional[str] = None,
+            sha1: t.Optional[str] = None) -> t.Optional[IndexedFile]:
+        if self.file_index is None:
+            return None
+        provider = self.providers.for_chat(chat_data)
+        while True:
+            try:
+                duplicate = await self._run_in_thread(self.file_index.find_duplicate, chat_id, telegram_file_unique_id, sha1)
+            except Exception as ex:
+                logger.warning('Failed to look up duplicates for chat %s: %s', chat_id, ex)
+                return None
+            if duplicate is None:
+                return None
+
+            # The user may have deleted the file in the provider since, its link would be a dead end
+            try:
+                exists = await provider.file_exists(
+                    chat_data['access_token'],
+                    chat_data['refresh_token'],
+                    duplicate.id,
+                    chat_id=chat_id,
+                    store_tokens=self._get_store_tokens_callback(chat_data))
+            except Exception as ex:
+                logger.warning('Failed to check duplicate %s of chat %s, assuming it still exists: %s', duplicate.id, chat_id, ex)
+                return duplicate
+            if exists:
+                return duplicate
+            # Dropped so the file is uploaded again, another copy in the index may still match
+            try:
+                await self._run_in_thread(self.file_index.remove, chat_id, duplicate.id)
+            except Exception as ex:
+                logger.warning('Failed to drop deleted file %s of chat %s from the index: %s', duplicate.id, chat_id, ex)
+                return None
+
+    @staticmethod
+    def _get_sha1(content: t.Union[io.BytesIO, MappedFile]) -> str:
+        with content.getbuffer() as buffer:
+            return hashlib.sha1(buffer).hexdigest()
+
+    @staticmethod
+    def _get_file_name(document: Document) -> str:
+        # Telegram doesn't always send a name, e.g. for documents sent through other bots or the Bot API
+        return document.file_name or f'file_{document.file_unique_id}'
+
+    @staticmethod
+    def _get_caption_tags(update: Update) -> t.List[str]:
+        caption = update.effective_message.caption or ''
+        return [word for word in caption.split() if word.startswith('#')]
+
+    async def _reconcile_file_index(self, context: CallbackContext) -> None:
+        # Walks a few registered chats per run, so the provider sees a bounded number of listing calls per interval
+        chat_ids = sorted(chat_id for chat_id, chat_data in self.application.chat_data.items() if 'access_token' in chat_data)
+        if len(chat_ids) == 0:
+            return
+        start = self._reconcile_cursor % len(chat_ids)
+        batch = (chat_ids[start:] + chat_ids[:start])[:self.reconcile_batch_size]
+        self._reconcile_cursor = start + len(batch)
+
+        for chat_id in batch:
+            chat_data = self.application.chat_data[chat_id]
+            # Unloaded while an earlier chat of the batch was listed
+            if 'access_token' not in chat_data:
+                continue
+            try:
+                with self._holding_chat(chat_id):
+                    files = await self._list_indexed_files(chat_id, chat_data)
+                await self._run_in_thread(self.file_index.replace_chat_files, chat_id, files)
+            except Exception as ex:
+                logger.warning('Failed to reconcile file index for chat %s: %s', chat_id, ex)
+
+    async def _list_indexed_files(self, chat_id: int, chat_data: dict) -> t.List[IndexedFile]:
+        items = await self.providers.for_chat(chat_data).list_files(
+            chat_data['access_token'],
+            chat_data['refresh_token'],
+            chat_data['box_folder_id'],
+            chat_id=chat_id,
+            store_tokens=self._get_store_tokens_callback(chat_data))
+        return [
+            IndexedFile(
+                item.id,
+                item.name,
+                getattr(item, 'size', None),
+                self._to_timestamp(getattr(item, 'created_at', None)),
+                ' '.join(getattr(item, 'tags', None) or []),
+                getattr(item, 'sha1', None))
+            for item in items]
+
+    @staticmethod
+    def _to_timestamp(value: t.Optional[str]) -> t.Optional[int]:
+        if value is None:
+            return None
+        return int(datetime.fromisoformat(value).timestamp())
+
+    def _get_store_tokens_callback(self, chat_data: dict, provider: t.Optional[BaseCloudProvider] = None):
+        # `provider` for a dict that only collects tokens and doesn't know the chat's provider
+        provider = provider if provider is not None else self.providers.for_chat(chat_data)
+
+        def _store_tokens(access_token, refresh_token) -> None:
+            # Box calls this with None values when the tokens get revoked, the user has to re-register then anyway
+            if access_token is None or refresh_token is None:
+                return
+            # A single update() so the persistence never sees a new access token paired with an old refresh token
+            chat_data.update({
+                'access_token': access_token,
+                'refresh_token': refresh_token,
+                'token_expires_ts': self._get_token_expiry(provider),
+            })
+        return _store_tokens
+
+    @staticmethod
+    def _get_token_expiry(provider: BaseCloudProvider) -> int:
+        # 0 keeps the chat out of the refresh job, NULL would leave an earlier expiry in place
+        if provider.access_token_ttl is None:
+            return 0
+        return int(time.time() + provider.access_token_ttl)
+
+    async def _refresh_expiring_tokens(self, context: CallbackContext) -> None:
+        now = time.time()
+        chats = await self.application.persistence.get_expiring_tokens(
+            int(now + self.token_refresh_margin),
+            int(now - self.token_refresh_inactive_after),
+            self.token_refresh_batch_size,
+            self.shard_index,
+            self.shard_count)
+        if len(chats) == 0:
+            return
+        semaphore = asyncio.Semaphore(self.token_refresh_concurrency)
+        refreshed = await asyncio.gather(*(self._refresh_chat_tokens(chat_id, tokens, semaphore) for chat_id, tokens in chats))
+        logger.info('Refreshed tokens of %s of %s chats', sum(refreshed), len(chats))
+
+    async def _refresh_chat_tokens(self, chat_id: int, tokens: dict, semaphore: asyncio.Semaphore) -> bool:
+        # The chat's data isn't loaded for this, the persistence writes the tokens to its row or to its loaded data
+        persistence = self.application.persistence
+        async with semaphore:
+            # A loaded chat may have rotated its tokens, or have been unloaded, since they were read
+            if 'access_token' not in tokens or (tokens.get('token_expires_ts') or 0) > time.time() + self.token_refresh_margin:
+                return False
+
+            provider = self.providers.for_chat(tokens)
+            refreshed_tokens = {}
+            store_tokens = self._get_store_tokens_callback(refreshed_tokens, provider)
+            try:
+                store_tokens(*await provider.refresh_tokens(tokens['access_token'], tokens['refresh_token'], chat_id=chat_id, store_tokens=store_tokens))
+            except RetryableException as retryable_ex:
+                # The next run picks the chat up again
+                TOKEN_REFRESHES.inc(outcome='retry')
+                logger.info('Token refresh of chat %s failed, retrying: %s', chat_id, retryable_ex.message)
+                return False
+            except InternalException as internal_ex:
+                # Mostly a revoked or already used refresh token, only registering again helps
+                TOKEN_REFRESHES.inc(outcome='failed')
+                logger.warning('Token refresh of chat %s failed: %s', chat_id, internal_ex.message)
+                await persistence.store_tokens(chat_id, {'token_expires_ts': 0})
+                return False
+
+            TOKEN_REFRESHES.inc(outcome='refreshed')
+            await persistence.store_tokens(chat_id, refreshed_tokens)
+            return True
+
+    async def send_register_link(self, update: Update, context: CallbackContext):
+        await update.message.reply_html('\n'.join(provider.get_registration_link() for provider in self.providers))
+
+    def get_success_registered_msg_text(self, provider: BaseCloudProvider, login: str, box_folder_id: str) -> str:
+        return  f'You\'ve been successfully registered with login {login}. I\'ve created a directory for savings called {provider.get_directory_link(box_folder_id, provider.directory_name)}'
+
+    def get_duplicate_msg_text(self, provider: BaseCloudProvider, file_id: str, file_name: str) -> str:
+        return f'This file is already in your {provider.name}: {provider.get_file_link(file_id, file_name)}'
+
+    def get_already_registered_msg_text(self, provider: BaseCloudProvider, login: str, box_folder_id: str) -> str:
+        return f'You\'ve been already registered with login {login}. The directory for savings called {provider.get_directory_link(box_folder_id, provider.directory_name)}'
+
+    async def _post_init(self, application: Application) -> None:
+        if self.metrics_server is not None:
+            self.metrics_server.listen(self.metrics_port, self.metrics_listen)
+            self._event_loop_lag_task = asyncio.create_task(sample_event_loop_lag())
+        if self.upload_queue is None:
+            return
+        recovered = await self._run_in_thread(self.upload_queue.recover)
+        if recovered > 0:
+            logger.info('Recovered %s interrupted upload jobs', recovered)
+        self._upload_queue_tasks = [asyncio.create_task(self._drain_upload_queue()) for _ in range(self.upload_workers)]
+
+    async def _stop_uploads(self) -> None:
+        # Batches and upload jobs persist rotated tokens as they end, so they have to end while the persistence still writes
+        if self.upload_batcher is not None:
+            await self.upload_batcher.shutdown()
+        for task in self._upload_queue_tasks:
+            task.cancel()
+        # A cancelled job stays 'running' in the store and is recovered on the next start
+        await asyncio.gather(*self._upload_queue_tasks, return_exceptions=True)
+        self._upload_queue_tasks = []
+
+    async def _shutdown(self, application: Application) -> None:
+        await self.file_streamer.shutdown()
+        if self._event_loop_lag_task is not None:
+            self._event_loop_lag_task.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.file_index is not None:
+            self.file_index.close()
+        if self.upload_queue is not None:
+            self.upload_queue.close()
+        for provider in self.providers:
+            await provider.shutdown()
+        self.executor.shutdown(wait=False)
+
+    def run(self):
+        # Not Application.run_polling(), its only hook after the updater stops runs once the persistence is already flushed
+        async def _serve() -> None:
+            await self.application.updater.start_polling()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await self.application.updater.stop()
+
+        self._run_application(_serve)
+
+    def run_webhook(
+            self,
+            webhook_url: str,
+            listen: str = '0.0.0.0',
+            port: int = 8000,
+            url_path: str = 'telegram',
+            callback_path: str = 'callback',
+            secret_token: t.Optional[str] = None,
+            exchange_code: bool = False) -> None:
+        server = WebhookServer(
+            self.application,
+            self.providers.oauth_provider,
+            self.bot_name,
+            url_path=url_path,
+            callback_path=callback_path,
+            secret_token=secret_token,
+            pending_authorizations=self.pending_authorizations if exchange_code else None)
+        full_webhook_url = f'{webhook_url.rstrip("/")}/{url_path.strip("/")}'
+
+        async def _serve() -> None:
+            await self.application.bot.set_webhook(url=full_webhook_url, secret_token=secret_token)
+            server.listen(port, listen)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+
+        self._run_application(_serve)
+
+    def run_worker(self, queue) -> None:
+        # Updates are fetched by the dispatcher process and arrive here as dicts through a multiprocessing queue
+        async def _serve() -> None:
+            loop = asyncio.get_running_loop()
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+        self._run_application(_serve)
+
+    def _run_application(self, serve: t.Callable[[], t.Awaitable[None]]) -> None:
+        try:
+            asyncio.run(self._serve_application(serve))
+        except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+            pass
+
+    async def _serve_application(self, serve: t.Callable[[], t.Awaitable[None]]) -> None:
+        # Same lifecycle as Application.run_polling, with `serve` feeding updates. Ctrl+C and SIGTERM cancel `serve`.
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await self.application.initialize()
+        try:
+            try:
+                await self._post_init(self.application)
+                await self.application.start()
+                await serve()
+            finally:
+                await self._stop_uploads()
+                if self.application.running:
+                    await self.application.stop()
+        finally:
+            await self.application.shutdown()
+            await self._shutdown(self.application)
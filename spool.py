@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import contextlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+import typing as t
+from pathlib import Path
+
+from exceptions import QuotaExceededException
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PREFIX = 'spool-'
+
+BUDGET_RESERVED_BYTES = REGISTRY.gauge('save_bot_budget_reserved_bytes', 'Bytes reserved by downloads in flight, by budget')
+BUDGET_WAIT_SECONDS = REGISTRY.histogram('save_bot_budget_wait_seconds', 'Time downloads waited for their bytes to be admitted, by budget')
+
+
+class ByteBudget:
+    # Admission control: a download only starts once its size fits into the budget, the others wait in arrival order
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self.reserved = 0
+        self._waiters: t.Deque[t.Tuple[int, asyncio.Future]] = collections.deque()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, size: int) -> t.AsyncIterator[None]:
+        await self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    @property
+    def waiting(self) -> bool:
+        return len(self._waiters) > 0
+
+    def fits(self, size: int) -> bool:
+        return not self._waiters and self.reserved + size <= self.limit
+
+    async def acquire(self, size: int) -> None:
+        # For reservations that outlive a block, every acquire() needs its release()
+        if size > self.limit:
+            raise QuotaExceededException(size, self.limit)
+        with BUDGET_WAIT_SECONDS.time(budget=self.name):
+            await self._acquire(size)
+
+    def release(self, size: int) -> None:
+        self._add(-size)
+        self._admit_waiters()
+
+    async def _acquire(self, size: int) -> None:
+        if self.fits(size):
+            self._add(size)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((size, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted right before the cancellation, the bytes are already counted
+                self.release(size)
+            else:
+                self._waiters.remove((size, waiter))
+                self._admit_waiters()
+            raise
+
+    def _admit_waiters(self) -> None:
+        # Strictly in order, so a large file isn't starved by a stream of small ones
+        while self._waiters and self.reserved + self._waiters[0][0] <= self.limit:
+            size, waiter = self._waiters.popleft()
+            self._add(size)
+            waiter.set_result(None)
+
+    def _add(self, size: int) -> None:
+        self.reserved += size
+        BUDGET_RESERVED_BYTES.set(self.reserved, budget=self.name)
+
+
+class MappedFile:
+    # Read-only view of a spooled file: reads come from the page cache, and parts are handed out as views instead of copies
+    def __init__(self, file: t.BinaryIO) -> None:
+        self._file = file
+        size = os.fstat(file.fileno()).st_size
+        # mmap() rejects empty files, an empty buffer reads the same
+        self._buffer = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) if size > 0 else b''
+        self._position = 0
+
+    def __enter__(self) -> 'MappedFile':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        return bytes(self.read_view(size))
+
+    def read_view(self, size: int = -1) -> memoryview:
+        # The view stays valid while it's referenced, a retried request sends the same pages again
+        end = len(self._buffer) if size is None or size < 0 else min(len(self._buffer), self._position + size)
+        view = memoryview(self._buffer)[self._position:end]
+        self._position = max(self._position, end)
+        return view
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._buffer)
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def fileno(self) -> int:
+        # Multipart encoders take the size from the descriptor, the local provider copies from it with sendfile()
+        return self._file.fileno()
+
+    def close(self) -> None:
+        if not isinstance(self._buffer, mmap.mmap):
+            return
+        try:
+            self._buffer.close()
+        except BufferError:
+            # A part view is still referenced (e.g. by a finished request), the mapping goes away with it
+            pass
+
+
+class SpooledFile:
+    # `complete` once a download was written to the file in full, a kept file that isn't has to be downloaded again
+    def __init__(self, path: Path, size: int) -> None:
+        self.path = path
+        self.size = size
+        self.complete = False
+        self.file: t.Optional[t.BinaryIO] = None
+        self.in_use = False
+
+
+class FileSpool:
+    # Downloads are written to temporary files under `directory`, which hold at most `quota` bytes at a time
+    def __init__(self, directory: str, quota: int) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.budget = ByteBudget('spool', quota)
+        # Files kept for a retry of their upload, least recently used first
+        self._kept: t.OrderedDict[t.Hashable, SpooledFile] = collections.OrderedDict()
+        self._remove_leftovers()
+
+    def _remove_leftovers(self) -> None:
+        # Files of a run that was killed mid-upload, nothing else uses the directory
+        for path in self.directory.glob(f'{SPOOL_PREFIX}*'):
+            path.unlink(missing_ok=True)
+            logger.info('Removed leftover spool file %s', path)
+
+    @contextlib.asynccontextmanager
+    async def spool(self, size: int, key: t.Optional[t.Hashable] = None) -> t.AsyncIterator[SpooledFile]:
+        # A file with a `key` outlives the block and counts against the quota until it's discarded, e.g. an upload job
+        # keeps its download for its retries. Without one it's removed right after.
+        spooled = self._kept.get(key) if key is not None else None
+        if spooled is None:
+            spooled = await self._create(size)
+            if key is not None:
+                self._kept[key] = spooled
+        else:
+            self._kept.move_to_end(key)
+
+        spooled.in_use = True
+        try:
+            with spooled.path.open('r+b') as file:
+                spooled.file = file
+                yield spooled
+        finally:
+            spooled.in_use = False
+            spooled.file = None
+            if key is None or self._kept.get(key) is not spooled:
+                self._remove(spooled)
+            elif self.budget.waiting:
+                # Other downloads wait for the quota, they go first and the retry downloads again
+                self.discard(key)
+
+    def discard(self, key: t.Hashable) -> None:
+        spooled = self._kept.pop(key, None)
+        # A file in use is removed once its block ends
+        if spooled is not None and not spooled.in_use:
+            self._remove(spooled)
+
+    async def _create(self, size: int) -> SpooledFile:
+        if size > self.budget.limit:
+            raise QuotaExceededException(size, self.budget.limit)
+        # Kept files only wait for a retry, a download that needs their space goes first
+        for key in [key for key, spooled in self._kept.items() if not spooled.in_use]:
+            if self.budget.fits(size):
+                break
+            self.discard(key)
+        await self.budget.acquire(size)
+        try:
+            fd, path = tempfile.mkstemp(dir=self.directory, prefix=SPOOL_PREFIX)
+            os.close(fd)
+        except BaseException:
+            self.budget.release(size)
+            raise
+        return SpooledFile(Path(path), size)
+
+    def _remove(self, spooled: SpooledFile) -> None:
+        spooled.path.unlink(missing_ok=True)
+        self.budget.release(spooled.size)
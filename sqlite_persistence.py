@@ -1,113 +1,319 @@
-from datetime import datetime
-import zoneinfo
-from typing import Any, DefaultDict, Dict, Optional
-from telegram.ext import BasePersistence, PersistenceInput
-from telegram.ext._utils.types import UD, CD
-import sqlite3
-
-
-def init_db(name: str = 'save_bot.db') -> None:
-    conn = sqlite3.connect(name)
-    cursor = conn.cursor()
-
-    cursor.execute('''CREATE TABLE chat_data
-        (id                INTEGER PRIMARY KEY     AUTOINCREMENT,
-         chat_id           INT     NOT NULL,
-         active            INT     NOT NULL,
-         registration_ts   INT, 
-         access_token      CHAR(500),
-         refresh_token     CHAR(500),
-         box_folder_id     CHAR(500));''')
-
-
-class SqlitePersistence(BasePersistence):
-    def __init__(self, name: str='save_bot.db'): 
-        super().__init__(
-            store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False),
-            update_interval=1)
-        self.conn = sqlite3.connect(name)
-        self.cursor = self.conn.cursor()
-
-    async def get_chat_data(self) -> DefaultDict[int, Any]:
-        data = self.cursor.execute('''SELECT * FROM chat_data''').fetchall()
-        chat_data = {x[1]: dict(zip(['id', 'chat_id', 'active', 'registration_ts', 'access_token', 'refresh_token', 'box_folder_id'], x)) for x in data}
-        return chat_data
-
-    async def update_chat_data(self, chat_id: int, data: CD) -> None:
-        if isinstance(data, dict) and len(data) > 0:
-            access_token = data['access_token']
-            refresh_token = data['refresh_token']
-            box_folder_id = data.get('box_folder_id', None)            
-
-            is_chat_data_exists = self._chat_data_exists(chat_id)
-            if is_chat_data_exists:
-                self.cursor.execute('''UPDATE chat_data
-                                       SET
-                                           access_token = ?,
-                                           refresh_token = ?,
-                                           box_folder_id = ?
-                                       WHERE
-                                           chat_id = ?''', (access_token, refresh_token, box_folder_id, chat_id))
-            else:
-                ts = int(datetime.now(tz=zoneinfo.ZoneInfo('UTC')).timestamp())
-                self.cursor.execute('''INSERT INTO chat_data
-                                           (chat_id, active, registration_ts, access_token, refresh_token, box_folder_id)
-                                       VALUES 
-                                           (?, 1, ?, ?, ?, ?)''',
-                    (chat_id, ts, access_token, refresh_token, box_folder_id))
-                
-            self.conn.commit()
-
-    def _chat_data_exists(self, chat_id):
-        row = self.cursor.execute('''SELECT EXISTS(SELECT * FROM chat_data WHERE chat_id = ?)''', (chat_id,)).fetchone()
-        return row[0] > 0
-
-    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
-        if isinstance(chat_data, dict):
-            data = self.cursor.execute('''SELECT * FROM chat_data WHERE chat_id = ?''', (chat_id, )).fetchone()
-            if data is not None:
-                record = dict(zip(['id', 'chat_id', 'active', 'registration_ts', 'access_token', 'refresh_token', 'box_folder_id'], data))
-                chat_data.update(record)
-
-    async def drop_chat_data(self, chat_id: int) -> None:
-        self.cursor.execute('''DELETE FROM chat_data WHERE chat_id = ?''', (chat_id, ))
-        self.conn.commit()
-    
-    async def get_bot_data(self) -> Any:
-        pass
-
-    def update_bot_data(self, data) -> None:
-        pass
-
-    def refresh_bot_data(self, bot_data) -> None:
-        pass
-
-    def get_user_data(self) -> DefaultDict[int, Any]:
-        pass
-
-    def update_user_data(self, user_id: int, data: Any) -> None:
-        pass
-
-    def refresh_user_data(self, user_id: int, user_data: Any) -> None:
-        pass
-
-    def get_callback_data(self) -> Optional[Any]:
-        pass
-
-    def update_callback_data(self, data: Any) -> None:
-        pass
-
-    def get_conversations(self, name: str) -> Any:
-        pass
-
-    def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
-        pass
-
-    def flush(self) -> None:
-        self.conn.close()  
-
-    async def drop_user_data(self, user_id: int) -> None:
-        pass
-
-    async def get_user_data(self) -> Dict[int, UD]:
+import asyncio
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import zoneinfo
+import typing as t
+from typing import Any, DefaultDict, Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import UD, CD
+import sqlite3
+
+from db_schema import migrate_table
+from metrics import REGISTRY, get_call_name
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = REGISTRY.histogram('save_bot_sqlite_flush_seconds', 'Duration of chat data flushes, one transaction each')
+FLUSHED_ROWS = REGISTRY.counter('save_bot_sqlite_flushed_rows_total', 'Chat data rows written or deleted by flushes')
+READ_SECONDS = REGISTRY.histogram('save_bot_sqlite_read_seconds', 'Duration of chat data reads, including the wait for the reader thread')
+
+CHAT_DATA_COLUMNS = ['access_token', 'refresh_token', 'box_folder_id', 'provider', 'token_expires_ts']
+
+SELECT_CHAT_DATA = '''SELECT access_token, refresh_token, box_folder_id, provider, token_expires_ts FROM chat_data WHERE chat_id = ? AND active = 1'''
+
+# A NULL `last_active_ts` leaves the chat's last activity as it is, for writes no update of the chat caused
+UPSERT_CHAT_DATA = '''INSERT INTO chat_data
+                          (chat_id, active, registration_ts, access_token, refresh_token, box_folder_id, provider, token_expires_ts, last_active_ts)
+                      VALUES
+                          (?, 1, ?, ?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(chat_id) DO UPDATE SET
+                          access_token = COALESCE(excluded.access_token, access_token),
+                          refresh_token = COALESCE(excluded.refresh_token, refresh_token),
+                          box_folder_id = COALESCE(excluded.box_folder_id, box_folder_id),
+                          provider = COALESCE(excluded.provider, provider),
+                          token_expires_ts = COALESCE(excluded.token_expires_ts, token_expires_ts),
+                          last_active_ts = COALESCE(excluded.last_active_ts, last_active_ts)'''
+
+TOKEN_COLUMNS = ['access_token', 'refresh_token', 'provider', 'token_expires_ts']
+
+# 0 marks tokens that don't expire or can't be refreshed anymore, NULL ones of chats that haven't rotated their tokens yet.
+# SQLite keeps the sign of the dividend in %, normalize so negative (group) chat ids shard like in Python.
+SELECT_EXPIRING_TOKENS = '''SELECT chat_id, access_token, refresh_token, provider, token_expires_ts FROM chat_data
+                            WHERE active = 1 AND token_expires_ts BETWEEN 1 AND ?
+                                AND COALESCE(last_active_ts, registration_ts) >= ?
+                                AND ((chat_id % ?) + ?) % ? = ?
+                            ORDER BY token_expires_ts
+                            LIMIT ?'''
+
+UPDATE_TOKENS = '''UPDATE chat_data SET
+                       access_token = COALESCE(?, access_token),
+                       refresh_token = COALESCE(?, refresh_token),
+                       token_expires_ts = COALESCE(?, token_expires_ts)
+                   WHERE chat_id = ? AND active = 1'''
+
+DELETE_CHAT_DATA = '''DELETE FROM chat_data WHERE chat_id = ?'''
+
+# Marks a pending drop_chat_data in the writer queue
+_DROPPED = object()
+
+
+def _prepare_db(conn: sqlite3.Connection) -> None:
+    conn.execute('''PRAGMA journal_mode=WAL''')
+    migrate_table(conn, 'chat_data')
+
+
+def _connect(name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(name, check_same_thread=False, timeout=30, cached_statements=64)
+    conn.execute('''PRAGMA synchronous=NORMAL''')
+    conn.execute('''PRAGMA busy_timeout=30000''')
+    return conn
+
+
+class _ChatDataWriter(threading.Thread):
+    # Owns the only writing connection, every wake-up turns all dirty chats into a single transaction
+    def __init__(self, name: str, flush_delay: float) -> None:
+        super().__init__(name='sqlite-persistence-writer', daemon=True)
+        self.flush_delay = flush_delay
+        self.conn = _connect(name)
+        self.flushes = 0
+        self.rows_written = 0
+
+        self._pending: Dict[int, Any] = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def put(self, chat_id: int, row: Any) -> bool:
+        # Returns False once the writer is stopped, nothing would write the row anymore
+        with self._condition:
+            if self._stopped:
+                return False
+            self._pending[chat_id] = row
+            self._condition.notify_all()
+            return True
+
+    def is_pending(self, chat_id: int) -> bool:
+        with self._condition:
+            return chat_id in self._pending
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending and self._stopped:
+                    break
+            # Give the rest of the current update_persistence run a moment to add its chats to the same batch
+            if self.flush_delay > 0:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._stopped, timeout=self.flush_delay)
+            with self._condition:
+                batch, self._pending = self._pending, {}
+            self._write(batch)
+        self.conn.close()
+
+    def _write(self, batch: Dict[int, Any]) -> None:
+        upserts = [row for row in batch.values() if row is not _DROPPED]
+        deletes = [(chat_id,) for chat_id, row in batch.items() if row is _DROPPED]
+        started_at = time.perf_counter()
+        try:
+            with self.conn:
+                if upserts:
+                    self.conn.executemany(UPSERT_CHAT_DATA, upserts)
+                if deletes:
+                    self.conn.executemany(DELETE_CHAT_DATA, deletes)
+            self.flushes += 1
+            self.rows_written += len(batch)
+            FLUSH_SECONDS.observe(time.perf_counter() - started_at)
+            FLUSHED_ROWS.inc(len(batch))
+        except sqlite3.Error as ex:
+            logger.error('Failed to write %s chats to the persistence, retrying on the next flush: %s', len(batch), ex)
+            with self._condition:
+                for chat_id, row in batch.items():
+                    self._pending.setdefault(chat_id, row)
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self.join()
+
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, name: str='save_bot.db', flush_delay: float = 0.05, max_loaded_chats: int = 10000, min_idle_time: float = 5 * 60): 
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False),
+            update_interval=1)
+        self.name = name
+        self.conn = _connect(name)
+        _prepare_db(self.conn)
+        # Reads share one connection, so they are serialized on their own thread instead of blocking the event loop
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-persistence-reader')
+        self._writer = _ChatDataWriter(name, flush_delay)
+        self._writer.start()
+        # Chats are loaded on their first update and the least recently used ones are unloaded again, once they have been
+        # idle for `min_idle_time` seconds and no upload, batch or job holds their data
+        self.max_loaded_chats = max_loaded_chats
+        self.min_idle_time = min_idle_time
+        self._loaded_chats: t.OrderedDict[int, dict] = collections.OrderedDict()
+        self._last_used: Dict[int, float] = {}
+        self._held_chats: t.Counter[int] = collections.Counter()
+
+    def stats(self) -> t.Dict[str, int]:
+        return {
+            'flushes': self._writer.flushes,
+            'rows_written': self._writer.rows_written,
+            'loaded_chats': len(self._loaded_chats),
+        }
+
+    async def _read(self, func, *args) -> Any:
+        with READ_SECONDS.time(call=get_call_name(func)):
+            return await asyncio.get_running_loop().run_in_executor(self._reader, func, *args)
+
+    async def get_chat_data(self) -> DefaultDict[int, Any]:
+        # Nothing is read at startup, refresh_chat_data loads every chat on demand
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: CD) -> None:
+        if isinstance(data, dict) and len(data) > 0:
+            self._put(chat_id, self._to_row(chat_id, data, active=True))
+
+    @staticmethod
+    def _to_row(chat_id: int, data: dict, active: bool) -> t.Tuple:
+        ts = int(datetime.now(tz=zoneinfo.ZoneInfo('UTC')).timestamp())
+        return (
+            chat_id,
+            ts,
+            data.get('access_token'),
+            data.get('refresh_token'),
+            data.get('box_folder_id'),
+            data.get('provider'),
+            data.get('token_expires_ts'),
+            ts if active else None)
+
+    def _put(self, chat_id: int, row: Any) -> None:
+        if not self._writer.put(chat_id, row):
+            # A bug in the shutdown order, e.g. a task still running after flush(). The chat may lose rotated tokens.
+            logger.error('Chat data of chat %s changed after the persistence was flushed, the change is lost', chat_id)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        if not isinstance(chat_data, dict):
+            return
+
+        self._last_used[chat_id] = time.monotonic()
+        if chat_id in self._loaded_chats:
+            self._loaded_chats.move_to_end(chat_id)
+            return
+
+        # In-memory data of a chat waiting for the writer is newer than its row
+        if not self._writer.is_pending(chat_id):
+            data = await self._read(lambda: self.conn.execute(SELECT_CHAT_DATA, (chat_id, )).fetchone())
+            if data is not None:
+                record = dict(zip(CHAT_DATA_COLUMNS, data))
+                chat_data.update(record)
+
+        self._loaded_chats[chat_id] = chat_data
+        self._evict_idle_chats()
+
+    async def get_expiring_tokens(
+            self,
+            expires_before: int,
+            active_after: int,
+            limit: int,
+            shard_index: int = 0,
+            shard_count: int = 1) -> t.List[t.Tuple[int, dict]]:
+        # Chats inactive since `active_after` are skipped, their refresh token is only used again once they come back
+        rows = await self._read(
+            lambda: self.conn.execute(
+                SELECT_EXPIRING_TOKENS,
+                (expires_before, active_after, shard_count, shard_count, shard_count, shard_index, limit)).fetchall())
+        # Loaded chats come with their live data, they may have rotated their tokens since they were written
+        return [(chat_id, self._loaded_chats.get(chat_id) or dict(zip(TOKEN_COLUMNS, values))) for chat_id, *values in rows]
+
+    async def store_tokens(self, chat_id: int, tokens: dict) -> None:
+        # Tokens refreshed outside of an update of the chat: neither loads the chat nor counts as its activity
+        if chat_id not in self._loaded_chats:
+            # On the reader thread, which also orders the write with loads of the chat
+            await self._read(self._update_tokens, chat_id, tokens)
+        # Loaded meanwhile (from the old row, if the load read first) or before, the in-memory data would win
+        chat_data = self._loaded_chats.get(chat_id)
+        if chat_data is not None:
+            chat_data.update(tokens)
+            self._put(chat_id, self._to_row(chat_id, chat_data, active=False))
+
+    def _update_tokens(self, chat_id: int, tokens: dict) -> None:
+        with self.conn:
+            self.conn.execute(UPDATE_TOKENS, (tokens.get('access_token'), tokens.get('refresh_token'), tokens.get('token_expires_ts'), chat_id))
+
+    def hold_chat(self, chat_id: int) -> None:
+        # Code using a chat's data outside of its update handler holds the chat, so the dict isn't emptied under it
+        self._held_chats[chat_id] += 1
+
+    def release_chat(self, chat_id: int) -> None:
+        self._held_chats[chat_id] -= 1
+        if self._held_chats[chat_id] <= 0:
+            del self._held_chats[chat_id]
+        if chat_id in self._loaded_chats:
+            self._loaded_chats.move_to_end(chat_id)
+            self._last_used[chat_id] = time.monotonic()
+
+    def _evict_idle_chats(self) -> None:
+        # Unloading empties the dict the application holds for the chat, the next update of the chat loads it again
+        unload_before = time.monotonic() - self.min_idle_time
+        for chat_id in list(self._loaded_chats):
+            # Chats are ordered by their last use, the rest have been used more recently
+            if len(self._loaded_chats) <= self.max_loaded_chats or self._last_used.get(chat_id, 0) > unload_before:
+                break
+            if self._writer.is_pending(chat_id) or chat_id in self._held_chats:
+                continue
+            self._loaded_chats.pop(chat_id).clear()
+            self._last_used.pop(chat_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded_chats.pop(chat_id, None)
+        self._last_used.pop(chat_id, None)
+        self._put(chat_id, _DROPPED)
+    
+    async def get_bot_data(self) -> Any:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        pass
+
+    def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    def get_user_data(self) -> DefaultDict[int, Any]:
+        pass
+
+    def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    def get_callback_data(self) -> Optional[Any]:
+        pass
+
+    def update_callback_data(self, data: Any) -> None:
+        pass
+
+    def get_conversations(self, name: str) -> Any:
+        pass
+
+    def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.stop)
+        self._reader.shutdown(wait=True)
+        self.conn.close()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def get_user_data(self) -> Dict[int, UD]:
         pass
\ No newline at end of file
@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import contextlib
+import io
+import threading
+import typing as t
+from pathlib import Path
+
+import httpx
+from telegram import File as TelegramFile
+
+from exceptions import PipeClosedException
+
+
+class StreamPipe:
+    # Read side is a blocking file-like object for provider threads, write side is async for the event loop. A full pipe
+    # makes the writer wait on the loop, a parked thread per waiting stream would starve the default executor.
+    def __init__(self, max_buffer_size: int = 4 * 1024 * 1024, size: t.Optional[int] = None) -> None:
+        self.max_buffer_size = max_buffer_size
+        self.size = size
+
+        self._chunks: t.Deque[bytes] = collections.deque()
+        self._buffered = 0
+        self._condition = threading.Condition()
+        self._eof = False
+        self._error: t.Optional[BaseException] = None
+        self._reader_closed = False
+        self._position = 0
+        self._writer_waiter: t.Optional[t.Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = None
+
+    def _try_put(self, chunk: bytes) -> bool:
+        with self._condition:
+            if self._reader_closed:
+                raise PipeClosedException()
+            # A single chunk is always accepted into an empty buffer, otherwise big chunks would block forever
+            if self._buffered > 0 and self._buffered + len(chunk) > self.max_buffer_size:
+                return False
+            self._chunks.append(chunk)
+            self._buffered += len(chunk)
+            self._condition.notify_all()
+            return True
+
+    async def write(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._try_put(chunk):
+                    return
+                # Registered under the lock, so a read right after can't miss it
+                waiter = loop.create_future()
+                self._writer_waiter = (loop, waiter)
+            await waiter
+
+    def _wake_writer(self) -> None:
+        # Called by the reader with the condition held
+        if self._writer_waiter is None:
+            return
+        loop, waiter = self._writer_waiter
+        self._writer_waiter = None
+        # The loop is gone once the writer was cancelled on shutdown
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(_set_waiter_result, waiter)
+
+    def close_write(self) -> None:
+        with self._condition:
+            self._eof = True
+            self._condition.notify_all()
+
+    def abort(self, error: BaseException) -> None:
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def close_read(self) -> None:
+        with self._condition:
+            self._reader_closed = True
+            self._chunks.clear()
+            self._buffered = 0
+            self._condition.notify_all()
+            self._wake_writer()
+
+    def read(self, size: int = -1) -> bytes:
+        with self._condition:
+            if size is None or size < 0:
+                while not self._eof and self._error is None:
+                    self._condition.wait()
+                self._raise_on_error()
+                data = b''.join(self._chunks)
+                self._chunks.clear()
+                self._buffered = 0
+                self._position += len(data)
+                self._condition.notify_all()
+                self._wake_writer()
+                return data
+
+            while not self._chunks and not self._eof and self._error is None:
+                self._condition.wait()
+            self._raise_on_error()
+
+            parts = []
+            remaining = size
+            while self._chunks and remaining > 0:
+                chunk = self._chunks.popleft()
+                if len(chunk) > remaining:
+                    self._chunks.appendleft(chunk[remaining:])
+                    chunk = chunk[:remaining]
+                parts.append(chunk)
+                remaining -= len(chunk)
+            data = b''.join(parts)
+            self._buffered -= len(data)
+            self._position += len(data)
+            self._condition.notify_all()
+            self._wake_writer()
+            return data
+
+    def tell(self) -> int:
+        return self._position
+
+    @property
+    def len(self) -> t.Optional[int]:
+        # Bytes left to read, multipart encoders (the Box SDK's among them) need it up front for the Content-Length
+        return self.size - self._position if self.size is not None else None
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # The Box SDK rewinds every request body to where it started, which for a pipe only works before a retry
+        if (whence == io.SEEK_SET and offset == self._position) or (whence == io.SEEK_CUR and offset == 0):
+            return self._position
+        raise io.UnsupportedOperation('A stream pipe can only be read once')
+
+    def _raise_on_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+
+def _set_waiter_result(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class TelegramFileStreamer:
+    def __init__(self, chunk_size: int = 256 * 1024) -> None:
+        self.chunk_size = chunk_size
+        self._client: t.Optional[httpx.AsyncClient] = None
+
+    async def stream_to(self, file: TelegramFile, pipe: StreamPipe) -> None:
+        try:
+            async with contextlib.aclosing(self._iter_chunks(file)) as chunks:
+                async for chunk in chunks:
+                    await pipe.write(chunk)
+        except PipeClosedException:
+            # The consumer gave up (e.g. the provider rejected the upload), its error is reported by the upload task
+            return
+        except BaseException as ex:
+            pipe.abort(ex)
+            raise
+        pipe.close_write()
+
+    async def download_to(self, file: TelegramFile, out: t.BinaryIO, max_size: t.Optional[int] = None) -> int:
+        # Written chunk by chunk, File.download() would hold the whole file in memory first
+        loop = asyncio.get_running_loop()
+        written = 0
+        async with contextlib.aclosing(self._iter_chunks(file)) as chunks:
+            async for chunk in chunks:
+                written += len(chunk)
+                if max_size is not None and written > max_size:
+                    raise ValueError(f'File is larger than the {max_size} bytes reserved for it')
+                await loop.run_in_executor(None, out.write, chunk)
+        await loop.run_in_executor(None, out.flush)
+        return written
+
+    async def _iter_chunks(self, file: TelegramFile) -> t.AsyncIterator[bytes]:
+        local_path = Path(file.file_path)
+        if local_path.is_file():
+            loop = asyncio.get_running_loop()
+            with local_path.open('rb') as local_file:
+                while True:
+                    chunk = await loop.run_in_executor(None, local_file.read, self.chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        # requests is only imported for this, and not at all by bots that only use the local provider
+        from requests.utils import requote_uri
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(30.0))
+        async with self._client.stream('GET', requote_uri(file.file_path)) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                yield chunk
+
+    async def shutdown(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+import typing as t
+
+from telegram import Message, constants
+from telegram.error import TelegramError
+from telegram.helpers import escape_markdown
+
+logger = logging.getLogger(__name__)
+
+
+class UploadBatch:
+    # One status message per batch, edited as files finish instead of two replies per file
+    def __init__(self, chat_id: int, file_names: t.Sequence[str], provider_name: str, edit_interval: float = 2.0) -> None:
+        self.chat_id = chat_id
+        self.file_names = list(file_names)
+        self.provider_name = provider_name
+        self.edit_interval = edit_interval
+        self.status_message: t.Optional[Message] = None
+        self._results: t.Dict[int, str] = {}
+        self._last_edit = 0.0
+        self._edit_lock = asyncio.Lock()
+
+    @property
+    def done(self) -> bool:
+        return len(self._results) == len(self.file_names)
+
+    def render(self) -> str:
+        if self.done:
+            header = f'{len(self.file_names)} files processed for your {self.provider_name}:'
+        else:
+            header = f'Uploading {len(self.file_names)} files to your {self.provider_name}, {len(self._results)} done:'
+        lines = [header]
+        for index, file_name in enumerate(self.file_names):
+            lines.append(f'- {self._results.get(index, escape_markdown(file_name) + " ...")}')
+
+        text = '\n'.join(lines)
+        if len(text) > constants.MessageLimit.TEXT_LENGTH:
+            text = text[:constants.MessageLimit.TEXT_LENGTH - 3] + '...'
+        return text
+
+    async def send(self, reply_to: Message) -> None:
+        self.status_message = await reply_to.reply_markdown(self.render())
+        self._last_edit = time.monotonic()
+
+    async def add_result(self, index: int, text: str, parse_mode: t.Optional[str] = None) -> None:
+        # The status message is Markdown, plain texts such as error messages are escaped first
+        self._results[index] = text if parse_mode is not None else escape_markdown(text)
+        await self._edit()
+
+    async def _edit(self) -> None:
+        if self.status_message is None:
+            return
+        async with self._edit_lock:
+            # Progress edits are throttled, the final state is always shown
+            if not self.done and time.monotonic() - self._last_edit < self.edit_interval:
+                return
+            self._last_edit = time.monotonic()
+            try:
+                await self.status_message.edit_text(self.render(), parse_mode=constants.ParseMode.MARKDOWN)
+            except TelegramError as ex:
+                # Flood control or a network error only costs this edit, the uploads go on and a later edit catches up
+                logger.warning('Failed to edit batch status message in chat %s: %s', self.chat_id, ex.message)
+
+
+class UploadBatcher:
+    # Documents of a chat arriving within `window` seconds of the first one (a media group, a burst of forwards) form one batch
+    def __init__(
+            self,
+            on_batch: t.Callable[[int, t.List[t.Any]], t.Awaitable[None]],
+            window: float = 1.0,
+            max_size: int = 50) -> None:
+        self.on_batch = on_batch
+        self.window = window
+        self.max_size = max_size
+        self._pending: t.Dict[int, t.Tuple[t.List[t.Any], asyncio.TimerHandle]] = {}
+        self._tasks: t.Set[asyncio.Task] = set()
+        # Set on shutdown, documents arriving after that are uploaded on their own
+        self.closed = False
+
+    def add(self, chat_id: int, item: t.Any) -> None:
+        if chat_id not in self._pending:
+            timer = asyncio.get_running_loop().call_later(self.window, self._flush, chat_id)
+            self._pending[chat_id] = ([], timer)
+        items, _ = self._pending[chat_id]
+        items.append(item)
+        if len(items) >= self.max_size:
+            self._flush(chat_id)
+
+    def _flush(self, chat_id: int) -> None:
+        pending = self._pending.pop(chat_id, None)
+        if pending is None:
+            return
+        items, timer = pending
+        timer.cancel()
+        task = asyncio.create_task(self._run_batch(chat_id, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, chat_id: int, items: t.List[t.Any]) -> None:
+        try:
+            await self.on_batch(chat_id, items)
+        except Exception:
+            logger.exception('Upload batch of chat %s failed', chat_id)
+
+    async def shutdown(self) -> None:
+        self.closed = True
+        for _, timer in self._pending.values():
+            timer.cancel()
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
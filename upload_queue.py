@@ -0,0 +1,150 @@
+import random
+import sqlite3
+import threading
+import time
+import typing as t
+
+from db_schema import migrate_table
+from metrics import REGISTRY
+
+UPLOAD_JOBS = REGISTRY.counter('save_bot_upload_jobs_total', 'Upload jobs by how an attempt ended')
+
+
+class UploadJob(t.NamedTuple):
+    id: int
+    chat_id: int
+    message_id: t.Optional[int]
+    telegram_file_id: str
+    telegram_file_unique_id: t.Optional[str]
+    file_name: str
+    file_size: t.Optional[int]
+    tags: str
+    attempts: int
+    upload_session_id: t.Optional[str]
+
+
+class UploadJobStore:
+    # SQLite keeps the sign of the dividend in %, normalize so negative (group) chat ids shard like in Python
+    _SHARD_FILTER = '((chat_id % ?) + ?) % ? = ?'
+
+    def __init__(
+            self,
+            name: str = 'save_bot.db',
+            max_attempts: int = 8,
+            base_delay: float = 2.0,
+            max_delay: float = 15 * 60,
+            shard_index: int = 0,
+            shard_count: int = 1,
+            failed_retention: float = 7 * 24 * 60 * 60) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Failed jobs stay for inspection this many seconds after they were enqueued, then prune() deletes them
+        self.failed_retention = failed_retention
+        # In workers mode every process only touches the jobs of the chats sharded to it
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+        self.conn = sqlite3.connect(name, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        migrate_table(self.conn, 'upload_jobs')
+
+    def enqueue(
+            self,
+            chat_id: int,
+            message_id: t.Optional[int],
+            telegram_file_id: str,
+            file_name: str,
+            file_size: t.Optional[int],
+            tags: t.Iterable[str] = (),
+            telegram_file_unique_id: t.Optional[str] = None) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self.conn.execute('''INSERT INTO upload_jobs
+                                              (chat_id, message_id, telegram_file_id, telegram_file_unique_id, file_name, file_size, tags, next_attempt_ts, created_ts)
+                                          VALUES
+                                              (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (chat_id, message_id, telegram_file_id, telegram_file_unique_id, file_name, file_size, ' '.join(tags), now, int(now)))
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def recover(self) -> int:
+        # Jobs that were running when the process died are picked up again on start
+        with self._lock:
+            cursor = self.conn.execute(f'''UPDATE upload_jobs SET status = 'pending' WHERE status = 'running' AND {self._SHARD_FILTER}''', self._shard_params())
+            self.conn.commit()
+            return cursor.rowcount
+
+    def claim(self) -> t.Optional[UploadJob]:
+        with self._lock:
+            row = self.conn.execute(f'''UPDATE upload_jobs
+                                       SET status = 'running', attempts = attempts + 1
+                                       WHERE id = (SELECT id FROM upload_jobs
+                                                   WHERE status = 'pending' AND next_attempt_ts <= ? AND {self._SHARD_FILTER}
+                                                   ORDER BY next_attempt_ts, id
+                                                   LIMIT 1)
+                                       RETURNING id, chat_id, message_id, telegram_file_id, telegram_file_unique_id, file_name, file_size, tags, attempts, upload_session_id''',
+                (time.time(), *self._shard_params())).fetchone()
+            self.conn.commit()
+        return UploadJob(*row) if row is not None else None
+
+    def next_due_in(self) -> t.Optional[float]:
+        with self._lock:
+            row = self.conn.execute(f'''SELECT MIN(next_attempt_ts) FROM upload_jobs WHERE status = 'pending' AND {self._SHARD_FILTER}''', self._shard_params()).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def save_upload_session(self, job_id: int, upload_session_id: t.Optional[str]) -> None:
+        with self._lock:
+            self.conn.execute('''UPDATE upload_jobs SET upload_session_id = ? WHERE id = ?''', (upload_session_id, job_id))
+            self.conn.commit()
+
+    def complete(self, job_id: int) -> None:
+        with self._lock:
+            self.conn.execute('''DELETE FROM upload_jobs WHERE id = ?''', (job_id, ))
+            self.conn.commit()
+        UPLOAD_JOBS.inc(outcome='completed')
+
+    def retry(self, job: UploadJob, error: str, retry_after: t.Optional[float] = None) -> t.Optional[float]:
+        # Returns the delay before the next attempt, or None once the job has used up its attempts
+        if job.attempts >= self.max_attempts:
+            self.fail(job.id, error)
+            return None
+
+        # Full jitter keeps many throttled jobs from coming back at the same moment
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** job.attempts))
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.base_delay)
+        with self._lock:
+            self.conn.execute('''UPDATE upload_jobs
+                                 SET status = 'pending', next_attempt_ts = ?, last_error = ?
+                                 WHERE id = ?''', (time.time() + delay, error, job.id))
+            self.conn.commit()
+        UPLOAD_JOBS.inc(outcome='retried')
+        return delay
+
+    def fail(self, job_id: int, error: str) -> None:
+        with self._lock:
+            self.conn.execute('''UPDATE upload_jobs SET status = 'failed', last_error = ? WHERE id = ?''', (error, job_id))
+            self.conn.commit()
+        UPLOAD_JOBS.inc(outcome='failed')
+
+    def prune(self) -> int:
+        # A job fails within a few hours of being enqueued, `created_ts` is close enough to when it failed
+        with self._lock:
+            cursor = self.conn.execute(f'''DELETE FROM upload_jobs WHERE status = 'failed' AND created_ts < ? AND {self._SHARD_FILTER}''',
+                (int(time.time() - self.failed_retention), *self._shard_params()))
+            self.conn.commit()
+            return cursor.rowcount
+
+    def stats(self) -> t.Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute('''SELECT status, COUNT(*) FROM upload_jobs GROUP BY status''').fetchall()
+        return dict(rows)
+
+    def _shard_params(self) -> t.Tuple[int, int, int, int]:
+        return self.shard_count, self.shard_count, self.shard_count, self.shard_index
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,159 @@
+import collections
+import json
+import logging
+import secrets
+import statistics
+import time
+import typing as t
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+from base_cloud_provider import BaseCloudProvider
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_REQUEST_SECONDS = REGISTRY.histogram('save_bot_webhook_request_seconds', 'Duration of webhook server requests')
+
+
+class PendingAuthorizations:
+    # OAuth codes are exchanged right on the redirect, the tokens wait here until the user presses "Start" in Telegram
+    def __init__(self, ttl: float = 10 * 60) -> None:
+        self.ttl = ttl
+        self._tokens: t.Dict[str, t.Tuple[float, t.Tuple[str, str]]] = {}
+
+    def add(self, tokens: t.Tuple[str, str]) -> str:
+        self._evict_expired()
+        nonce = secrets.token_urlsafe(16)
+        self._tokens[nonce] = (time.monotonic(), tokens)
+        return nonce
+
+    def pop(self, nonce: str) -> t.Optional[t.Tuple[str, str]]:
+        self._evict_expired()
+        entry = self._tokens.pop(nonce, None)
+        return entry[1] if entry is not None else None
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        for nonce in [nonce for nonce, (created_at, _) in self._tokens.items() if now - created_at > self.ttl]:
+            del self._tokens[nonce]
+
+
+class RequestLatencies:
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._latencies: t.DefaultDict[str, t.Deque[float]] = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        self._counts: t.Counter[str] = collections.Counter()
+
+    def observe(self, route: str, seconds: float) -> None:
+        self._latencies[route].append(seconds)
+        self._counts[route] += 1
+
+    def summary(self) -> t.Dict[str, t.Dict[str, float]]:
+        result = {}
+        for route, latencies in self._latencies.items():
+            ordered = sorted(latencies)
+            result[route] = {
+                'count': self._counts[route],
+                'p50_ms': statistics.median(ordered) * 1000,
+                'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return result
+
+
+class TelegramUpdateHandler(tornado.web.RequestHandler):
+    def initialize(self, telegram_application: Application, secret_token: t.Optional[str]) -> None:
+        self.telegram_application = telegram_application
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        if self.secret_token is not None and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400)
+
+        # Handlers run on the application's own queue, so Telegram gets its 200 without waiting for uploads
+        await self.telegram_application.update_queue.put(Update.de_json(data, self.telegram_application.bot))
+        self.set_status(200)
+
+
+class OAuthCallbackHandler(tornado.web.RequestHandler):
+    def initialize(
+            self,
+            bot_name: str,
+            provider: t.Optional[BaseCloudProvider],
+            pending_authorizations: t.Optional[PendingAuthorizations]) -> None:
+        self.bot_name = bot_name
+        self.provider = provider
+        self.pending_authorizations = pending_authorizations
+
+    async def get(self) -> None:
+        code = self.get_argument('code', None)
+        if code is None:
+            raise tornado.web.HTTPError(400)
+
+        start_parameter = code
+        if self.pending_authorizations is not None and self.provider is not None:
+            try:
+                tokens = await self.provider.get_oauth_tokens(code)
+                start_parameter = self.pending_authorizations.add(tokens)
+            except Exception as ex:
+                # Fall back to the plain redirect, /start will try the exchange once more
+                logger.warning('Failed to exchange OAuth code on redirect: %s', ex)
+
+        self.redirect(f'https://t.me/{self.bot_name}?start={start_parameter}', permanent=True)
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, latencies: RequestLatencies) -> None:
+        self.latencies = latencies
+
+    def get(self) -> None:
+        self.write(self.latencies.summary())
+
+
+class WebhookServer:
+    def __init__(
+            self,
+            application: Application,
+            provider: t.Optional[BaseCloudProvider],
+            bot_name: str,
+            url_path: str = 'telegram',
+            callback_path: str = 'callback',
+            secret_token: t.Optional[str] = None,
+            pending_authorizations: t.Optional[PendingAuthorizations] = None) -> None:
+        self.latencies = RequestLatencies()
+        self.web_application = tornado.web.Application(
+            [
+                (f'/{url_path.strip("/")}', TelegramUpdateHandler, {'telegram_application': application, 'secret_token': secret_token}),
+                (f'/{callback_path.strip("/")}', OAuthCallbackHandler, {
+                    'bot_name': bot_name,
+                    'provider': provider,
+                    'pending_authorizations': pending_authorizations,
+                }),
+                ('/stats', StatsHandler, {'latencies': self.latencies}),
+            ],
+            log_function=self._log_request)
+        self._server: t.Optional[HTTPServer] = None
+
+    def _log_request(self, handler: tornado.web.RequestHandler) -> None:
+        route = handler.request.path if handler.get_status() != 404 else 'not_found'
+        self.latencies.observe(route, handler.request.request_time())
+        WEBHOOK_REQUEST_SECONDS.observe(handler.request.request_time(), route=route, status=handler.get_status())
+        logger.debug('%s %s %s %.2fms', handler.get_status(), handler.request.method, handler.request.path, handler.request.request_time() * 1000)
+
+    def listen(self, port: int, address: str = '') -> None:
+        self._server = HTTPServer(self.web_application, xheaders=True)
+        self._server.listen(port, address)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
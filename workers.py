@@ -0,0 +1,181 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import typing as t
+from queue import Full
+
+from telegram import Bot, Update
+from telegram.error import InvalidToken, RetryAfter, TelegramError, TimedOut
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(update: Update, worker_count: int) -> int:
+    # Every update of a chat goes to the same worker, so a chat is only ever handled and persisted by one process
+    chat = update.effective_chat
+    if chat is None:
+        return 0
+    return chat.id % worker_count
+
+
+def _run_worker(index: int, worker_count: int, queue: multiprocessing.Queue, db: str, bot_kwargs: t.Dict[str, t.Any]) -> None:
+    # Imported here so the dispatcher process doesn't pay for the provider SDKs it never uses
+    from file_index import FileIndex
+    from saver_bot import SaverBot
+    from sqlite_persistence import SqlitePersistence
+    from upload_queue import UploadJobStore
+
+    logging.basicConfig(level=logging.INFO, format=f'[worker {index}] %(asctime)s %(name)s %(levelname)s %(message)s')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    bot_kwargs = dict(bot_kwargs)
+    if bot_kwargs.pop('file_index', False):
+        bot_kwargs['file_index'] = FileIndex(db)
+    if bot_kwargs.pop('upload_queue', False):
+        # Jobs are sharded like updates, so a worker only resumes uploads of its own chats
+        bot_kwargs['upload_queue'] = UploadJobStore(db, shard_index=index, shard_count=worker_count)
+    if bot_kwargs.get('metrics_port') is not None:
+        # Every worker serves its own metrics, on consecutive ports
+        bot_kwargs['metrics_port'] += index
+    if bot_kwargs.get('spool_dir') is not None:
+        # Every worker removes leftover spool files on start, so they don't share a directory
+        bot_kwargs['spool_dir'] = os.path.join(bot_kwargs['spool_dir'], f'worker-{index}')
+    max_loaded_chats = bot_kwargs.pop('max_loaded_chats', 10000)
+    bot = SaverBot(
+        persistence=SqlitePersistence(db, max_loaded_chats=max_loaded_chats),
+        shard_index=index,
+        shard_count=worker_count,
+        polling=False,
+        **bot_kwargs)
+    bot.run_worker(queue)
+
+
+class UpdateDispatcher:
+    def __init__(
+            self,
+            token: str,
+            db: str,
+            worker_count: int,
+            bot_kwargs: t.Dict[str, t.Any],
+            queue_size: int = 1000,
+            restart_delay: float = 5,
+            stop_timeout: float = 60,
+            max_retry_delay: float = 30) -> None:
+        self.token = token
+        self.db = db
+        self.worker_count = worker_count
+        self.bot_kwargs = bot_kwargs
+        self.queue_size = queue_size
+        # A worker that exits is restarted, at most once per `restart_delay` seconds so a crashing one doesn't spin
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.max_retry_delay = max_retry_delay
+
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(maxsize=queue_size) for _ in range(worker_count)]
+        self.processes = [self._create_worker(index) for index in range(worker_count)]
+        self._started_at = [0.0] * worker_count
+
+    def _create_worker(self, index: int) -> multiprocessing.Process:
+        return self._context.Process(
+            target=_run_worker,
+            args=(index, self.worker_count, self.queues[index], self.db, self.bot_kwargs),
+            name=f'save-bot-worker-{index}')
+
+    def _start_worker(self, index: int) -> None:
+        self.processes[index].start()
+        self._started_at[index] = time.monotonic()
+
+    def _restart_dead_workers(self) -> None:
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or time.monotonic() - self._started_at[index] < self.restart_delay:
+                continue
+            logger.error('Worker %s exited with code %s, restarting it', index, process.exitcode)
+            process.close()
+            # A process killed while reading may have left the queue locked, the updates still in it are lost
+            self.queues[index].cancel_join_thread()
+            self.queues[index].close()
+            self.queues[index] = self._context.Queue(maxsize=self.queue_size)
+            self.processes[index] = self._create_worker(index)
+            self._start_worker(index)
+
+    def run(self) -> None:
+        for index in range(self.worker_count):
+            self._start_worker(index)
+        try:
+            asyncio.run(self._poll())
+        except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+            pass
+        finally:
+            self._stop_workers()
+
+    def _stop_workers(self) -> None:
+        # Workers handle their queued updates before the stop marker, one that doesn't get to it in time is terminated
+        for index, (queue, process) in enumerate(zip(self.queues, self.processes)):
+            if not process.is_alive():
+                continue
+            try:
+                queue.put(None, timeout=self.stop_timeout)
+            except Full:
+                logger.warning('Worker %s is not taking updates, terminating it', index)
+                process.terminate()
+        for index, process in enumerate(self.processes):
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                logger.warning('Worker %s did not stop in time, killing it', index)
+                process.kill()
+                process.join()
+
+    async def _poll(self) -> None:
+        loop = asyncio.get_running_loop()
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        telegram_api_url = self.bot_kwargs.get('telegram_api_url')
+        bot_urls = {}
+        if telegram_api_url is not None:
+            telegram_api_url = telegram_api_url.rstrip('/')
+            bot_urls = dict(base_url=f'{telegram_api_url}/bot', base_file_url=f'{telegram_api_url}/file/bot')
+        async with Bot(self.token, **bot_urls) as bot:
+            await bot.delete_webhook()
+            offset = None
+            retry_delay = 0.0
+            while True:
+                self._restart_dead_workers()
+                # Same error handling as Updater.start_polling, a Telegram outage must not stop the whole deployment
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, read_timeout=40)
+                except InvalidToken:
+                    raise
+                except RetryAfter as ex:
+                    logger.warning('Fetching updates is throttled, retrying in %ss', ex.retry_after)
+                    await asyncio.sleep(ex.retry_after)
+                    continue
+                except TimedOut:
+                    continue
+                except TelegramError as ex:
+                    retry_delay = min(self.max_retry_delay, max(1.0, retry_delay * 2))
+                    logger.warning('Fetching updates failed, retrying in %.0fs: %s', retry_delay, ex)
+                    await asyncio.sleep(retry_delay)
+                    continue
+                retry_delay = 0.0
+
+                for update in updates:
+                    await self._dispatch(get_shard(update, self.worker_count), update.to_dict())
+                    offset = update.update_id + 1
+
+    async def _dispatch(self, index: int, data: t.Dict[str, t.Any]) -> None:
+        # Blocks while the worker falls behind, which in turn stops fetching new updates. A full queue may also mean the
+        # worker died, so its liveness is checked while waiting.
+        while True:
+            # Looked up on every attempt, a restarted worker comes with a new queue
+            put = functools.partial(self.queues[index].put, data, timeout=self.restart_delay)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, put)
+                return
+            except Full:
+                self._restart_dead_workers()